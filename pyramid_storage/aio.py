@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import implementer
+
+from . import utils
+from .interfaces import IAsyncFileStorage, IFileStorage
+from .registry import register_file_storage_impl
+
+
+def includeme(config):
+    """Adds an asyncio API in front of the storage backend already
+    included, e.g. **pyramid_storage.s3**"""
+    storage = config.registry.queryUtility(IFileStorage)
+    if storage is None:
+        raise ConfigurationError(
+            "pyramid_storage.aio must be included after a storage backend, e.g. pyramid_storage.s3"
+        )
+    options = (("async.max_workers", False, 8),)
+    kwargs = utils.read_settings(config.registry.settings, options, "storage.")
+    impl = AsyncFileStorage(storage, max_workers=kwargs["async.max_workers"])
+
+    register_file_storage_impl(config, impl)
+
+
+@implementer(IAsyncFileStorage)
+class AsyncFileStorage(object):
+    """Asyncio counterpart of an **IFileStorage** backend.
+
+    Operations that do I/O (save, exists, delete) are coroutines. Neither
+    boto3 nor google-cloud-storage offers non-blocking calls, so these run on
+    a thread pool of at most **max_workers** threads, shared by all requests,
+    which keeps the event loop free and bounds the number of calls in flight.
+    Operations without I/O (url, extension checks) are plain methods.
+
+    :param storage: **IFileStorage** instance, e.g. **S3FileStorage**
+    :param max_workers: maximum number of concurrent backend calls
+    """
+
+    def __init__(self, storage, max_workers=8):
+        self.storage = storage
+        self.max_workers = int(max_workers)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix="pyramid_storage"
+                    )
+        return self._executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # The context is copied so calls are counted in the totals of the
+        # request that awaits them.
+        func = utils.in_context(functools.partial(func, *args, **kwargs))
+        return await loop.run_in_executor(self.executor, func)
+
+    def url(self, filename):
+        """Returns entire URL of the filename, joined to the base_url
+
+        :param filename: base name of file
+        """
+        return self.storage.url(filename)
+
+    def filename_allowed(self, filename, extensions=None):
+        """Checks if a filename has an allowed extension
+
+        :param filename: base name of file
+        :param extensions: iterable of extensions (or self.extensions)
+        """
+        return self.storage.filename_allowed(filename, extensions)
+
+    def file_allowed(self, fs, extensions=None):
+        """Checks if a file can be saved, based on extensions
+
+        :param fs: **cgi.FieldStorage** object or similar
+        :param extensions: iterable of extensions (or self.extensions)
+        """
+        return self.storage.file_allowed(fs, extensions)
+
+    async def exists(self, *args, **kwargs):
+        """Checks if file exists. Takes the same arguments as the
+        backend's **exists**."""
+        return await self._run(self.storage.exists, *args, **kwargs)
+
+    async def exists_many(self, *args, **kwargs):
+        """Checks if several files exist. Takes the same arguments as the
+        backend's **exists_many**."""
+        return await self._run(self.storage.exists_many, *args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        """Deletes the filename. Takes the same arguments as the
+        backend's **delete**."""
+        return await self._run(self.storage.delete, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        """Deletes several files. Takes the same arguments as the
+        backend's **delete_many**."""
+        return await self._run(self.storage.delete_many, *args, **kwargs)
+
+    async def copy(self, *args, **kwargs):
+        """Copies a stored file. Takes the same arguments as the backend's
+        **copy**."""
+        return await self._run(self.storage.copy, *args, **kwargs)
+
+    async def move(self, *args, **kwargs):
+        """Moves a stored file. Takes the same arguments as the backend's
+        **move**."""
+        return await self._run(self.storage.move, *args, **kwargs)
+
+    async def copy_many(self, *args, **kwargs):
+        """Copies several files. Takes the same arguments as the backend's
+        **copy_many**."""
+        return await self._run(self.storage.copy_many, *args, **kwargs)
+
+    async def move_many(self, *args, **kwargs):
+        """Moves several files. Takes the same arguments as the backend's
+        **move_many**."""
+        return await self._run(self.storage.move_many, *args, **kwargs)
+
+    async def save(self, fs, *args, **kwargs):
+        """Saves contents of a **cgi.FieldStorage** object. Takes the same
+        arguments as the backend's **save**.
+
+        :returns: modified filename
+        """
+        return await self._run(self.storage.save, fs, *args, **kwargs)
+
+    async def save_file(self, file, filename, *args, **kwargs):
+        """Saves a file object. Takes the same arguments as the backend's
+        **save_file**.
+
+        :returns: modified filename
+        """
+        return await self._run(self.storage.save_file, file, filename, *args, **kwargs)
+
+    async def save_filename(self, filename, *args, **kwargs):
+        """Saves a filename in local filesystem. Takes the same arguments
+        as the backend's **save_filename**.
+
+        :returns: modified filename
+        """
+        return await self._run(self.storage.save_filename, filename, *args, **kwargs)
+
+    async def save_many(self, items):
+        """Saves many files. Takes the same arguments as the backend's
+        **save_many**.
+
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return await self._run(self.storage.save_many, items)
+
+    def close(self):
+        """Shuts down the thread pool, waiting for pending calls."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
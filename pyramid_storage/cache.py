@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import implementer
+
+from . import utils
+from .interfaces import IFileStorage
+
+
+def cache_from_settings(settings, prefix):
+    """Returns a cache configured by the **cache.*** settings, or **None**
+    if **cache.backend** is not set.
+
+    :param settings: dict(-like) of settings
+    :param prefix: prefix separating these settings
+    """
+    options = (
+        ("cache.backend", False, None),
+        ("cache.ttl", False, 60),
+        ("cache.max_entries", False, 10000),
+        ("cache.path", False, None),
+    )
+    kwargs = utils.read_settings(settings, options, prefix)
+    backend = kwargs["cache.backend"]
+    if not backend:
+        return None
+    if backend == "memory":
+        return MemoryCache(ttl=kwargs["cache.ttl"], max_entries=kwargs["cache.max_entries"])
+    if backend == "file":
+        if not kwargs["cache.path"]:
+            raise ConfigurationError("%scache.path is required" % prefix)
+        return FileCache(
+            kwargs["cache.path"], ttl=kwargs["cache.ttl"], max_entries=kwargs["cache.max_entries"]
+        )
+    raise ConfigurationError('%scache.backend must be "memory" or "file"' % prefix)
+
+
+class MemoryCache(object):
+    """In-process cache holding up to **max_entries** values for **ttl**
+    seconds each, evicting the least recently used first.
+
+    :param ttl: lifetime of an entry in seconds
+    :param max_entries: maximum number of entries
+    """
+
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value for key, or **None** if missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileCache(object):
+    """Cache shared by all processes on a host, storing one small file per
+    entry under **path**. Put **path** on a tmpfs such as /dev/shm to keep
+    it in memory. Entries expire after **ttl** seconds; beyond
+    **max_entries** the oldest entries are removed first.
+
+    :param path: directory holding the entries
+    :param ttl: lifetime of an entry in seconds
+    :param max_entries: maximum number of entries
+    """
+
+    # Check the number of entries once every this many writes.
+    prune_interval = 100
+
+    def __init__(self, path, ttl=60, max_entries=10000):
+        self.path = path
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._writes = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        """Returns the value for key, or **None** if missing or expired."""
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl < time.time():
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return data == b"1"
+
+    def set(self, key, value):
+        path = self._path(key)
+        temp_path = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        with open(temp_path, "wb") as f:
+            f.write(b"1" if value else b"0")
+        os.replace(temp_path, path)
+
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def prune(self):
+        """Removes expired entries, then the oldest entries beyond
+        **max_entries**."""
+        cutoff = time.time() - self.ttl
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                entries.append((mtime, entry.path))
+        entries.sort()
+        excess = len(entries) - self.max_entries
+        for index, (mtime, path) in enumerate(entries):
+            if mtime >= cutoff and index >= excess:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+@implementer(IFileStorage)
+class CachedFileStorage(object):
+    """Caches the results of **exists** in front of any **IFileStorage**
+    implementation, both positive and negative. Saving or deleting a file
+    through this object updates or removes its entry. All other attributes are those
+    of the wrapped storage.
+
+    :param storage: **IFileStorage** instance
+    :param cache: :class:`MemoryCache` or :class:`FileCache` instance
+    """
+
+    def __init__(self, storage, cache):
+        self.storage = storage
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _key(self, filename, bucket_name=None):
+        # Calls naming the default bucket share the entries of those that
+        # do not name any.
+        bucket_name = bucket_name or getattr(self.storage, "bucket_name", None)
+        return "%s\0%s" % (bucket_name or "", filename)
+
+    def _bucket_name(self, method, *args, **kwargs):
+        """Returns the bucket_name argument of a call to a method of the
+        storage, whether it is passed by position or by keyword."""
+        try:
+            arguments = utils.bind_arguments(getattr(self.storage, method), *args, **kwargs)
+        except TypeError:
+            return None
+        return arguments.get("bucket_name")
+
+    def exists(self, filename, *args, **kwargs):
+        key = self._key(filename, self._bucket_name("exists", filename, *args, **kwargs))
+        result = self.cache.get(key)
+        if result is None:
+            result = bool(self.storage.exists(filename, *args, **kwargs))
+            self.cache.set(key, result)
+        return result
+
+    def exists_many(self, filenames, bucket_name=None, **kwargs):
+        results = {}
+        missing = []
+        for filename in filenames:
+            result = self.cache.get(self._key(filename, bucket_name))
+            if result is None:
+                missing.append(filename)
+            else:
+                results[filename] = result
+        if missing:
+            if bucket_name:
+                kwargs["bucket_name"] = bucket_name
+            for filename, result in self.storage.exists_many(missing, **kwargs).items():
+                self.cache.set(self._key(filename, bucket_name), result)
+                results[filename] = result
+        return results
+
+    def delete(self, filename, *args, **kwargs):
+        try:
+            return self.storage.delete(filename, *args, **kwargs)
+        finally:
+            bucket_name = self._bucket_name("delete", filename, *args, **kwargs)
+            self.cache.delete(self._key(filename, bucket_name))
+
+    def delete_many(self, filenames, bucket_name=None):
+        filenames = list(filenames)
+        try:
+            if bucket_name:
+                return self.storage.delete_many(filenames, bucket_name=bucket_name)
+            return self.storage.delete_many(filenames)
+        finally:
+            for filename in filenames:
+                self.cache.delete(self._key(filename, bucket_name))
+
+    def copy(self, src, dst, bucket_name=None, **kwargs):
+        if bucket_name:
+            kwargs["bucket_name"] = bucket_name
+        try:
+            return self.storage.copy(src, dst, **kwargs)
+        finally:
+            self.cache.delete(self._key(dst, bucket_name))
+
+    def move(self, src, dst, bucket_name=None, **kwargs):
+        if bucket_name:
+            kwargs["bucket_name"] = bucket_name
+        try:
+            return self.storage.move(src, dst, **kwargs)
+        finally:
+            self.cache.delete(self._key(src, bucket_name))
+            self.cache.delete(self._key(dst, bucket_name))
+
+    def copy_many(self, pairs, bucket_name=None):
+        return utils.transfer_many(
+            lambda src, dst: self.copy(src, dst, bucket_name), pairs, self.storage.max_workers
+        )
+
+    def move_many(self, pairs, bucket_name=None):
+        return utils.transfer_many(
+            lambda src, dst: self.move(src, dst, bucket_name), pairs, self.storage.max_workers
+        )
+
+    def save(self, fs, *args, **kwargs):
+        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+
+    def save_filename(self, filename, *args, **kwargs):
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    def save_file(self, file, filename, *args, **kwargs):
+        bucket_name = self._bucket_name("save_file", file, filename, *args, **kwargs)
+        filename = self.storage.save_file(file, filename, *args, **kwargs)
+        self.cache.set(self._key(filename, bucket_name), True)
+        return filename
+
+    def complete_upload(self, filename, *args, **kwargs):
+        bucket_name = self._bucket_name("complete_upload", filename, *args, **kwargs)
+        filename = self.storage.complete_upload(filename, *args, **kwargs)
+        self.cache.set(self._key(filename, bucket_name), True)
+        return filename
+
+    def save_many(self, items):
+        return utils.save_many(self, items, self.storage.max_workers)
@@ -5,3 +5,9 @@ class FileNotAllowed(Exception):
     """
     Thrown if file does not have an allowed extension.
     """
+
+
+class ContentNotAllowed(FileNotAllowed):
+    """
+    Thrown if the contents of a file do not match its extension.
+    """
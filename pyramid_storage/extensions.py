@@ -1,3 +1,7 @@
+import functools
+import os
+
+
 ANY = ()
 TEXT = ("txt",)
 DOCUMENTS = tuple("pdf rtf odf ods gnumeric abw doc docx xls xlsx".split())
@@ -45,3 +49,69 @@ def resolve_extensions(extensions):
             for ext in group.split():
                 rv.add(ext.lower())
     return rv
+
+
+class ExtensionPolicy(object):
+    """
+    Compiled set of allowed extensions. An empty set allows any
+    extension. Extensions may contain dots, e.g. "tar.gz", in which
+    case both the last suffix and the multi-dot suffix of a filename
+    are checked.
+
+    :param extensions: iterable of extensions, with or without leading dot
+    """
+
+    def __init__(self, extensions):
+        self.extensions = frozenset(ext.lstrip(".").lower() for ext in extensions)
+        self.max_dots = max([ext.count(".") for ext in self.extensions] or [0]) + 1
+
+    def extension_allowed(self, ext):
+        """Checks if an extension is permitted. Both e.g. ".jpg" and
+        "jpg" can be passed in. Extension lookup is case-insensitive.
+
+        :param ext: extension
+        """
+        if not self.extensions:
+            return True
+        if ext.startswith("."):
+            ext = ext[1:]
+        return ext.lower() in self.extensions
+
+    def filename_allowed(self, filename):
+        """Checks if a filename has an allowed extension
+
+        :param filename: name of file
+        """
+        if not self.extensions:
+            return True
+        parts = os.path.basename(filename).lstrip(".").lower().rsplit(".", self.max_dots)
+        for index in range(len(parts) - 1, 0, -1):
+            if ".".join(parts[index:]) in self.extensions:
+                return True
+        return False
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(extensions):
+    if isinstance(extensions, str):
+        extensions = resolve_extensions(extensions)
+    return ExtensionPolicy(extensions)
+
+
+def get_policy(extensions, default=None):
+    """
+    Returns a cached :class:`ExtensionPolicy` for an extensions string
+    (see :func:`resolve_extensions`) or iterable of extensions. If
+    extensions is **None** returns default. An empty iterable allows any
+    extension.
+
+    :param extensions: extensions string, iterable or policy
+    :param default: policy returned if extensions is **None**
+    """
+    if extensions is None:
+        return default
+    if isinstance(extensions, ExtensionPolicy):
+        return extensions
+    if not isinstance(extensions, str):
+        extensions = frozenset(extensions)
+    return _compile(extensions)
@@ -1,22 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import mimetypes
 import os
+import time
 import urllib
 
 from pyramid.exceptions import ConfigurationError
 from pyramid.settings import asbool
 from zope.interface import implementer
 
-from . import utils
+from . import instrumentation, utils, validation
 from .exceptions import FileNotAllowed
-from .extensions import resolve_extensions
+from .extensions import get_policy
 from .interfaces import IFileStorage
 from .registry import register_file_storage_impl
 
 
 try:
-    from google.cloud.exceptions import NotFound
+    import requests
+    from google.api_core.exceptions import (
+        GoogleAPICallError,
+        ServerError,
+        TooManyRequests,
+        from_http_response,
+    )
+    from google.cloud.exceptions import NotFound, PreconditionFailed
     from google.cloud.storage.blob import Blob
     from google.cloud.storage.client import Client
 except ImportError:
@@ -35,9 +44,29 @@ def includeme(config):
 DEFAULT_BUCKET_ACL = "projectPrivate"
 DEFAULT_FILE_ACL = "publicRead"
 
+MB = 1024 * 1024
+
+# Chunks of a resumable upload must be a multiple of this size.
+CHUNK_SIZE_MULTIPLE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 8 * MB
+
+# Errors after which a chunk of a resumable upload is sent again.
+RETRYABLE_ERRORS = (
+    ServerError,
+    TooManyRequests,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+instrumented = instrumentation.instrumented("gcloud")
+
 
 @implementer(IFileStorage)
 class GoogleCloudStorage(object):
+    # Unless replace is set, save_file leaves a file already stored under
+    # the name in place instead of saving under another name.
+    keeps_existing_files = True
+
     @classmethod
     def from_settings(cls, settings, prefix):
         options = (
@@ -47,14 +76,23 @@ class GoogleCloudStorage(object):
             ("gcloud.acl", False, None),
             ("base_url", False, ""),
             ("extensions", False, "default"),
+            ("max_workers", False, 8),
+            ("sniff_content", False, False),
             # Gcloud Connection options.
             ("gcloud.auto_create_bucket", False, False),
             ("gcloud.auto_create_acl", False, None),
             ("gcloud.cache_control", False, None),
             ("gcloud.uniform_bucket_level_access", False, False),
+            # Upload options.
+            ("gcloud.chunk_size", False, None),
+            ("gcloud.resumable_threshold", False, 8 * MB),
+            ("gcloud.read_buffer_size", False, MB),
+            ("gcloud.upload_timeout", False, 60),
+            ("gcloud.chunk_retries", False, 3),
         )
         kwargs = utils.read_settings(settings, options, prefix)
         kwargs = dict([(k.replace("gcloud.", ""), v) for k, v in kwargs.items()])
+        kwargs["hooks"] = instrumentation.hooks_from_settings(settings, prefix)
         return cls(**kwargs)
 
     def __init__(
@@ -69,6 +107,14 @@ class GoogleCloudStorage(object):
         auto_create_acl=None,
         cache_control=None,
         uniform_bucket_level_access=False,
+        chunk_size=None,
+        resumable_threshold=8 * MB,
+        read_buffer_size=MB,
+        upload_timeout=60,
+        chunk_retries=3,
+        max_workers=8,
+        sniff_content=False,
+        hooks=None,
     ):
         if (acl or auto_create_acl) and uniform_bucket_level_access:
             raise ConfigurationError(
@@ -90,11 +136,27 @@ class GoogleCloudStorage(object):
         self.project = project
         self.bucket_name = bucket_name
         self.base_url = base_url
-        self.extensions = resolve_extensions(extensions)
+        self.extension_policy = get_policy(extensions)
+        self.extensions = self.extension_policy.extensions
         self.auto_create_bucket = auto_create_bucket
         self.cache_control = cache_control
         self.uniform_bucket_level_access = asbool(uniform_bucket_level_access)
 
+        if chunk_size is not None:
+            chunk_size = int(chunk_size)
+            if chunk_size % CHUNK_SIZE_MULTIPLE:
+                raise ConfigurationError(
+                    '"chunk_size" must be a multiple of %d bytes' % CHUNK_SIZE_MULTIPLE
+                )
+        self.chunk_size = chunk_size
+        self.resumable_threshold = int(resumable_threshold)
+        self.read_buffer_size = int(read_buffer_size)
+        self.upload_timeout = float(upload_timeout)
+        self.chunk_retries = int(chunk_retries)
+        self.max_workers = int(max_workers)
+        self.sniff_content = asbool(sniff_content)
+        self.hooks = list(hooks or ())
+
         self._client = None
         self._bucket = None
 
@@ -150,6 +212,7 @@ class GoogleCloudStorage(object):
         """
         return urllib.parse.urljoin(self.base_url, filename)
 
+    @instrumented
     def exists(self, name, bucket_name=None):
         if not name:  # root element aka the bucket
             try:
@@ -160,6 +223,85 @@ class GoogleCloudStorage(object):
 
         return bool(self.get_bucket(bucket_name).get_blob(name))
 
+    @instrumented
+    def open(self, name, mode="rb", bucket_name=None):
+        """Opens a stored file for reading. Data is fetched with ranged
+        requests of at least **read_buffer_size** bytes as it is read, so
+        reading part of a large file does not download all of it. Reads
+        fail if the file is replaced while it is open.
+
+        :param name: base name of file
+        :param mode: only "rb" is supported
+        :param bucket_name: name of the bucket, if not default
+        :returns: seekable file object
+        """
+        if mode != "rb":
+            raise ValueError('only "rb" mode is supported')
+        blob = self.get_bucket(bucket_name).get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(name)
+        instrumentation.add_bytes(blob.size)
+        return blob.open(
+            "rb", chunk_size=self.read_buffer_size, if_generation_match=blob.generation
+        )
+
+    @instrumented
+    def exists_many(self, names, bucket_name=None, prefix=None):
+        """Checks if several files exist. Returns a dict mapping each
+        name to **True** or **False**.
+
+        By default each file is looked up with its own request, with up to
+        **max_workers** requests in flight. If all the files share a prefix
+        (e.g. a folder) that holds few other files, pass it as **prefix** to
+        list the files under it instead: one request per 1000 files.
+
+        :param names: iterable of base names of files
+        :param bucket_name: name of bucket, if not default
+        :param prefix: list the files under this prefix instead
+        """
+        names = list(names)
+        if prefix is not None:
+            blobs = self.get_connection().list_blobs(self.get_bucket(bucket_name), prefix=prefix)
+            existing = set(blob.name for blob in blobs)
+            return dict((name, name in existing) for name in names)
+
+        results = utils.map_concurrently(
+            lambda name: self.exists(name, bucket_name), names, self.max_workers
+        )
+        return dict(zip(names, results))
+
+    def list(self, prefix="", recursive=True, bucket_name=None):
+        """Yields a :class:`pyramid_storage.utils.FileInfo` for each file
+        whose name starts with prefix, e.g. "photos/", fetching one page of
+        results at a time.
+
+        :param prefix: prefix of the names
+        :param recursive: include files in sub-folders; otherwise only
+            those without a "/" after the prefix are listed
+        :param bucket_name: name of the bucket, if not default
+        """
+        blobs = self.get_connection().list_blobs(
+            self.get_bucket(bucket_name),
+            prefix=prefix or None,
+            delimiter=None if recursive else "/",
+        )
+        for page in blobs.pages:
+            for blob in page:
+                mtime = blob.updated.timestamp() if blob.updated else None
+                yield utils.FileInfo(blob.name, blob.size, mtime, blob.etag)
+
+    def list_many(self, prefixes, **kwargs):
+        """Yields the files listed by :meth:`list` for each prefix, listing
+        the prefixes in parallel on up to **max_workers** threads, in no
+        particular order. Splitting a large bucket into prefixes, e.g. by
+        the first character of the names, speeds up listing all of it.
+
+        :param prefixes: iterable of prefixes that do not overlap
+        :param kwargs: keyword arguments for :meth:`list`
+        """
+        return utils.list_concurrently(self, prefixes, self.max_workers, **kwargs)
+
+    @instrumented
     def delete(self, filename, bucket_name=None):
         """Deletes the filename. Filename is resolved with the
         absolute path based on base_path. If file does not exist,
@@ -170,14 +312,104 @@ class GoogleCloudStorage(object):
         """
         self.get_bucket(bucket_name).delete_blob(filename)
 
+    @instrumented
+    def delete_many(self, filenames, bucket_name=None):
+        """Deletes several files, with up to **max_workers** requests in
+        flight. Returns a dict mapping each filename to **True** if it was
+        deleted or **False** if it did not exist or could not be deleted.
+
+        :param filenames: iterable of base names of files
+        :param bucket_name: name of bucket, if not default
+        """
+        filenames = list(filenames)
+        bucket = self.get_bucket(bucket_name)
+
+        def delete(filename):
+            try:
+                bucket.blob(filename).delete()
+            except GoogleAPICallError:
+                return False
+            return True
+
+        results = utils.map_concurrently(delete, filenames, self.max_workers)
+        return dict(zip(filenames, results))
+
+    @instrumented
+    def copy(self, src, dst, bucket_name=None, acl=None):
+        """Copies a stored file to another name inside Google Cloud
+        Storage, replacing dst if it exists, without the data passing
+        through this process. The copy is a rewrite, repeated until the
+        service reports it done, so large files are copied too. Returns
+        dst.
+
+        :param src: name of the file to copy
+        :param dst: name of the copy
+        :param bucket_name: name of the bucket, if not default
+        :param acl: ACL policy (if None then uses default)
+        :raises FileNotFoundError: if src does not exist
+        """
+        bucket = self.get_bucket(bucket_name)
+        source = bucket.blob(src)
+        blob = bucket.blob(dst)
+        try:
+            token, _, _ = blob.rewrite(source)
+            while token is not None:
+                token, _, _ = blob.rewrite(source, token=token)
+        except NotFound:
+            raise FileNotFoundError(src)
+        if not self.uniform_bucket_level_access and (acl or self.acl):
+            blob.acl.save_predefined(acl or self.acl)
+        return dst
+
+    @instrumented
+    def move(self, src, dst, bucket_name=None, acl=None):
+        """Copies a stored file to another name with :meth:`copy`, then
+        deletes src. Returns dst.
+
+        :param src: name of the file to move
+        :param dst: new name of the file
+        :param bucket_name: name of the bucket, if not default
+        :param acl: ACL policy (if None then uses default)
+        :raises FileNotFoundError: if src does not exist
+        """
+        self.copy(src, dst, bucket_name, acl)
+        if src != dst:
+            self.delete(src, bucket_name)
+        return dst
+
+    @instrumented
+    def copy_many(self, pairs, bucket_name=None):
+        """Copies several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was copied or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        :param bucket_name: name of the bucket, if not default
+        """
+        return utils.transfer_many(
+            lambda src, dst: self.copy(src, dst, bucket_name), pairs, self.max_workers
+        )
+
+    @instrumented
+    def move_many(self, pairs, bucket_name=None):
+        """Moves several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was moved or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        :param bucket_name: name of the bucket, if not default
+        """
+        return utils.transfer_many(
+            lambda src, dst: self.move(src, dst, bucket_name), pairs, self.max_workers
+        )
+
     def filename_allowed(self, filename, extensions=None):
         """Checks if a filename has an allowed extension
 
         :param filename: base name of file
         :param extensions: iterable of extensions (or self.extensions)
         """
-        _, ext = os.path.splitext(filename)
-        return self.extension_allowed(ext, extensions)
+        return get_policy(extensions, self.extension_policy).filename_allowed(filename)
 
     def file_allowed(self, fs, extensions=None):
         """Checks if a file can be saved, based on extensions
@@ -193,13 +425,7 @@ class GoogleCloudStorage(object):
 
         :param extensions: iterable of extensions (or self.extensions)
         """
-
-        extensions = extensions or self.extensions
-        if not extensions:
-            return True
-        if ext.startswith("."):
-            ext = ext[1:]
-        return ext.lower() in extensions
+        return get_policy(extensions, self.extension_policy).extension_allowed(ext)
 
     def save(self, fs, *args, **kwargs):
         """Saves contents of a **cgi.FieldStorage** object to the file system.
@@ -232,6 +458,19 @@ class GoogleCloudStorage(object):
         """
         return self.save_file(open(filename, "rb"), filename, *args, **kwargs)
 
+    @instrumented
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads.
+        Errors are collected per item rather than aborting the batch.
+
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.max_workers)
+
+    @instrumented
     def save_file(
         self,
         file,
@@ -243,6 +482,9 @@ class GoogleCloudStorage(object):
         acl=None,
         replace=False,
         headers={},
+        upload_session_callback=None,
+        content_addressed=False,
+        _reserved=False,
     ):
         """
         :param filename: local filename
@@ -252,47 +494,302 @@ class GoogleCloudStorage(object):
         :param extensions: iterable of allowed extensions, if not default
         :param acl: ACL policy (if None then uses default)
         :param headers: dict request headers (used to specify for content-type)
+        :param upload_session_callback: called with the filename and the
+            session URL before a resumable upload starts, so the session can
+            be saved and later passed to :meth:`resume_upload`
+        :param content_addressed: name the file after the SHA-256 digest of
+            its contents and skip the upload if it already exists
         :returns: modified filename
         """
-        extensions = extensions or self.extensions
-
         if not self.filename_allowed(filename, extensions):
             raise FileNotAllowed()
 
+        if self.sniff_content:
+            policy = get_policy(extensions, self.extension_policy)
+            file = validation.sniff(file, filename, policy.extensions)
+
         filename = utils.secure_filename(os.path.basename(filename))
 
-        if randomize:
+        md5 = None
+        if content_addressed:
+            file, sha256, md5 = utils.digest_file(file, self.chunk_size or DEFAULT_CHUNK_SIZE)
+            filename = utils.content_filename(filename, sha256.hexdigest())
+        elif randomize:
             filename = utils.random_filename(filename)
 
         if folder:
             filename = folder + "/" + filename
 
+        if content_addressed and self.exists(filename, bucket_name):
+            return filename
+
         content_type = headers.get("Content-Type")
         if content_type is None:
             content_type, _ = mimetypes.guess_type(filename)
         content_type = content_type or "application/octet-stream"
 
-        blob = self.get_bucket(bucket_name).get_blob(filename)
-
-        # If the file exist and we explicitely asked not to replace it: ignore it.
-        if blob and not replace:
-            return filename
-
-        # If the file doesn't exist: create it.
-        if not blob:
-            blob = Blob(filename, self.get_bucket(bucket_name))
-
+        blob = Blob(filename, self.get_bucket(bucket_name))
         blob.cache_control = self.cache_control
+        blob.chunk_size = self.chunk_size
+        if md5 is not None:
+            # Google Cloud Storage rejects the upload if the data differs.
+            blob.md5_hash = utils.b64_digest(md5)
         file.seek(0)
 
         kwargs = {
-            "rewind": True,
             "content_type": content_type,
         }
 
         if not self.uniform_bucket_level_access:
             kwargs["predefined_acl"] = acl or self.acl
 
-        blob.upload_from_file(file, **kwargs)
+        # Rather than looking the file up first, make the upload conditional
+        # on the file not existing yet.
+        if not replace:
+            kwargs["if_generation_match"] = 0
+
+        size = utils.get_file_size(file)
+
+        try:
+            if size is not None and size > self.resumable_threshold:
+                session_url = blob.create_resumable_upload_session(size=size, **kwargs)
+                if upload_session_callback:
+                    upload_session_callback(filename, session_url)
+                self._upload_chunks(file, session_url, size, 0)
+            else:
+                if size is not None:
+                    kwargs["size"] = size
+                blob.upload_from_file(file, rewind=True, **kwargs)
+        except PreconditionFailed:
+            # A name handed out in advance was taken by someone else: the
+            # caller must not take their file for ours, e.g. to remove it.
+            if _reserved:
+                raise
+            # If the file exist and we explicitely asked not to replace it: ignore it.
+        else:
+            instrumentation.add_bytes(size)
 
         return filename
+
+    def reserve_filename(self, filename, folder=None, randomize=False, extensions=None):
+        """Returns the name :meth:`save_file` would store a file under. Names
+        cannot be reserved in Google Cloud Storage, so nothing else is done.
+
+        :param filename: original filename
+        :param folder: relative path of sub-folder
+        :param randomize: randomize the filename
+        :param extensions: iterable of allowed extensions, if not default
+        :returns: modified filename
+        """
+        if not self.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+        return utils.resolve_filename(filename, folder, randomize)
+
+    def release_filename(self, filename, bucket_name=None):
+        """Gives back a name returned by :meth:`reserve_filename`. Nothing is
+        reserved in Google Cloud Storage, so this does nothing.
+
+        :param filename: name returned by :meth:`reserve_filename`
+        """
+
+    def presigned_url(self, name, expires_in=3600, bucket_name=None, download_name=None):
+        """Returns a signed URL to download a file straight from Google
+        Cloud Storage, e.g. from a private bucket.
+
+        :param name: base name of file
+        :param expires_in: number of seconds the URL is valid for
+        :param bucket_name: name of the bucket, if not default
+        :param download_name: filename offered to the browser, as an
+            attachment, if given
+        """
+        blob = self.get_bucket(bucket_name).blob(name)
+        disposition = None
+        if download_name:
+            disposition = 'attachment; filename="%s"' % download_name
+        return blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.timedelta(seconds=int(expires_in)),
+            method="GET",
+            response_disposition=disposition,
+        )
+
+    def presigned_upload(
+        self,
+        filename,
+        folder=None,
+        bucket_name=None,
+        randomize=False,
+        extensions=None,
+        acl=None,
+        content_type=None,
+        max_size=None,
+        expires_in=3600,
+        method="POST",
+    ):
+        """Returns a :class:`pyramid_storage.utils.PresignedUpload` a
+        client can use to upload a file straight to Google Cloud Storage,
+        without sending it through the application. The file is named as
+        by :meth:`save_file`. Call :meth:`complete_upload` once the client
+        is done.
+
+        A "POST" upload is limited to max_size bytes and to content_type by
+        a signed policy; a "PUT" upload is only checked by
+        :meth:`complete_upload`.
+
+        :param filename: original filename
+        :param folder: relative path of sub-folder
+        :param bucket_name: name of the bucket, if not default
+        :param randomize: randomize the filename
+        :param extensions: iterable of allowed extensions, if not default
+        :param acl: ACL policy (if None then uses default)
+        :param content_type: required content type, by default guessed from
+            the filename
+        :param max_size: maximum size in bytes
+        :param expires_in: number of seconds the upload is allowed for
+        :param method: "POST" or "PUT"
+        :returns: :class:`pyramid_storage.utils.PresignedUpload`
+        """
+        if not self.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        filename = utils.resolve_filename(filename, folder, randomize)
+        bucket = self.get_bucket(bucket_name)
+        acl = None if self.uniform_bucket_level_access else acl or self.acl
+        if content_type is None:
+            content_type, _ = mimetypes.guess_type(filename)
+        content_type = content_type or "application/octet-stream"
+        expiration = datetime.timedelta(seconds=int(expires_in))
+
+        if method == "POST":
+            fields = {"Content-Type": content_type}
+            if acl:
+                fields["acl"] = acl
+            conditions = [{name: value} for name, value in fields.items()]
+            if max_size is not None:
+                conditions.append(["content-length-range", 0, int(max_size)])
+            policy = self.get_connection().generate_signed_post_policy_v4(
+                bucket.name, filename, expiration, conditions=conditions, fields=fields
+            )
+            return utils.PresignedUpload(filename, policy["url"], method, fields=policy["fields"])
+
+        if method == "PUT":
+            headers = {"Content-Type": content_type}
+            if acl:
+                headers["x-goog-acl"] = acl
+            url = bucket.blob(filename).generate_signed_url(
+                version="v4",
+                expiration=expiration,
+                method="PUT",
+                content_type=content_type,
+                headers={k: v for k, v in headers.items() if k != "Content-Type"},
+            )
+            return utils.PresignedUpload(filename, url, method, headers=headers)
+
+        raise ValueError('method must be "POST" or "PUT"')
+
+    def complete_upload(self, name, max_size=None, content_type=None, bucket_name=None):
+        """Checks a file uploaded with :meth:`presigned_upload`. The file is
+        deleted and **FileNotAllowed** raised if it is larger than max_size,
+        does not have the given content type, or (if **sniff_content** is
+        set) its contents do not match its extension.
+
+        :param name: name returned by :meth:`presigned_upload`
+        :param max_size: maximum size in bytes
+        :param content_type: required content type
+        :param bucket_name: name of the bucket, if not default
+        :raises FileNotFoundError: if the file was not uploaded
+        :returns: name
+        """
+        blob = self.get_bucket(bucket_name).get_blob(name)
+        if blob is None:
+            raise FileNotFoundError(name)
+
+        try:
+            if max_size is not None and blob.size > int(max_size):
+                raise FileNotAllowed()
+            if content_type and blob.content_type != content_type:
+                raise FileNotAllowed()
+            if self.sniff_content:
+                with self.open(name, bucket_name=bucket_name) as file:
+                    validation.sniff(file, name, self.extensions)
+        except FileNotAllowed:
+            blob.delete()
+            raise
+        return name
+
+    def resume_upload(self, file, session_url):
+        """Resumes a resumable upload, e.g. one interrupted by a worker
+        crash. The server is asked how many bytes it has already stored and
+        only the rest of the file is sent.
+
+        :param file: the same file object (or contents) as the original upload
+        :param session_url: session URL passed to the **upload_session_callback**
+            of :meth:`save_file`
+        """
+        self._upload_chunks(file, session_url, utils.get_file_size(file), None)
+
+    def _upload_chunks(self, file, session_url, size, offset):
+        """Sends the file from offset on in chunks. If offset is **None**, or
+        a request fails with a server or connection error, the server is
+        first asked how many bytes it has stored. A failing request is
+        retried up to **chunk_retries** times.
+        """
+        chunk_size = self.chunk_size or DEFAULT_CHUNK_SIZE
+        attempt = 0
+        while True:
+            if offset is None:
+                data = b""
+                end = 0
+                content_range = "bytes */%s" % ("*" if size is None else size)
+            else:
+                file.seek(offset)
+                data = file.read(chunk_size)
+                end = offset + len(data)
+                if len(data) < chunk_size:
+                    total = end
+                else:
+                    total = "*" if size is None else size
+                if data:
+                    content_range = "bytes %d-%d/%s" % (offset, end - 1, total)
+                else:
+                    content_range = "bytes */%s" % total
+            try:
+                response = self._put_chunk(session_url, data, content_range)
+            except RETRYABLE_ERRORS:
+                attempt += 1
+                if attempt > self.chunk_retries:
+                    raise
+                instrumentation.add_retries()
+                time.sleep(0.1 * 2**attempt)
+                # Part of the chunk may have been stored: ask the server.
+                offset = None
+                continue
+            attempt = 0
+            if response.status_code in (200, 201):
+                return
+            offset = self._next_offset(response)
+            if offset < end:
+                # The server did not persist the whole chunk: send the rest again.
+                instrumentation.add_retries()
+
+    def _put_chunk(self, session_url, data, content_range):
+        transport = self.get_connection()._http
+        response = transport.request(
+            "PUT",
+            session_url,
+            data=data,
+            headers={"Content-Range": content_range},
+            timeout=self.upload_timeout,
+        )
+        if response.status_code not in (200, 201, 308):
+            raise from_http_response(response)
+        return response
+
+    def _next_offset(self, response):
+        if response.status_code != 308:
+            raise from_http_response(response)
+        # The Range header ("bytes=0-N") lists the bytes persisted so far.
+        persisted = response.headers.get("Range")
+        if not persisted:
+            return 0
+        return int(persisted.rsplit("-", 1)[1]) + 1
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+
+import contextvars
+import functools
+import logging
+import socket
+import threading
+import time
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.path import DottedNameResolver
+from pyramid.settings import asbool, aslist
+
+from . import utils
+
+
+log = logging.getLogger(__name__)
+
+# The call in progress in the current context, and the totals of the
+# request being handled, if any.
+_operation = contextvars.ContextVar("pyramid_storage_operation", default=None)
+_totals = contextvars.ContextVar("pyramid_storage_totals", default=None)
+
+# Guards the counters of operations and totals, which calls running on
+# several threads (e.g. the parts of a multipart upload) add to.
+_lock = threading.Lock()
+
+
+def includeme(config):
+    """Adds :func:`storage_tween_factory`, so each request gets the totals
+    of the storage calls made while handling it."""
+    config.add_tween("pyramid_storage.instrumentation.storage_tween_factory")
+
+
+class Operation(object):
+    """A call to a storage backend, passed to the hooks once it has
+    returned or raised.
+
+    :ivar backend: "local", "s3" or "gcloud"
+    :ivar name: name of the method called, e.g. "save_file"
+    :ivar filename: name of the file the call was about, if any
+    :ivar elapsed: wall-clock duration in seconds
+    :ivar bytes: bytes uploaded by **save_file** and **save_many**, or the
+        size of the file opened by **open**
+    :ivar retries: number of requests the backend had to retry
+    :ivar error: class name of the exception raised, or **None**
+    """
+
+    __slots__ = ("backend", "name", "filename", "elapsed", "bytes", "retries", "error")
+
+    def __init__(self, backend, name, filename=None):
+        self.backend = backend
+        self.name = name
+        self.filename = filename
+        self.elapsed = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+
+
+class StorageTotals(object):
+    """Storage calls made while handling a request, attached to it as
+    **request.storage_totals** by :func:`storage_tween_factory`. Calls
+    running in the background, e.g. the uploads of a write-behind or
+    mirrored storage, are not included.
+
+    :ivar calls: number of calls
+    :ivar elapsed: total duration of the calls in seconds
+    :ivar bytes: total bytes uploaded or opened
+    :ivar retries: total number of retried requests
+    :ivar errors: number of calls that raised
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.elapsed = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.errors = 0
+
+    def add(self, operation):
+        with _lock:
+            self.calls += 1
+            self.elapsed += operation.elapsed
+            self.bytes += operation.bytes
+            self.retries += operation.retries
+            if operation.error is not None:
+                self.errors += 1
+
+
+def instrumented(backend):
+    """Returns a decorator reporting each call of a storage method to the
+    hooks of the storage, its **hooks** attribute, and to the totals of
+    the current request. Calls made while another is in progress, e.g.
+    **exists** within **save_file** or the files of **save_many**, are
+    part of that call and not reported on their own. Without hooks or a
+    request being instrumented the method is called straight away.
+
+    :param backend: name of the backend, e.g. "s3"
+    """
+
+    def decorator(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            totals = _totals.get()
+            if (not self.hooks and totals is None) or _operation.get() is not None:
+                return method(self, *args, **kwargs)
+
+            filename = args[0] if args and isinstance(args[0], str) else None
+            operation = Operation(backend, name, filename)
+            token = _operation.set(operation)
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            except BaseException as e:
+                operation.error = type(e).__name__
+                raise
+            else:
+                if isinstance(result, str):
+                    # The resolved name of a saved, copied or moved file.
+                    operation.filename = result
+                return result
+            finally:
+                operation.elapsed = time.perf_counter() - start
+                _operation.reset(token)
+                _report(self.hooks, totals, operation)
+
+        return wrapper
+
+    return decorator
+
+
+def _report(hooks, totals, operation):
+    if totals is not None:
+        totals.add(operation)
+    for hook in hooks:
+        try:
+            hook(operation)
+        except Exception:
+            log.exception("Storage instrumentation hook %r failed", hook)
+
+
+def add_bytes(count):
+    """Adds count bytes to the call in progress, if it is instrumented.
+
+    :param count: number of bytes uploaded or opened
+    """
+    operation = _operation.get()
+    if operation is not None and count:
+        with _lock:
+            operation.bytes += count
+
+
+def add_retries(count=1):
+    """Adds count retried requests to the call in progress, if it is
+    instrumented.
+
+    :param count: number of retried requests
+    """
+    operation = _operation.get()
+    if operation is not None and count:
+        with _lock:
+            operation.retries += count
+
+
+class LoggingHook(object):
+    """Logs a line for each storage call.
+
+    :param logger: **logging.Logger**, "pyramid_storage.instrumentation"
+        if not given
+    :param level: logging level of the lines
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or log
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        self.level = level
+
+    def __call__(self, operation):
+        self.logger.log(
+            self.level,
+            "%s.%s %s %.1fms bytes=%d retries=%d error=%s",
+            operation.backend,
+            operation.name,
+            operation.filename or "-",
+            operation.elapsed * 1000,
+            operation.bytes,
+            operation.retries,
+            operation.error or "-",
+        )
+
+
+class StatsdHook(object):
+    """Sends the metrics of each storage call to a statsd server, in a
+    single UDP datagram:
+
+    - **<prefix>.<backend>.<name>.time**: duration in milliseconds
+    - **<prefix>.<backend>.<name>.bytes**: bytes uploaded or opened
+    - **<prefix>.<backend>.<name>.retries**: retried requests
+    - **<prefix>.<backend>.<name>.errors.<error>**: calls that raised
+
+    Metrics that could not be sent are dropped.
+
+    :param host: host of the statsd server
+    :param port: port of the statsd server
+    :param prefix: prefix of the metric names
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="pyramid_storage"):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, operation):
+        key = "%s.%s.%s" % (self.prefix, operation.backend, operation.name)
+        lines = ["%s.time:%.3f|ms" % (key, operation.elapsed * 1000)]
+        if operation.bytes:
+            lines.append("%s.bytes:%d|c" % (key, operation.bytes))
+        if operation.retries:
+            lines.append("%s.retries:%d|c" % (key, operation.retries))
+        if operation.error:
+            lines.append("%s.errors.%s:1|c" % (key, operation.error))
+        try:
+            self._socket.sendto("\n".join(lines).encode("ascii"), self.address)
+        except OSError:
+            pass
+
+
+# Prometheus metrics by (registry, namespace), as a metric can only be
+# registered once however many storages report to it.
+_prometheus_metrics = {}
+
+
+class PrometheusHook(object):
+    """Records the metrics of each storage call with **prometheus_client**,
+    labelled by backend and operation:
+
+    - **<namespace>_operation_duration_seconds**: histogram of durations
+    - **<namespace>_bytes_total**: bytes uploaded or opened
+    - **<namespace>_retries_total**: retried requests
+    - **<namespace>_errors_total**: calls that raised, also labelled by
+      error
+
+    :param namespace: prefix of the metric names
+    :param registry: **CollectorRegistry**, the default one if not given
+    """
+
+    def __init__(self, namespace="pyramid_storage", registry=None):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise RuntimeError("You must have prometheus_client installed to use prometheus")
+
+        registry = registry or prometheus_client.REGISTRY
+        labels = ("backend", "operation")
+        with _lock:
+            key = (id(registry), namespace)
+            if key not in _prometheus_metrics:
+                kwargs = {"namespace": namespace, "registry": registry}
+                _prometheus_metrics[key] = (
+                    prometheus_client.Histogram(
+                        "operation_duration_seconds", "Duration of storage calls", labels, **kwargs
+                    ),
+                    prometheus_client.Counter(
+                        "bytes", "Bytes uploaded or opened by storage calls", labels, **kwargs
+                    ),
+                    prometheus_client.Counter(
+                        "retries", "Requests retried by storage calls", labels, **kwargs
+                    ),
+                    prometheus_client.Counter(
+                        "errors", "Storage calls that raised", labels + ("error",), **kwargs
+                    ),
+                )
+        self.duration, self.bytes, self.retries, self.errors = _prometheus_metrics[key]
+
+    def __call__(self, operation):
+        labels = (operation.backend, operation.name)
+        self.duration.labels(*labels).observe(operation.elapsed)
+        if operation.bytes:
+            self.bytes.labels(*labels).inc(operation.bytes)
+        if operation.retries:
+            self.retries.labels(*labels).inc(operation.retries)
+        if operation.error:
+            self.errors.labels(*labels, operation.error).inc()
+
+
+def hooks_from_settings(settings, prefix):
+    """Returns the list of hooks named by the **instrument.hooks** setting:
+    "logging", "statsd", "prometheus" or the dotted name of any callable
+    taking an :class:`Operation`.
+
+    :param settings: dict(-like) of settings
+    :param prefix: prefix separating these settings
+    """
+    options = (
+        ("instrument.hooks", False, ""),
+        ("instrument.log_level", False, "info"),
+        ("instrument.statsd_host", False, "localhost"),
+        ("instrument.statsd_port", False, 8125),
+        ("instrument.metrics_prefix", False, "pyramid_storage"),
+    )
+    kwargs = utils.read_settings(settings, options, prefix)
+    hooks = []
+    for name in aslist(kwargs["instrument.hooks"]):
+        if name == "logging":
+            hooks.append(LoggingHook(level=kwargs["instrument.log_level"]))
+        elif name == "statsd":
+            hooks.append(
+                StatsdHook(
+                    kwargs["instrument.statsd_host"],
+                    kwargs["instrument.statsd_port"],
+                    kwargs["instrument.metrics_prefix"],
+                )
+            )
+        elif name == "prometheus":
+            hooks.append(PrometheusHook(kwargs["instrument.metrics_prefix"]))
+        else:
+            try:
+                hooks.append(DottedNameResolver().resolve(name))
+            except ImportError:
+                raise ConfigurationError('unknown instrumentation hook "%s"' % name)
+    return hooks
+
+
+def storage_tween_factory(handler, registry, prefix="storage."):
+    """Pyramid tween attaching the :class:`StorageTotals` of the storage
+    calls made while handling each request as **request.storage_totals**.
+    If the **instrument.server_timing** setting is set they are also sent
+    in a **Server-Timing** header, shown by the developer tools of
+    browsers.
+
+    :param prefix: prefix of the settings of the storage, "storage." as
+        used by the **includeme** of the backends
+    """
+    options = (("instrument.server_timing", False, False),)
+    kwargs = utils.read_settings(registry.settings, options, prefix)
+    server_timing = asbool(kwargs["instrument.server_timing"])
+
+    def storage_tween(request):
+        totals = request.storage_totals = StorageTotals()
+        token = _totals.set(totals)
+        try:
+            response = handler(request)
+        finally:
+            _totals.reset(token)
+        if server_timing:
+            response.headers.add(
+                "Server-Timing",
+                'storage;dur=%.1f;desc="%d calls"' % (totals.elapsed * 1000, totals.calls),
+            )
+        return response
+
+    return storage_tween
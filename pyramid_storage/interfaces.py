@@ -5,3 +5,7 @@ from zope.interface import Interface
 
 class IFileStorage(Interface):
     pass
+
+
+class IAsyncFileStorage(Interface):
+    pass
@@ -1,20 +1,56 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import errno
+import hashlib
+import io
+import mmap
 import os
 import shutil
+import stat
+import tempfile
+import threading
+import time
 import urllib
+import uuid
 
+from pyramid.settings import asbool
 from zope.interface import implementer
 
-from . import utils
+from . import instrumentation, utils, validation
 from .exceptions import FileNotAllowed
-from .extensions import resolve_extensions
+from .extensions import get_policy
 from .interfaces import IFileStorage
 from .registry import register_file_storage_impl
 
 
+# Uploads are written to a temporary file named like this, in the same
+# folder, before being renamed into place.
+TEMP_PREFIX = ".pyramid_storage-"
+TEMP_SUFFIX = ".tmp"
+
+# ioctl request cloning a file on copy-on-write filesystems (btrfs, XFS).
+FICLONE = 0x40049409
+
+# Errors meaning a kernel copy is not possible between these two files.
+_NO_KERNEL_COPY = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.ENOTSOCK,
+}
+
+instrumented = instrumentation.instrumented("local")
+
+
 def includeme(config):
-    impl = LocalFileStorage.from_settings(config.registry.settings, prefix="storage.")
+    settings = config.registry.settings
+    impl = LocalFileStorage.from_settings(settings, prefix="storage.")
+
+    if asbool(settings.get("storage.sweep_temp_files", False)):
+        impl.sweep_temp_files()
 
     register_file_storage_impl(config, impl)
 
@@ -27,6 +63,17 @@ class LocalFileStorage(object):
     :param base_path: the absolute base path where uploads are stored
     :param base_url: absolute or relative base URL for uploads
     :param extensions: extensions string
+    :param fsync: flush each upload to disk before it is made visible
+    :param copy_buffer_size: buffer size in bytes when an upload cannot be
+        copied by the kernel
+    :param max_workers: number of threads used by batch operations
+    :param sniff_content: reject uploads whose first bytes do not match
+        their extension
+    :param shard_depth: number of nested shard directories each file is
+        stored under, e.g. 2 for "ab/cd/test.jpg"; 0 stores files flat
+    :param shard_width: number of hex characters in each shard directory
+    :param hooks: callables each passed a
+        :class:`pyramid_storage.instrumentation.Operation` once a call is done
     """
 
     @classmethod
@@ -40,21 +87,54 @@ class LocalFileStorage(object):
             ("base_path", True, None),
             ("base_url", False, ""),
             ("extensions", False, "default"),
+            ("fsync", False, False),
+            ("copy_buffer_size", False, 1024 * 1024),
+            ("max_workers", False, 8),
+            ("sniff_content", False, False),
+            ("shard_depth", False, 0),
+            ("shard_width", False, 2),
         )
         kwargs = utils.read_settings(settings, options, prefix)
+        kwargs["hooks"] = instrumentation.hooks_from_settings(settings, prefix)
         return cls(**kwargs)
 
-    def __init__(self, base_path, base_url="", extensions="default"):
+    # Number of (folder, name) pairs whose last used suffix is remembered.
+    max_cached_counters = 1024
+
+    def __init__(
+        self,
+        base_path,
+        base_url="",
+        extensions="default",
+        fsync=False,
+        copy_buffer_size=1024 * 1024,
+        max_workers=8,
+        sniff_content=False,
+        shard_depth=0,
+        shard_width=2,
+        hooks=None,
+    ):
         self.base_path = base_path
         self.base_url = base_url
-        self.extensions = resolve_extensions(extensions)
+        self.extension_policy = get_policy(extensions)
+        self.extensions = self.extension_policy.extensions
+        self.fsync = asbool(fsync)
+        self.copy_buffer_size = int(copy_buffer_size)
+        self.max_workers = int(max_workers)
+        self.sniff_content = asbool(sniff_content)
+        self.shard_depth = int(shard_depth)
+        self.shard_width = int(shard_width)
+        self.hooks = list(hooks or ())
+
+        self._counters = collections.OrderedDict()
+        self._counters_lock = threading.Lock()
 
     def url(self, filename):
         """Returns entire URL of the filename, joined to the base_url
 
         :param filename: base name of file
         """
-        return urllib.parse.urljoin(self.base_url, filename)
+        return urllib.parse.urljoin(self.base_url, self.sharded_name(filename))
 
     def path(self, filename):
         """Returns absolute file path of the filename, joined to the
@@ -62,8 +142,61 @@ class LocalFileStorage(object):
 
         :param filename: base name of file
         """
-        return os.path.join(self.base_path, filename)
+        return os.path.join(self.base_path, self.sharded_name(filename))
 
+    def sharded_name(self, filename):
+        """Returns the name the file is stored under relative to base_path,
+        with its shard directories inserted before the base name, e.g.
+        "photos/test.jpg" -> "photos/3b/9a/test.jpg". Without sharding the
+        filename is returned unchanged.
+
+        :param filename: base name of file
+        """
+        if not self.shard_depth:
+            return filename
+        folder, _, name = filename.rpartition("/")
+        parts = shard_dirs(name, self.shard_depth, self.shard_width)
+        if folder:
+            parts.insert(0, folder)
+        parts.append(name)
+        return "/".join(parts)
+
+    def _shard_path(self, folder, name):
+        """Returns the path of name in the absolute folder path, creating
+        its shard directories if needed."""
+        if not self.shard_depth:
+            return os.path.join(folder, name)
+        shard = os.path.join(folder, *shard_dirs(name, self.shard_depth, self.shard_width))
+        os.makedirs(shard, exist_ok=True)
+        return os.path.join(shard, name)
+
+    @instrumented
+    def open(self, filename, mode="rb"):
+        """Opens a stored file for reading. The file is memory mapped, so
+        reads need no system calls and only the pages actually read are
+        loaded from disk. Empty files are opened normally, as they cannot
+        be mapped.
+
+        :param filename: base name of file
+        :param mode: only "rb" is supported
+        :returns: seekable file object
+        """
+        if mode != "rb":
+            raise ValueError('only "rb" mode is supported')
+        file = open(self.path(filename), "rb")
+        try:
+            size = os.fstat(file.fileno()).st_size
+            instrumentation.add_bytes(size)
+            if size == 0:
+                return file
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            file.close()
+            raise
+        file.close()
+        return MappedFile(mapping, filename)
+
+    @instrumented
     def delete(self, filename):
         """Deletes the filename. Filename is resolved with the
         absolute path based on base_path. If file does not exist,
@@ -76,6 +209,26 @@ class LocalFileStorage(object):
             return True
         return False
 
+    @instrumented
+    def delete_many(self, filenames):
+        """Deletes several files, in parallel on up to **max_workers**
+        threads. Returns a dict mapping each filename to **True** if it was
+        deleted or **False** if it did not exist.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        results = utils.map_concurrently(self._remove, filenames, self.max_workers)
+        return dict(zip(filenames, results))
+
+    def _remove(self, filename):
+        try:
+            os.remove(self.path(filename))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @instrumented
     def exists(self, filename):
         """Checks if file exists. Resolves filename's absolute
         path based on base_path.
@@ -84,14 +237,162 @@ class LocalFileStorage(object):
         """
         return os.path.exists(self.path(filename))
 
+    @instrumented
+    def exists_many(self, filenames):
+        """Checks if several files exist. Returns a dict mapping each
+        filename to **True** or **False**.
+
+        :param filenames: iterable of base names of files
+        """
+        return dict((filename, self.exists(filename)) for filename in filenames)
+
+    def list(self, prefix="", recursive=True):
+        """Yields a :class:`pyramid_storage.utils.FileInfo` for each stored
+        file whose name starts with prefix, e.g. "photos/". Folders are
+        scanned one at a time with **os.scandir**, so the listing is never
+        held in memory. Temporary files of uploads in progress are skipped,
+        and shard directories are hidden from the names.
+
+        :param prefix: prefix of the names, relative to base_path
+        :param recursive: include files in sub-folders; otherwise only
+            those in the folder of the prefix are listed
+        """
+        for name, entry in self._walk(prefix, recursive, self.shard_depth, self.shard_width):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield utils.FileInfo(
+                name,
+                st.st_size,
+                st.st_mtime,
+                "%x-%x" % (st.st_mtime_ns, st.st_size),
+            )
+
+    def _walk(self, prefix, recursive, depth, width):
+        """Yields the (name, **os.DirEntry**) pairs of the files whose name
+        starts with prefix, for a tree laid out with the given shard depth
+        and width. A file is only listed when it is exactly depth shard
+        directories below a folder and they match its name; other files
+        cannot be found under that layout and are skipped. A folder whose
+        name looks like a shard directory is walked both ways, so e.g. a
+        folder "ab" is not mistaken for the shard of the files in it."""
+        folder = prefix.rpartition("/")[0]
+        # (relative path, folder of the names, shard directories so far)
+        folders = [(folder, folder, [])]
+        while folders:
+            path, folder, shards = folders.pop()
+            try:
+                it = os.scandir(os.path.join(self.base_path, path) if path else self.base_path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            subfolders = []
+            with it:
+                for entry in it:
+                    child = path + "/" + entry.name if path else entry.name
+                    name = folder + "/" + entry.name if folder else entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        if len(shards) < depth and _is_shard(entry.name, width):
+                            subfolders.append((child, folder, shards + [entry.name]))
+                        # Folders are never nested in shard directories.
+                        if (
+                            not shards
+                            and recursive
+                            and (name.startswith(prefix) or prefix.startswith(name + "/"))
+                        ):
+                            subfolders.append((child, name, []))
+                    elif (
+                        name.startswith(prefix)
+                        and not entry.name.startswith(TEMP_PREFIX)
+                        and shards == shard_dirs(entry.name, depth, width)
+                    ):
+                        yield name, entry
+            folders.extend(reversed(subfolders))
+
+    def list_many(self, prefixes, **kwargs):
+        """Yields the files listed by :meth:`list` for each prefix, listing
+        the prefixes in parallel on up to **max_workers** threads, in no
+        particular order.
+
+        :param prefixes: iterable of prefixes that do not overlap
+        :param kwargs: keyword arguments for :meth:`list`
+        """
+        return utils.list_concurrently(self, prefixes, self.max_workers, **kwargs)
+
+    @instrumented
+    def copy(self, src, dst):
+        """Copies a stored file to another name, replacing dst if it
+        exists. The copy is made by the kernel, as a reflink where the
+        filesystem supports it, into a temporary file renamed into place.
+        Returns dst.
+
+        :param src: base name of the file to copy
+        :param dst: base name of the copy
+        :raises FileNotFoundError: if src does not exist
+        """
+        path = self.path(dst)
+        folder = os.path.dirname(path)
+        with open(self.path(src), "rb") as file:
+            os.makedirs(folder, exist_ok=True)
+            temp_path = os.path.join(folder, TEMP_PREFIX + uuid.uuid4().hex + TEMP_SUFFIX)
+            try:
+                with open(temp_path, "xb") as dest:
+                    _copy_file(file, dest, self.copy_buffer_size)
+                    if self.fsync:
+                        dest.flush()
+                        os.fsync(dest.fileno())
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        if self.fsync:
+            _fsync_dir(folder)
+        return dst
+
+    @instrumented
+    def move(self, src, dst):
+        """Renames a stored file, replacing dst if it exists. Returns dst.
+
+        :param src: base name of the file to move
+        :param dst: new base name of the file
+        :raises FileNotFoundError: if src does not exist
+        """
+        path = self.path(dst)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+        os.replace(self.path(src), path)
+        if self.fsync:
+            _fsync_dir(folder)
+        return dst
+
+    @instrumented
+    def copy_many(self, pairs):
+        """Copies several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was copied or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        """
+        return utils.transfer_many(self.copy, pairs, self.max_workers)
+
+    @instrumented
+    def move_many(self, pairs):
+        """Moves several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was moved or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        """
+        return utils.transfer_many(self.move, pairs, self.max_workers)
+
     def filename_allowed(self, filename, extensions=None):
         """Checks if a filename has an allowed extension
 
         :param filename: base name of file
         :param extensions: iterable of extensions (or self.extensions)
         """
-        _, ext = os.path.splitext(filename)
-        return self.extension_allowed(ext, extensions)
+        return get_policy(extensions, self.extension_policy).filename_allowed(filename)
 
     def file_allowed(self, fs, extensions=None):
         """Checks if a file can be saved, based on extensions
@@ -107,16 +408,7 @@ class LocalFileStorage(object):
 
         :param extensions: iterable of extensions (or self.extensions)
         """
-
-        if isinstance(extensions, tuple) and not extensions:
-            return True
-
-        extensions = extensions or self.extensions
-        if not extensions:
-            return True
-        if ext.startswith("."):
-            ext = ext[1:]
-        return ext.lower() in extensions
+        return get_policy(extensions, self.extension_policy).extension_allowed(ext)
 
     def save(self, fs, *args, **kwargs):
         """Saves contents of a **cgi.FieldStorage** object to the file system.
@@ -149,28 +441,61 @@ class LocalFileStorage(object):
         :returns: modified filename
         """
 
-        return self.save_file(open(filename, "rb"), filename, *args, **kwargs)
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    @instrumented
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads.
+        Errors are collected per item rather than aborting the batch.
 
-    def save_file(self, file, filename, folder=None, randomize=False, extensions=None, **kwargs):
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.max_workers)
+
+    @instrumented
+    def save_file(
+        self,
+        file,
+        filename,
+        folder=None,
+        randomize=False,
+        extensions=None,
+        content_addressed=False,
+        _reserved=False,
+        **kwargs,
+    ):
         """Saves a file object to the uploads location.
         Returns the resolved filename, i.e. the folder +
         the (randomized/incremented) base name.
 
+        The contents are written to a temporary file in the target folder
+        which is then renamed into place, so a partially written upload is
+        never visible under its final name. If the file object is backed by
+        a regular file the copy is done by the kernel (as a reflink where the
+        filesystem supports it) rather than through Python.
+
         :param fs: **cgi.FieldStorage** object (or similar)
         :param filename: original filename
         :param folder: relative path of sub-folder
         :param randomize: randomize the filename
         :param extensions: iterable of allowed extensions, if not default
+        :param content_addressed: name the file after the SHA-256 digest of
+            its contents, computed while it is copied, keeping the existing
+            file if there is one
         :returns: modified filename
         """
 
-        # In case extensions is an empty tuple we want to keep it empty.
-        if not isinstance(extensions, tuple):
-            extensions = extensions or self.extensions
-
         if not self.filename_allowed(filename, extensions):
             raise FileNotAllowed()
 
+        if self.sniff_content:
+            policy = get_policy(extensions, self.extension_policy)
+            file = validation.sniff(file, filename, policy.extensions)
+
         filename = utils.secure_filename(os.path.basename(filename))
 
         if folder:
@@ -184,32 +509,378 @@ class LocalFileStorage(object):
         if randomize:
             filename = utils.random_filename(filename)
 
-        filename, path = self.resolve_name(filename, dest_folder)
-
         file.seek(0)
 
-        with open(path, "wb") as dest:
-            shutil.copyfileobj(file, dest)
+        # Unlike tempfile.mkstemp this honours the umask, as open() would.
+        temp_path = os.path.join(dest_folder, TEMP_PREFIX + uuid.uuid4().hex + TEMP_SUFFIX)
+        flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+        fd = os.open(temp_path, flags, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as dest:
+                if content_addressed:
+                    sha256, _ = utils.hash_file(file, dest, self.copy_buffer_size)
+                else:
+                    _copy_file(file, dest, self.copy_buffer_size)
+                # A kernel copy does not move the position of dest.
+                instrumentation.add_bytes(dest.seek(0, os.SEEK_END))
+                if self.fsync:
+                    dest.flush()
+                    os.fsync(dest.fileno())
+
+            if content_addressed:
+                filename = utils.content_filename(filename, sha256.hexdigest())
+                path = self._shard_path(dest_folder, filename)
+                if os.path.exists(path):
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, path)
+            elif _reserved:
+                # Written into a name given by reserve_filename().
+                path = self._shard_path(dest_folder, filename)
+                os.replace(temp_path, path)
+            else:
+                filename, path = self.resolve_name(filename, dest_folder)
+                os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        if self.fsync:
+            _fsync_dir(os.path.dirname(path))
 
         if folder:
             filename = os.path.join(folder, filename)
 
         return filename
 
+    def reserve_filename(self, filename, folder=None, randomize=False, extensions=None):
+        """Resolves the name :meth:`save_file` would store a file under and
+        reserves it with an empty file, so that wrappers such as
+        :class:`pyramid_storage.transactional.TransactionalFileStorage` can
+        write the file into it later. An unused name should be given back
+        with :meth:`release_filename`.
+
+        :param filename: original filename
+        :param folder: relative path of sub-folder
+        :param randomize: randomize the filename
+        :param extensions: iterable of allowed extensions, if not default
+        :returns: modified filename
+        """
+        if not self.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        filename = utils.secure_filename(os.path.basename(filename))
+
+        if folder:
+            dest_folder = os.path.join(self.base_path, folder)
+        else:
+            dest_folder = self.base_path
+
+        os.makedirs(dest_folder, exist_ok=True)
+
+        if randomize:
+            filename = utils.random_filename(filename)
+
+        filename, _ = self.resolve_name(filename, dest_folder)
+
+        if folder:
+            filename = os.path.join(folder, filename)
+
+        return filename
+
+    def release_filename(self, filename):
+        """Removes the empty file reserving a name returned by
+        :meth:`reserve_filename`. Nothing is removed once the file has
+        been written.
+
+        :param filename: name returned by :meth:`reserve_filename`
+        """
+        path = self.path(filename)
+        try:
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def sweep_temp_files(self, max_age=3600):
+        """Removes temporary files left behind under base_path by uploads
+        that never completed, e.g. because the worker crashed. Returns the
+        number of files removed.
+
+        :param max_age: only remove files older than this many seconds
+        """
+        removed = 0
+        cutoff = time.time() - max_age
+        for dirpath, _, filenames in os.walk(self.base_path):
+            for name in filenames:
+                if not (name.startswith(TEMP_PREFIX) and name.endswith(TEMP_SUFFIX)):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def reshard(self, from_depth=0, from_width=2):
+        """Moves every stored file from the shard layout given by from_depth
+        and from_width to the layout of this storage, e.g. to shard a tree
+        of files stored flat, in place. Empty shard directories of the old
+        layout are removed. Returns the number of files moved.
+
+        Files are renamed, so no data is copied, but uploads should be
+        stopped while this runs.
+
+        :param from_depth: shard_depth of the existing tree
+        :param from_width: shard_width of the existing tree
+        """
+        from_depth = int(from_depth)
+        from_width = int(from_width)
+        # The new shard directories are created inside the folders being
+        # scanned, so the names are all read before anything is moved.
+        files = [
+            (name, entry.path) for name, entry in self._walk("", True, from_depth, from_width)
+        ]
+        moved = 0
+        for name, old_path in files:
+            folder, _, basename = name.rpartition("/")
+            dest_folder = os.path.join(self.base_path, folder) if folder else self.base_path
+            path = self._shard_path(dest_folder, basename)
+            if os.path.abspath(path) == os.path.abspath(old_path):
+                continue
+            os.replace(old_path, path)
+            moved += 1
+            shard = os.path.dirname(old_path)
+            for _ in range(from_depth):
+                try:
+                    os.rmdir(shard)
+                except OSError:
+                    break
+                shard = os.path.dirname(shard)
+        return moved
+
     def resolve_name(self, name, folder):
         """Resolves a unique name and the correct path. If a filename
         for that path already exists then a numeric prefix will be
         added, for example test.jpg -> test-1.jpg etc.
 
+        The name is reserved by atomically creating an empty file at the
+        returned path, so concurrent callers never get the same name.
+        The last suffix used for each name is remembered. Otherwise the
+        highest suffix in use is found with a doubling then binary search,
+        taking a number of lookups logarithmic in the number of duplicates
+        rather than one per duplicate or a scan of the whole folder.
+
         :param name: base name of file
         :param folder: absolute folder path
         """
 
         basename, ext = os.path.splitext(name)
-        counter = 0
+        key = (folder, name)
+
+        with self._counters_lock:
+            counter = self._counters.get(key)
+
         while True:
-            path = os.path.join(folder, name)
-            if not os.path.exists(path):
-                return name, path
-            counter += 1
+            if counter is None:
+                candidate = name
+            else:
+                candidate = "%s-%d%s" % (basename, counter, ext)
+            path = self._shard_path(folder, candidate)
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+            except FileExistsError:
+                if counter is None:
+                    counter = self._search_last_counter(basename, ext, folder) + 1
+                else:
+                    counter += 1
+                continue
+            os.close(fd)
+            break
+
+        if counter is not None:
+            with self._counters_lock:
+                if counter > self._counters.get(key, 0):
+                    self._counters[key] = counter
+                self._counters.move_to_end(key)
+                while len(self._counters) > self.max_cached_counters:
+                    self._counters.popitem(last=False)
+
+        return candidate, path
+
+    def _search_last_counter(self, basename, ext, folder):
+        """Returns the highest numeric suffix in use for a name in the
+        folder, or 0 if there is none, assuming suffixes are used from 1 up.
+        A suffix freed by a deletion may be found instead, which is then
+        reused."""
+
+        def used(counter):
             name = "%s-%d%s" % (basename, counter, ext)
+            shards = shard_dirs(name, self.shard_depth, self.shard_width)
+            return os.path.lexists(os.path.join(folder, *shards, name))
+
+        low, high = 0, 1
+        while used(high):
+            low, high = high, high * 2
+        # low is in use (or 0) and high is not.
+        while high - low > 1:
+            middle = (low + high) // 2
+            if used(middle):
+                low = middle
+            else:
+                high = middle
+        return low
+
+
+def shard_dirs(name, depth, width=2):
+    """Returns the list of shard directories a file is stored under: depth
+    slices of width characters of the MD5 hex digest of its base name.
+
+    :param name: base name of file
+    :param depth: number of shard directories
+    :param width: number of characters in each directory name
+    """
+    if not depth:
+        return []
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    return [digest[i * width : (i + 1) * width] for i in range(depth)]
+
+
+def _is_shard(name, width):
+    return len(name) == width and all(c in "0123456789abcdef" for c in name)
+
+
+def _fsync_dir(path):
+    """Flushes a directory entry to disk, so a rename into it is durable."""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only file object over a memory mapping, returned by
+    :meth:`LocalFileStorage.open`.
+
+    :param mapping: **mmap.mmap** instance, closed with this object
+    :param name: name of the mapped file
+    """
+
+    def __init__(self, mapping, name=None):
+        self.mapping = mapping
+        self.name = name
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.mapping)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        data = self.mapping[self.position : self.position + len(buffer)]
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def readall(self):
+        data = self.mapping[self.position :]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.mapping.close()
+        super().close()
+
+
+def _copy_file(src, dest, buffer_size):
+    """Copies the contents of the src file object, from its current
+    position, to the empty dest file object. When src is a regular file
+    the kernel does the copy: by cloning the file where the filesystem
+    supports it, otherwise with copy_file_range() or sendfile(). Anything
+    else is copied through a buffer of buffer_size bytes.
+    """
+    if isinstance(src, tempfile.SpooledTemporaryFile) and not src._rolled:
+        # Asking for its file descriptor would write it to disk first.
+        shutil.copyfileobj(src, dest, buffer_size)
+        return
+
+    try:
+        src_fd = src.fileno()
+        dest_fd = dest.fileno()
+        offset = src.tell()
+    except (AttributeError, OSError, ValueError):
+        src_fd = None
+
+    if isinstance(src_fd, int) and isinstance(offset, int):
+        st = os.fstat(src_fd)
+        if stat.S_ISREG(st.st_mode) and _kernel_copy(src_fd, dest_fd, offset, st.st_size):
+            src.seek(st.st_size)
+            return
+
+    shutil.copyfileobj(src, dest, buffer_size)
+
+
+def _kernel_copy(src_fd, dest_fd, offset, size):
+    """Returns **False** if the kernel cannot copy between the two files,
+    in which case nothing has been written."""
+    if offset == 0 and _clone(src_fd, dest_fd):
+        return True
+
+    copies = []
+    if hasattr(os, "copy_file_range"):
+        copies.append(os.copy_file_range)
+    if hasattr(os, "sendfile"):
+        copies.append(_sendfile)
+
+    for copy in copies:
+        copied = 0
+        try:
+            while copied < size - offset:
+                sent = copy(src_fd, dest_fd, size - offset - copied, offset + copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError as e:
+            if copied or e.errno not in _NO_KERNEL_COPY:
+                raise
+            continue
+        return True
+    return False
+
+
+def _clone(src_fd, dest_fd):
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except OSError:
+        return False
+    return True
+
+
+def _sendfile(src_fd, dest_fd, count, offset):
+    # Same argument order as os.copy_file_range().
+    return os.sendfile(dest_fd, src_fd, offset, count)
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import mmap
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import implementer
+
+from . import utils
+from .exceptions import FileNotAllowed
+from .interfaces import IFileStorage
+from .local import MappedFile
+from .registry import register_file_storage_impl, storage_from_settings
+
+
+log = logging.getLogger(__name__)
+
+
+def includeme(config):
+    impl = MirroredFileStorage.from_settings(config.registry.settings, prefix="storage.")
+
+    register_file_storage_impl(config, impl)
+
+
+@implementer(IFileStorage)
+class MirroredFileStorage(object):
+    """Writes every file to several storages at once, e.g. an S3 bucket and
+    a Google Cloud mirror in another region.
+
+    Saves, deletes, copies and moves are sent to all the storages in
+    parallel and return as soon as **quorum** of them have succeeded. The
+    other writes go on in the background, each retried up to **retries**
+    times; one that still fails is logged. If fewer than **quorum**
+    storages succeed, the first error is raised, but the writes that did
+    succeed are not undone.
+
+    Reads (exists, open, list) go to the storage that has answered fastest
+    so far, skipping storages that failed in the last **cooldown** seconds
+    and those still writing the file in the background. Names are resolved
+    by the first storage, the primary, which also provides url and
+    all other attributes.
+
+    :param storages: list of **IFileStorage** instances, primary first
+    :param quorum: number of storages a write must succeed on
+    :param max_workers: number of threads writing to the storages
+    :param retries: number of times a failed background write is retried
+    :param cooldown: seconds a storage is not read from after a failure
+    """
+
+    @classmethod
+    def from_settings(cls, settings, prefix):
+        """Returns a new instance from config settings. Each storage named
+        in **mirror.backends** is configured by the settings under
+        **mirror.<name>.**, e.g. **mirror.primary.backend = s3** and
+        **mirror.primary.aws.bucket_name**.
+
+        :param settings: dict(-like) of settings
+        :param prefix: prefix separating these settings
+        """
+        options = (
+            ("mirror.backends", True, None),
+            ("mirror.quorum", False, 1),
+            ("mirror.max_workers", False, 8),
+            ("mirror.retries", False, 3),
+            ("mirror.cooldown", False, 30),
+        )
+        kwargs = utils.read_settings(settings, options, prefix)
+        storages = []
+        for name in kwargs.pop("mirror.backends").split():
+            backend_prefix = "%smirror.%s." % (prefix, name)
+            backend = utils.read_settings(settings, (("backend", True, None),), backend_prefix)
+            storages.append(storage_from_settings(backend["backend"], settings, backend_prefix))
+        kwargs = dict((k.replace("mirror.", ""), v) for k, v in kwargs.items())
+        return cls(storages, **kwargs)
+
+    def __init__(self, storages, quorum=1, max_workers=8, retries=3, cooldown=30):
+        self.storages = list(storages)
+        if not self.storages:
+            raise ConfigurationError("at least one storage is required")
+        self.quorum = int(quorum)
+        if not 1 <= self.quorum <= len(self.storages):
+            raise ConfigurationError(
+                "quorum must be between 1 and the number of storages (%d)" % len(self.storages)
+            )
+        self.max_workers = int(max_workers)
+        self.retries = int(retries)
+        self.cooldown = float(cooldown)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="pyramid_storage-mirror"
+        )
+        self._lock = threading.Lock()
+        # Per storage: moving average of call durations, time until which it
+        # is not read from, and names still being written in the background.
+        self._latency = [0.0] * len(self.storages)
+        self._down_until = [0.0] * len(self.storages)
+        self._pending = [dict() for _ in self.storages]
+        self._futures = set()
+
+    @property
+    def primary(self):
+        return self.storages[0]
+
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def url(self, filename):
+        """Returns entire URL of the filename in the primary storage
+
+        :param filename: base name of file
+        """
+        return self.primary.url(filename)
+
+    def exists(self, filename, *args, **kwargs):
+        """Checks if file exists, in the fastest healthy storage.
+
+        :param filename: base name of file
+        """
+        return self._read(filename, lambda storage: storage.exists(filename, *args, **kwargs))
+
+    def exists_many(self, filenames, *args, **kwargs):
+        """Checks if several files exist, in the fastest healthy storage.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        return self._read(
+            filenames, lambda storage: storage.exists_many(filenames, *args, **kwargs)
+        )
+
+    def open(self, filename, *args, **kwargs):
+        """Opens a stored file from the fastest healthy storage. If the file
+        is missing there, the other storages are tried before raising
+        **FileNotFoundError**.
+
+        :param filename: base name of file
+        """
+        return self._read(
+            filename,
+            lambda storage: storage.open(filename, *args, **kwargs),
+            missing=FileNotFoundError,
+        )
+
+    def list(self, *args, **kwargs):
+        """Lists files of the fastest healthy storage. Takes the same
+        arguments as its **list**."""
+        return self._read(None, lambda storage: storage.list(*args, **kwargs))
+
+    def delete(self, filename, *args, **kwargs):
+        """Deletes the filename from all the storages.
+
+        :param filename: base name of file
+        """
+        return self._write([filename], lambda storage: storage.delete(filename, *args, **kwargs))
+
+    def delete_many(self, filenames, *args, **kwargs):
+        """Deletes several files from all the storages. Returns the result
+        of the first storage to finish.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        return self._write(
+            filenames, lambda storage: storage.delete_many(filenames, *args, **kwargs)
+        )
+
+    def copy(self, src, dst, *args, **kwargs):
+        """Copies a stored file in all the storages. Returns dst."""
+        return self._write([dst], lambda storage: storage.copy(src, dst, *args, **kwargs))
+
+    def move(self, src, dst, *args, **kwargs):
+        """Moves a stored file in all the storages. Returns dst."""
+        return self._write([src, dst], lambda storage: storage.move(src, dst, *args, **kwargs))
+
+    def copy_many(self, pairs, *args, **kwargs):
+        """Copies several files in all the storages. Returns the result of
+        the first storage to finish."""
+        pairs = list(pairs)
+        return self._write(
+            [dst for _, dst in pairs], lambda storage: storage.copy_many(pairs, *args, **kwargs)
+        )
+
+    def move_many(self, pairs, *args, **kwargs):
+        """Moves several files in all the storages. Returns the result of
+        the first storage to finish."""
+        pairs = list(pairs)
+        names = [name for pair in pairs for name in pair]
+        return self._write(names, lambda storage: storage.move_many(pairs, *args, **kwargs))
+
+    def save(self, fs, *args, **kwargs):
+        """Saves contents of a **cgi.FieldStorage** object. Takes the same
+        arguments as :meth:`save_file`.
+
+        :returns: modified filename
+        """
+        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+
+    def save_filename(self, filename, *args, **kwargs):
+        """Saves a filename in local filesystem. Takes the same arguments as
+        :meth:`save_file`.
+
+        :returns: modified filename
+        """
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads.
+
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.max_workers)
+
+    def save_file(
+        self,
+        file,
+        filename,
+        folder=None,
+        randomize=False,
+        extensions=None,
+        content_addressed=False,
+        replace=False,
+        **kwargs,
+    ):
+        """Saves a file object to all the storages. The name is resolved by
+        the primary storage. A regular file is memory mapped, and an
+        in-memory one shared, so each storage reads it on its own; anything
+        else, e.g. a stream, is first copied to a temporary file. Takes the
+        arguments of the storages' **save_file**.
+
+        :returns: modified filename
+        """
+        if not self.primary.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        readers = _share(file, len(self.storages))
+        temp_path = None
+
+        def cleanup():
+            if temp_path is not None:
+                os.remove(temp_path)
+            else:
+                for reader in readers:
+                    reader.close()
+
+        try:
+            if readers is None:
+                fd, temp_path = tempfile.mkstemp(prefix="pyramid_storage-")
+                with os.fdopen(fd, "wb") as temp:
+                    file.seek(0)
+                    if content_addressed:
+                        sha256, _ = utils.hash_file(file, temp)
+                    else:
+                        shutil.copyfileobj(file, temp)
+            elif content_addressed:
+                sha256, _ = utils.hash_file(readers[0])
+
+            options = dict(kwargs, extensions=extensions)
+            if content_addressed:
+                options.update(folder=folder, content_addressed=True)
+                name = utils.content_filename(
+                    utils.secure_filename(os.path.basename(filename)), sha256.hexdigest()
+                )
+                if folder:
+                    name = folder + "/" + name
+            else:
+                if replace:
+                    name = utils.resolve_filename(filename, folder, randomize)
+                else:
+                    name = self.primary.reserve_filename(filename, folder, randomize, extensions)
+                folder, _, filename = name.rpartition("/")
+                options.update(folder=folder or None, replace=replace, _reserved=True)
+        except BaseException:
+            cleanup()
+            raise
+
+        def save(storage):
+            if temp_path is None:
+                reader = readers[self.storages.index(storage)]
+                reader.seek(0)
+                return storage.save_file(reader, filename, **options)
+            with open(temp_path, "rb") as temp:
+                return storage.save_file(temp, filename, **options)
+
+        try:
+            self._write([name], save, cleanup=cleanup)
+        except BaseException:
+            if not (content_addressed or replace):
+                self.primary.release_filename(name)
+            raise
+        return name
+
+    def flush(self, timeout=None):
+        """Waits for the writes still running in the background. Returns
+        **True** if they all finished within timeout seconds.
+
+        :param timeout: maximum number of seconds to wait
+        """
+        with self._lock:
+            futures = list(self._futures)
+        _, not_done = wait(futures, timeout=timeout)
+        return not not_done
+
+    def close(self):
+        """Waits for the writes still running in the background and shuts
+        down the thread pool."""
+        self._executor.shutdown()
+
+    def _order(self):
+        """Returns the indexes of the storages, fastest healthy ones
+        first."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                range(len(self.storages)),
+                key=lambda i: (self._down_until[i] > now, self._latency[i]),
+            )
+
+    def _record(self, index, started, ok):
+        elapsed = time.monotonic() - started
+        with self._lock:
+            if ok:
+                latency = self._latency[index]
+                self._latency[index] = elapsed if not latency else latency * 0.8 + elapsed * 0.2
+            else:
+                self._down_until[index] = time.monotonic() + self.cooldown
+
+    def _is_pending(self, index, names):
+        if names is None:
+            return False
+        if isinstance(names, str):
+            names = [names]
+        with self._lock:
+            return any(name in self._pending[index] for name in names)
+
+    def _read(self, names, func, missing=None):
+        """Calls func with each storage in turn, fastest first, until one
+        succeeds. Storages still writing one of the names are tried last."""
+        order = self._order()
+        order.sort(key=lambda i: self._is_pending(i, names))
+        error = None
+        for index in order:
+            started = time.monotonic()
+            try:
+                result = func(self.storages[index])
+            except Exception as e:
+                if missing is None or not isinstance(e, missing):
+                    self._record(index, started, False)
+                    log.warning("Read from storage %d failed", index, exc_info=True)
+                if error is None or (missing is not None and isinstance(error, missing)):
+                    error = e
+                continue
+            self._record(index, started, True)
+            return result
+        raise error
+
+    def _write(self, names, func, cleanup=None):
+        """Calls func with every storage on the thread pool and returns the
+        first result once **quorum** calls have succeeded. Raises the first
+        error if that is no longer possible."""
+        futures = {}
+        remaining = [len(self.storages)]
+
+        def done(index, future):
+            with self._lock:
+                for name in names:
+                    count = self._pending[index].pop(name, 1) - 1
+                    if count:
+                        self._pending[index][name] = count
+                self._futures.discard(future)
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last and cleanup is not None:
+                cleanup()
+
+        with self._lock:
+            for index in range(len(self.storages)):
+                for name in names:
+                    self._pending[index][name] = self._pending[index].get(name, 0) + 1
+        for index in range(len(self.storages)):
+            try:
+                future = self._executor.submit(self._call, index, func)
+            except RuntimeError as e:
+                # The pool is shut down: the write fails like any other, so
+                # its names are no longer pending.
+                future = Future()
+                future.set_exception(e)
+            with self._lock:
+                self._futures.add(future)
+            futures[future] = index
+            future.add_done_callback(lambda f, index=index: done(index, f))
+
+        results = []
+        errors = []
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                if future.exception() is None:
+                    results.append(future.result())
+                else:
+                    errors.append(future.exception())
+            if len(results) >= self.quorum:
+                return results[0]
+            if len(errors) > len(self.storages) - self.quorum:
+                raise errors[0]
+
+    def _call(self, index, func):
+        """Calls func with a storage, retrying up to **retries** times."""
+        storage = self.storages[index]
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                result = func(storage)
+            except (FileNotAllowed, FileNotFoundError):
+                raise
+            except Exception:
+                self._record(index, started, False)
+                attempt += 1
+                if attempt > self.retries:
+                    log.exception("Write to storage %d failed", index)
+                    raise
+                time.sleep(0.1 * 2**attempt)
+                continue
+            self._record(index, started, True)
+            return result
+
+
+def _share(file, count):
+    """Returns count readers of the contents of a file, each with its own
+    position and still readable once the caller has closed the file, or
+    **None** if the file cannot be shared and has to be copied."""
+    if isinstance(file, io.BytesIO) or (
+        isinstance(file, tempfile.SpooledTemporaryFile) and not file._rolled
+    ):
+        # Kept in memory: copies of bytes share the same buffer.
+        file.seek(0)
+        data = file.read()
+        return [io.BytesIO(data) for _ in range(count)]
+
+    try:
+        fd = file.fileno()
+        # Data written through the file object may still be in its buffer.
+        file.flush()
+        st = os.fstat(fd)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    if not st.st_size:
+        return [io.BytesIO() for _ in range(count)]
+    try:
+        mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    except OSError:
+        # e.g. a file opened for writing only.
+        return None
+    return [MappedFile(mapping)] + [
+        MappedFile(mmap.mmap(fd, 0, access=mmap.ACCESS_READ)) for _ in range(count - 1)
+    ]
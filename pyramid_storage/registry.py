@@ -1,10 +1,47 @@
-from .interfaces import IFileStorage
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+
+from .cache import CachedFileStorage, cache_from_settings
+from .interfaces import IAsyncFileStorage, IFileStorage
 
 
 def register_file_storage_impl(config, impl):
+    settings = config.registry.settings
+    if IAsyncFileStorage.providedBy(impl):
+        config.registry.registerUtility(impl, IAsyncFileStorage)
+        name = settings.get("storage.async_name", "async_storage")
+        config.add_request_method(get_async_file_storage_impl, name, True)
+        return
+    cache = cache_from_settings(settings, "storage.")
+    if cache is not None:
+        impl = CachedFileStorage(impl, cache)
     config.registry.registerUtility(impl, IFileStorage)
-    name = config.registry.settings.get("storage.name", "storage")
-    config.add_request_method(get_file_storage_impl, name, True)
+    name = settings.get("storage.name", "storage")
+    if asbool(settings.get("storage.transactional", False)):
+        from .transactional import get_transactional_file_storage_impl
+
+        config.add_request_method(get_transactional_file_storage_impl, name, True)
+    else:
+        config.add_request_method(get_file_storage_impl, name, True)
+
+
+def storage_from_settings(backend, settings, prefix):
+    """Returns a new **IFileStorage** instance of the named backend,
+    configured by the settings under prefix.
+
+    :param backend: "local", "s3" or "gcloud"
+    :param settings: dict(-like) of settings
+    :param prefix: prefix separating the settings of the backend
+    """
+    if backend == "local":
+        from .local import LocalFileStorage as cls
+    elif backend == "s3":
+        from .s3 import S3FileStorage as cls
+    elif backend == "gcloud":
+        from .gcloud import GoogleCloudStorage as cls
+    else:
+        raise ConfigurationError('unknown storage backend "%s"' % backend)
+    return cls.from_settings(settings, prefix)
 
 
 def get_file_storage_impl(request):
@@ -17,3 +54,15 @@ def get_file_storage_impl(request):
     if registry is None:
         registry = request
     return registry.getUtility(IFileStorage)
+
+
+def get_async_file_storage_impl(request):
+    """
+    Retrieves correct **IAsyncFileStorage** instance from the registry.
+
+    :param request: Pyramid Request instance
+    """
+    registry = getattr(request, "registry", None)
+    if registry is None:
+        registry = request
+    return registry.getUtility(IAsyncFileStorage)
@@ -1,19 +1,43 @@
 # -*- coding: utf-8 -*-
 
+import io
 import mimetypes
 import os
+import threading
+import time
 import urllib
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from pyramid.settings import asbool
 from zope.interface import implementer
 
-from . import utils
+from . import instrumentation, utils, validation
 from .exceptions import FileNotAllowed
-from .extensions import resolve_extensions
+from .extensions import get_policy
 from .interfaces import IFileStorage
 from .registry import register_file_storage_impl
 
 
+MB = 1024 * 1024
+
+# S3 rejects parts smaller than this, except for the last one.
+MIN_PART_SIZE = 5 * MB
+
+# Maximum number of keys in a single DeleteObjects request.
+MAX_DELETE_KEYS = 1000
+
+# Largest object CopyObject can copy; larger ones are copied in parts.
+MAX_COPY_SIZE = 5 * 1024 * MB
+
+# Parts of a server-side copy are not buffered by us, so they can be large.
+COPY_PART_SIZE = 512 * MB
+
+# Maximum number of parts in a multipart upload.
+MAX_PARTS = 10000
+
+instrumented = instrumentation.instrumented("s3")
+
+
 def includeme(config):
     impl = S3FileStorage.from_settings(config.registry.settings, prefix="storage.")
 
@@ -29,6 +53,8 @@ class S3FileStorage(object):
             ("aws.acl", False, "public-read"),
             ("base_url", False, ""),
             ("extensions", False, "default"),
+            ("max_workers", False, 8),
+            ("sniff_content", False, False),
             # S3 Connection options.
             ("aws.access_key", False, None),
             ("aws.secret_key", False, None),
@@ -39,22 +65,71 @@ class S3FileStorage(object):
             ("aws.region", False, None),
             ("aws.num_retries", False, 1),
             ("aws.timeout", False, 5),
+            ("aws.max_pool_connections", False, 10),
+            # Multipart upload options.
+            ("aws.multipart_threshold", False, 8 * MB),
+            ("aws.multipart_chunksize", False, 8 * MB),
+            ("aws.max_concurrency", False, 4),
+            ("aws.part_retries", False, 3),
+            ("aws.read_buffer_size", False, MB),
         )
         kwargs = utils.read_settings(settings, options, prefix)
         kwargs = dict([(k.replace("aws.", ""), v) for k, v in kwargs.items()])
         kwargs["aws_access_key_id"] = kwargs.pop("access_key")
         kwargs["aws_secret_access_key"] = kwargs.pop("secret_key")
+        kwargs["hooks"] = instrumentation.hooks_from_settings(settings, prefix)
         return cls(**kwargs)
 
-    def __init__(self, bucket_name, acl=None, base_url="", extensions="default", **conn_options):
+    def __init__(
+        self,
+        bucket_name,
+        acl=None,
+        base_url="",
+        extensions="default",
+        multipart_threshold=8 * MB,
+        multipart_chunksize=8 * MB,
+        max_concurrency=4,
+        part_retries=3,
+        read_buffer_size=MB,
+        max_workers=8,
+        sniff_content=False,
+        hooks=None,
+        **conn_options,
+    ):
         self.bucket_name = bucket_name
         self.acl = acl
         self.base_url = base_url
-        self.extensions = resolve_extensions(extensions)
+        self.extension_policy = get_policy(extensions)
+        self.extensions = self.extension_policy.extensions
+        self.multipart_threshold = int(multipart_threshold)
+        self.multipart_chunksize = max(int(multipart_chunksize), MIN_PART_SIZE)
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.part_retries = int(part_retries)
+        self.read_buffer_size = int(read_buffer_size)
+        self.max_workers = int(max_workers)
+        self.sniff_content = asbool(sniff_content)
+        self.hooks = list(hooks or ())
         self.conn_options = conn_options
 
+        self._client = None
+        self._client_pid = None
+        self._client_lock = threading.Lock()
+
     @property
     def s3_client(self):
+        """Returns a boto3 S3 client, built on first access and then
+        shared by all threads of the current process. Clients are not
+        inherited across a fork: a child process builds its own.
+        """
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            with self._client_lock:
+                if self._client is None or self._client_pid != pid:
+                    self._client = self._create_client()
+                    self._client_pid = pid
+        return self._client
+
+    def _create_client(self):
         try:
             import boto3
         except ImportError:
@@ -62,10 +137,13 @@ class S3FileStorage(object):
         from botocore.config import Config
         from botocore.exceptions import NoCredentialsError
 
-        timeout = float(self.conn_options.pop("timeout"))
-        conn_config = {"connect_timeout": timeout}
+        timeout = float(self.conn_options.get("timeout", 5))
+        conn_config = {
+            "connect_timeout": timeout,
+            "max_pool_connections": int(self.conn_options.get("max_pool_connections", 10)),
+        }
 
-        num_retries = int(self.conn_options.pop("num_retries"))
+        num_retries = int(self.conn_options.get("num_retries", 1))
         if num_retries > 1:
             conn_config["retries"] = {"max_attempts": num_retries, "mode": "standard"}
         if asbool(self.conn_options.get("use_path_style")):
@@ -75,12 +153,12 @@ class S3FileStorage(object):
             "aws_access_key_id": self.conn_options.get("aws_access_key_id"),
             "aws_secret_access_key": self.conn_options.get("aws_secret_access_key"),
         }
-        if self.conn_options["region"] is not None:
+        if self.conn_options.get("region") is not None:
             client_kwargs["region_name"] = self.conn_options.get("region")
         else:
             protocol = "http" if self.conn_options.get("is_secure") else "https"
-            host = self.conn_options["host"]
-            port = self.conn_options["port"]
+            host = self.conn_options.get("host")
+            port = self.conn_options.get("port")
             client_kwargs["endpoint"] = f"{protocol}://{host}:{port}"
 
         try:
@@ -99,13 +177,108 @@ class S3FileStorage(object):
         """
         return urllib.parse.urljoin(self.base_url, filename)
 
+    @instrumented
     def exists(self, filename, bucket_name=None):
         try:
-            self.s3_client.head_object(Bucket=bucket_name or self.bucket_name, Key=filename)
+            response = self.s3_client.head_object(
+                Bucket=bucket_name or self.bucket_name, Key=filename
+            )
+            _count_retries(response)
             return True
         except self.s3_client.exceptions.ClientError:
             return False
 
+    @instrumented
+    def open(self, filename, mode="rb", bucket_name=None):
+        """Opens a stored file for reading. Data is fetched with ranged GET
+        requests of at least **read_buffer_size** bytes as it is read, so
+        reading part of a large file does not download all of it. Reads
+        fail if the file is replaced while it is open.
+
+        :param filename: base name of file
+        :param mode: only "rb" is supported
+        :param bucket_name: name of the bucket, if not default
+        :returns: seekable file object
+        """
+        if mode != "rb":
+            raise ValueError('only "rb" mode is supported')
+        bucket_name = bucket_name or self.bucket_name
+        response = self._head_object(filename, bucket_name)
+        instrumentation.add_bytes(response["ContentLength"])
+        raw = S3ObjectReader(
+            self.s3_client, bucket_name, filename, response["ContentLength"], response["ETag"]
+        )
+        return io.BufferedReader(raw, buffer_size=self.read_buffer_size)
+
+    def _head_object(self, filename, bucket_name):
+        try:
+            response = self.s3_client.head_object(Bucket=bucket_name, Key=filename)
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(filename)
+            raise
+        _count_retries(response)
+        return response
+
+    @instrumented
+    def exists_many(self, filenames, bucket_name=None, prefix=None):
+        """Checks if several files exist. Returns a dict mapping each
+        filename to **True** or **False**.
+
+        By default each file is checked with its own HEAD request, with up to
+        **max_workers** requests in flight. If all the files share a prefix
+        (e.g. a folder) that holds few other keys, pass it as **prefix** to
+        list the keys under it instead: one request per 1000 keys.
+
+        :param filenames: iterable of base names of files
+        :param bucket_name: name of the bucket, if not default
+        :param prefix: list the keys under this prefix instead
+        """
+        filenames = list(filenames)
+        if prefix is not None:
+            existing = set()
+            paginator = self.s3_client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=bucket_name or self.bucket_name, Prefix=prefix):
+                existing.update(obj["Key"] for obj in page.get("Contents", []))
+            return dict((filename, filename in existing) for filename in filenames)
+
+        results = utils.map_concurrently(
+            lambda filename: self.exists(filename, bucket_name), filenames, self.max_workers
+        )
+        return dict(zip(filenames, results))
+
+    def list(self, prefix="", recursive=True, bucket_name=None):
+        """Yields a :class:`pyramid_storage.utils.FileInfo` for each key
+        starting with prefix, e.g. "photos/", fetching one page of up to
+        1000 keys at a time.
+
+        :param prefix: prefix of the keys
+        :param recursive: include keys in sub-folders; otherwise only those
+            without a "/" after the prefix are listed
+        :param bucket_name: name of the bucket, if not default
+        """
+        kwargs = {"Bucket": bucket_name or self.bucket_name, "Prefix": prefix}
+        if not recursive:
+            kwargs["Delimiter"] = "/"
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(**kwargs):
+            for obj in page.get("Contents", []):
+                yield utils.FileInfo(
+                    obj["Key"], obj["Size"], obj["LastModified"].timestamp(), obj["ETag"]
+                )
+
+    def list_many(self, prefixes, **kwargs):
+        """Yields the keys listed by :meth:`list` for each prefix, listing
+        the prefixes in parallel on up to **max_workers** threads, in no
+        particular order. Splitting a large bucket into prefixes, e.g. by
+        the first character of the keys, speeds up listing all of it.
+
+        :param prefixes: iterable of prefixes that do not overlap
+        :param kwargs: keyword arguments for :meth:`list`
+        """
+        return utils.list_concurrently(self, prefixes, self.max_workers, **kwargs)
+
+    @instrumented
     def delete(self, filename, bucket_name=None):
         """Deletes the filename. Filename is resolved with the
         absolute path based on base_path. If file does not exist,
@@ -114,7 +287,111 @@ class S3FileStorage(object):
         :param filename: base name of file
         :param bucket_name: name of the bucket, if not default
         """
-        self.s3_client.delete_object(Bucket=bucket_name or self.bucket_name, Key=filename)
+        response = self.s3_client.delete_object(
+            Bucket=bucket_name or self.bucket_name, Key=filename
+        )
+        _count_retries(response)
+
+    @instrumented
+    def delete_many(self, filenames, bucket_name=None):
+        """Deletes several files with one DeleteObjects request per 1000
+        keys. Returns a dict mapping each filename to **True** if it was
+        deleted (S3 also reports keys that did not exist as deleted) or
+        **False** if S3 returned an error for it.
+
+        :param filenames: iterable of base names of files
+        :param bucket_name: name of the bucket, if not default
+        """
+        results = {}
+        filenames = list(filenames)
+        for start in range(0, len(filenames), MAX_DELETE_KEYS):
+            chunk = filenames[start : start + MAX_DELETE_KEYS]
+            response = self.s3_client.delete_objects(
+                Bucket=bucket_name or self.bucket_name,
+                Delete={"Objects": [{"Key": key} for key in chunk]},
+            )
+            _count_retries(response)
+            for deleted in response.get("Deleted", []):
+                results[deleted["Key"]] = True
+            for error in response.get("Errors", []):
+                results[error["Key"]] = False
+        return results
+
+    @instrumented
+    def copy(self, src, dst, bucket_name=None, acl=None):
+        """Copies a stored file to another key inside S3, replacing dst if
+        it exists, without the data passing through this process. Objects
+        larger than 5 GB are copied in parts, several at a time. Returns
+        dst.
+
+        :param src: key of the file to copy
+        :param dst: key of the copy
+        :param bucket_name: name of the bucket, if not default
+        :param acl: ACL policy (if None then uses default)
+        :raises FileNotFoundError: if src does not exist
+        """
+        bucket_name = bucket_name or self.bucket_name
+        acl = acl or self.acl
+        response = self._head_object(src, bucket_name)
+        extra_args = {"ACL": acl} if acl else {}
+        source = {"Bucket": bucket_name, "Key": src}
+        if response["ContentLength"] > MAX_COPY_SIZE:
+            self.copy_multipart(
+                source,
+                dst,
+                response["ContentLength"],
+                bucket_name=bucket_name,
+                ContentType=response.get("ContentType", "application/octet-stream"),
+                **extra_args,
+            )
+        else:
+            response = self.s3_client.copy_object(
+                Bucket=bucket_name, Key=dst, CopySource=source, **extra_args
+            )
+            _count_retries(response)
+        return dst
+
+    @instrumented
+    def move(self, src, dst, bucket_name=None, acl=None):
+        """Copies a stored file to another key with :meth:`copy`, then
+        deletes src. S3 has no rename. Returns dst.
+
+        :param src: key of the file to move
+        :param dst: new key of the file
+        :param bucket_name: name of the bucket, if not default
+        :param acl: ACL policy (if None then uses default)
+        :raises FileNotFoundError: if src does not exist
+        """
+        self.copy(src, dst, bucket_name, acl)
+        if src != dst:
+            self.delete(src, bucket_name)
+        return dst
+
+    @instrumented
+    def copy_many(self, pairs, bucket_name=None):
+        """Copies several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was copied or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        :param bucket_name: name of the bucket, if not default
+        """
+        return utils.transfer_many(
+            lambda src, dst: self.copy(src, dst, bucket_name), pairs, self.max_workers
+        )
+
+    @instrumented
+    def move_many(self, pairs, bucket_name=None):
+        """Moves several files on up to **max_workers** threads. Returns a
+        dict mapping each src to **True** if it was moved or **False** if
+        it did not exist.
+
+        :param pairs: iterable of (src, dst) tuples
+        :param bucket_name: name of the bucket, if not default
+        """
+        return utils.transfer_many(
+            lambda src, dst: self.move(src, dst, bucket_name), pairs, self.max_workers
+        )
 
     def filename_allowed(self, filename, extensions=None):
         """Checks if a filename has an allowed extension
@@ -122,8 +399,7 @@ class S3FileStorage(object):
         :param filename: base name of file
         :param extensions: iterable of extensions (or self.extensions)
         """
-        _, ext = os.path.splitext(filename)
-        return self.extension_allowed(ext, extensions)
+        return get_policy(extensions, self.extension_policy).filename_allowed(filename)
 
     def file_allowed(self, fs, extensions=None):
         """Checks if a file can be saved, based on extensions
@@ -139,13 +415,7 @@ class S3FileStorage(object):
 
         :param extensions: iterable of extensions (or self.extensions)
         """
-
-        extensions = extensions or self.extensions
-        if not extensions:
-            return True
-        if ext.startswith("."):
-            ext = ext[1:]
-        return ext.lower() in extensions
+        return get_policy(extensions, self.extension_policy).extension_allowed(ext)
 
     def save(self, fs, *args, **kwargs):
         """Saves contents of a **cgi.FieldStorage** object to the file system.
@@ -183,6 +453,19 @@ class S3FileStorage(object):
 
         return self.save_file(open(filename, "rb"), filename, *args, **kwargs)
 
+    @instrumented
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads.
+        Errors are collected per item rather than aborting the batch.
+
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.max_workers)
+
+    @instrumented
     def save_file(
         self,
         file,
@@ -194,6 +477,8 @@ class S3FileStorage(object):
         acl=None,
         replace=False,
         headers=None,
+        content_addressed=False,
+        _reserved=False,
     ):
         """
         :param filename: local filename
@@ -204,23 +489,36 @@ class S3FileStorage(object):
         :param acl: ACL policy (if None then uses default)
         :param replace: replace existing key
         :param headers: dict of s3 request headers
+        :param content_addressed: name the file after the SHA-256 digest of
+            its contents and skip the upload if it already exists
         :returns: modified filename
         """
         acl = acl or self.acl
         headers = headers or {}
-        extensions = extensions or self.extensions
 
         if not self.filename_allowed(filename, extensions):
             raise FileNotAllowed()
 
+        if self.sniff_content:
+            policy = get_policy(extensions, self.extension_policy)
+            file = validation.sniff(file, filename, policy.extensions)
+
         filename = utils.secure_filename(os.path.basename(filename))
 
-        if randomize:
+        extra_args = {}
+        if content_addressed:
+            file, sha256, md5 = utils.digest_file(file, self.multipart_chunksize)
+            filename = utils.content_filename(filename, sha256.hexdigest())
+            extra_args["ContentMD5"] = utils.b64_digest(md5)
+        elif randomize:
             filename = utils.random_filename(filename)
 
         if folder:
             filename = folder + "/" + filename
 
+        if content_addressed and self.exists(filename, bucket_name):
+            return filename
+
         content_type = headers.get("Content-Type")
         if content_type is None:
             content_type, _ = mimetypes.guess_type(filename)
@@ -228,11 +526,385 @@ class S3FileStorage(object):
 
         file.seek(0)
 
-        self.s3_client.put_object(
-            Bucket=bucket_name or self.bucket_name,
-            Key=filename,
-            Body=file,
-            ACL=acl,
-            ContentType=content_type,
+        size = utils.get_file_size(file)
+
+        if size is not None and size > self.multipart_threshold:
+            self.upload_multipart(
+                file,
+                filename,
+                bucket_name=bucket_name,
+                ACL=acl,
+                ContentType=content_type,
+            )
+        else:
+            response = self.s3_client.put_object(
+                Bucket=bucket_name or self.bucket_name,
+                Key=filename,
+                Body=file,
+                ACL=acl,
+                ContentType=content_type,
+                **extra_args,
+            )
+            _count_retries(response)
+        instrumentation.add_bytes(size)
+        return filename
+
+    def reserve_filename(self, filename, folder=None, randomize=False, extensions=None):
+        """Returns the name :meth:`save_file` would store a file under. Names
+        cannot be reserved in S3, so nothing else is done.
+
+        :param filename: original filename
+        :param folder: relative path of sub-folder
+        :param randomize: randomize the filename
+        :param extensions: iterable of allowed extensions, if not default
+        :returns: modified filename
+        """
+        if not self.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+        return utils.resolve_filename(filename, folder, randomize)
+
+    def release_filename(self, filename, bucket_name=None):
+        """Gives back a name returned by :meth:`reserve_filename`. Nothing is
+        reserved in S3, so this does nothing.
+
+        :param filename: name returned by :meth:`reserve_filename`
+        """
+
+    def presigned_url(self, filename, expires_in=3600, bucket_name=None, download_name=None):
+        """Returns a presigned URL to download a file straight from S3,
+        e.g. from a private bucket.
+
+        :param filename: base name of file
+        :param expires_in: number of seconds the URL is valid for
+        :param bucket_name: name of the bucket, if not default
+        :param download_name: filename offered to the browser, as an
+            attachment, if given
+        """
+        params = {"Bucket": bucket_name or self.bucket_name, "Key": filename}
+        if download_name:
+            params["ResponseContentDisposition"] = 'attachment; filename="%s"' % download_name
+        return self.s3_client.generate_presigned_url(
+            "get_object", Params=params, ExpiresIn=int(expires_in)
         )
+
+    def presigned_upload(
+        self,
+        filename,
+        folder=None,
+        bucket_name=None,
+        randomize=False,
+        extensions=None,
+        acl=None,
+        content_type=None,
+        max_size=None,
+        expires_in=3600,
+        method="POST",
+    ):
+        """Returns a :class:`pyramid_storage.utils.PresignedUpload` a
+        client can use to upload a file straight to S3, without sending it
+        through the application. The file is named as by :meth:`save_file`.
+        Call :meth:`complete_upload` once the client is done.
+
+        A "POST" upload is limited to max_size bytes and to content_type by
+        S3 itself; a "PUT" upload is only checked by :meth:`complete_upload`.
+
+        :param filename: original filename
+        :param folder: relative path of sub-folder
+        :param bucket_name: name of the bucket, if not default
+        :param randomize: randomize the filename
+        :param extensions: iterable of allowed extensions, if not default
+        :param acl: ACL policy (if None then uses default)
+        :param content_type: required content type, by default guessed from
+            the filename
+        :param max_size: maximum size in bytes
+        :param expires_in: number of seconds the upload is allowed for
+        :param method: "POST" or "PUT"
+        :returns: :class:`pyramid_storage.utils.PresignedUpload`
+        """
+        if not self.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        filename = utils.resolve_filename(filename, folder, randomize)
+        bucket_name = bucket_name or self.bucket_name
+        acl = acl or self.acl
+        if content_type is None:
+            content_type, _ = mimetypes.guess_type(filename)
+        content_type = content_type or "application/octet-stream"
+
+        if method == "POST":
+            fields = {"Content-Type": content_type}
+            if acl:
+                fields["acl"] = acl
+            conditions = [{name: value} for name, value in fields.items()]
+            if max_size is not None:
+                conditions.append(["content-length-range", 0, int(max_size)])
+            response = self.s3_client.generate_presigned_post(
+                bucket_name,
+                filename,
+                Fields=fields,
+                Conditions=conditions,
+                ExpiresIn=int(expires_in),
+            )
+            return utils.PresignedUpload(
+                filename, response["url"], method, fields=response["fields"]
+            )
+
+        if method == "PUT":
+            params = {"Bucket": bucket_name, "Key": filename, "ContentType": content_type}
+            headers = {"Content-Type": content_type}
+            if acl:
+                params["ACL"] = acl
+                headers["x-amz-acl"] = acl
+            url = self.s3_client.generate_presigned_url(
+                "put_object", Params=params, ExpiresIn=int(expires_in)
+            )
+            return utils.PresignedUpload(filename, url, method, headers=headers)
+
+        raise ValueError('method must be "POST" or "PUT"')
+
+    def complete_upload(self, filename, max_size=None, content_type=None, bucket_name=None):
+        """Checks a file uploaded with :meth:`presigned_upload`. The file is
+        deleted and **FileNotAllowed** raised if it is larger than max_size,
+        does not have the given content type, or (if **sniff_content** is
+        set) its contents do not match its extension.
+
+        :param filename: name returned by :meth:`presigned_upload`
+        :param max_size: maximum size in bytes
+        :param content_type: required content type
+        :param bucket_name: name of the bucket, if not default
+        :raises FileNotFoundError: if the file was not uploaded
+        :returns: filename
+        """
+        bucket_name = bucket_name or self.bucket_name
+        response = self._head_object(filename, bucket_name)
+
+        try:
+            if max_size is not None and response["ContentLength"] > int(max_size):
+                raise FileNotAllowed()
+            if content_type and response.get("ContentType") != content_type:
+                raise FileNotAllowed()
+            if self.sniff_content:
+                with self.open(filename, bucket_name=bucket_name) as file:
+                    validation.sniff(file, filename, self.extensions)
+        except FileNotAllowed:
+            self.delete(filename, bucket_name)
+            raise
         return filename
+
+    def upload_multipart(self, file, key, bucket_name=None, **extra_args):
+        """Uploads a file object to the given key as a multipart upload.
+
+        The stream is read sequentially in parts of **multipart_chunksize**
+        bytes, which are uploaded in parallel on a pool of
+        **max_concurrency** threads. No more than **max_concurrency** parts
+        are buffered at once, whatever the size of the file. A part that
+        fails is retried on its own up to **part_retries** times; if it
+        still fails the whole upload is aborted and the error re-raised.
+
+        :param file: file object, read from its current position
+        :param key: target key
+        :param bucket_name: name of the bucket, if not default
+        :param extra_args: extra arguments for **create_multipart_upload**
+            e.g. ACL and ContentType
+        """
+        bucket_name = bucket_name or self.bucket_name
+        client = self.s3_client
+
+        upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, **extra_args)[
+            "UploadId"
+        ]
+
+        parts = []
+        upload_part = utils.in_context(self._upload_part)
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                pending = set()
+                part_number = 0
+                while True:
+                    if len(pending) >= self.max_concurrency:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        parts.extend(future.result() for future in done)
+
+                    data = self._read_part(file)
+                    if not data and part_number:
+                        break
+                    part_number += 1
+                    pending.add(
+                        executor.submit(
+                            upload_part, bucket_name, key, upload_id, part_number, data
+                        )
+                    )
+
+                parts.extend(future.result() for future in pending)
+
+            parts.sort(key=lambda part: part["PartNumber"])
+            client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def copy_multipart(self, source, key, size, bucket_name=None, **extra_args):
+        """Copies an object of the given size to key with UploadPartCopy
+        requests, on a pool of **max_concurrency** threads. Parts are at
+        least 512 MB, so no more than 10000 are needed. A part that fails
+        is retried on its own up to **part_retries** times; if it still
+        fails the whole copy is aborted and the error re-raised.
+
+        :param source: dict with the Bucket and Key of the object to copy
+        :param key: target key
+        :param size: size of the object in bytes
+        :param bucket_name: name of the bucket, if not default
+        :param extra_args: extra arguments for **create_multipart_upload**
+            e.g. ACL and ContentType
+        """
+        bucket_name = bucket_name or self.bucket_name
+        client = self.s3_client
+        part_size = max(COPY_PART_SIZE, -(-size // MAX_PARTS))
+
+        upload_id = client.create_multipart_upload(Bucket=bucket_name, Key=key, **extra_args)[
+            "UploadId"
+        ]
+
+        def copy_part(part_number):
+            start = (part_number - 1) * part_size
+            end = min(start + part_size, size) - 1
+            return self._retry_part(
+                lambda: {
+                    "PartNumber": part_number,
+                    "ETag": client.upload_part_copy(
+                        Bucket=bucket_name,
+                        Key=key,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        CopySource=source,
+                        CopySourceRange="bytes=%d-%d" % (start, end),
+                    )["CopyPartResult"]["ETag"],
+                }
+            )
+
+        try:
+            part_numbers = range(1, -(-size // part_size) + 1)
+            parts = utils.map_concurrently(copy_part, part_numbers, self.max_concurrency)
+            client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def _read_part(self, file):
+        chunks = []
+        remaining = self.multipart_chunksize
+        while remaining:
+            chunk = file.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def _upload_part(self, bucket_name, key, upload_id, part_number, data):
+        def upload():
+            response = self.s3_client.upload_part(
+                Bucket=bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+        return self._retry_part(upload)
+
+    def _retry_part(self, func):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except (BotoCoreError, ClientError):
+                attempt += 1
+                if attempt > self.part_retries:
+                    raise
+                instrumentation.add_retries()
+                time.sleep(0.1 * 2**attempt)
+
+
+def _count_retries(response):
+    """Adds the retries botocore made for a request to the call in
+    progress."""
+    instrumentation.add_retries(response.get("ResponseMetadata", {}).get("RetryAttempts", 0))
+
+
+class S3ObjectReader(io.RawIOBase):
+    """Unbuffered, seekable file object reading an S3 object with ranged
+    GET requests, returned by :meth:`S3FileStorage.open` inside an
+    **io.BufferedReader**.
+
+    :param client: boto3 S3 client
+    :param bucket_name: name of the bucket
+    :param key: key of the object
+    :param size: size of the object in bytes
+    :param etag: ETag of the object, required to match on every request
+    """
+
+    def __init__(self, client, bucket_name, key, size, etag):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self.position = offset
+        return offset
+
+    def readinto(self, buffer):
+        data = self._get(min(self.position + len(buffer), self.size))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def readall(self):
+        # The rest of the object in a single request, rather than one per
+        # DEFAULT_BUFFER_SIZE bytes.
+        return self._get(self.size)
+
+    def _get(self, end):
+        """Returns the bytes from the current position up to end, moving
+        the position past them."""
+        if end <= self.position:
+            return b""
+        response = self.client.get_object(
+            Bucket=self.bucket_name,
+            Key=self.name,
+            Range="bytes=%d-%d" % (self.position, end - 1),
+            IfMatch=self.etag,
+        )
+        data = response["Body"].read()
+        self.position += len(data)
+        return data
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+import threading
+import time
+import uuid
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import implementer
+
+from . import utils
+from .interfaces import IFileStorage
+from .local import TEMP_PREFIX, TEMP_SUFFIX, LocalFileStorage, _copy_file
+from .registry import register_file_storage_impl, storage_from_settings
+
+
+def includeme(config):
+    settings = config.registry.settings
+    impl = TieredFileStorage.from_settings(settings, prefix="storage.")
+    impl.cache.sweep_temp_files()
+
+    register_file_storage_impl(config, impl)
+
+
+@implementer(IFileStorage)
+class TieredFileStorage(object):
+    """Keeps recently used files of a remote storage, e.g.
+    **S3FileStorage** or **GoogleCloudStorage**, on local disk.
+
+    Saved files are uploaded to the remote storage and kept in the cache
+    (write-through). Files opened with :meth:`open` or :meth:`path` are
+    downloaded into the cache first unless they are there already
+    (read-through). The cache holds at most **max_bytes**: the least
+    recently used files are evicted first, as are files unused for more
+    than **max_age** seconds. Use is tracked with the modification time of
+    the cached files, so every process on the host shares the cache.
+
+    Cached files are trusted until evicted, so files should only be
+    replaced or deleted through this storage.
+
+    All other attributes are those of the remote storage.
+
+    :param remote: **IFileStorage** instance holding the files
+    :param cache: :class:`pyramid_storage.local.LocalFileStorage` for the
+        cached copies
+    :param max_bytes: maximum total size of the cached files
+    :param max_age: seconds after which an unused file is evicted
+    :param prune_interval: minimum number of seconds between two scans of
+        the cache for files to evict, unless it is full
+    """
+
+    @classmethod
+    def from_settings(cls, settings, prefix):
+        """Returns a new instance from config settings. The remote storage
+        is configured by its own settings, e.g. **storage.aws.***.
+
+        :param settings: dict(-like) of settings
+        :param prefix: prefix separating these settings
+        """
+        options = (
+            ("tiered.remote", True, None),
+            ("tiered.path", True, None),
+            ("tiered.max_bytes", False, 1024 * 1024 * 1024),
+            ("tiered.max_age", False, 24 * 3600),
+            ("tiered.prune_interval", False, 60),
+            ("tiered.shard_depth", False, 0),
+        )
+        kwargs = utils.read_settings(settings, options, prefix)
+        if kwargs["tiered.remote"] not in ("s3", "gcloud"):
+            raise ConfigurationError('%stiered.remote must be "s3" or "gcloud"' % prefix)
+        remote = storage_from_settings(kwargs["tiered.remote"], settings, prefix)
+        cache = LocalFileStorage(
+            kwargs["tiered.path"], extensions="any", shard_depth=kwargs["tiered.shard_depth"]
+        )
+        return cls(
+            remote,
+            cache,
+            max_bytes=kwargs["tiered.max_bytes"],
+            max_age=kwargs["tiered.max_age"],
+            prune_interval=kwargs["tiered.prune_interval"],
+        )
+
+    def __init__(
+        self, remote, cache, max_bytes=1024 * 1024 * 1024, max_age=24 * 3600, prune_interval=60
+    ):
+        self.remote = remote
+        self.cache = cache
+        self.max_bytes = int(max_bytes)
+        self.max_age = float(max_age)
+        self.prune_interval = float(prune_interval)
+
+        # Estimate of the size of the cache, corrected by each prune.
+        self._size = None
+        self._pruned_at = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def url(self, filename):
+        """Returns entire URL of the filename in the remote storage
+
+        :param filename: base name of file
+        """
+        return self.remote.url(filename)
+
+    def exists(self, filename, *args, **kwargs):
+        """Checks if file exists, in the cache or else in the remote
+        storage.
+
+        :param filename: base name of file
+        """
+        return self.cache.exists(filename) or self.remote.exists(filename, *args, **kwargs)
+
+    def exists_many(self, filenames, **kwargs):
+        """Checks if several files exist. Files missing from the cache are
+        checked with the remote storage's **exists_many**.
+
+        :param filenames: iterable of base names of files
+        """
+        results = self.cache.exists_many(filenames)
+        missing = [filename for filename, result in results.items() if not result]
+        if missing:
+            results.update(self.remote.exists_many(missing, **kwargs))
+        return results
+
+    def open(self, filename, mode="rb"):
+        """Opens a stored file for reading from the cache, downloading it
+        first if needed. A file larger than **max_bytes** is read from the
+        remote storage instead.
+
+        :param filename: base name of file
+        :param mode: only "rb" is supported
+        :returns: seekable file object
+        """
+        if mode != "rb":
+            raise ValueError('only "rb" mode is supported')
+        if self._touch(filename):
+            return self.cache.open(filename)
+        file = self.remote.open(filename)
+        size = utils.get_file_size(file)
+        if size is None or size > self.max_bytes:
+            return file
+        with file:
+            self._store(file, filename)
+        return self.cache.open(filename)
+
+    def path(self, filename):
+        """Returns the absolute path of the cached copy of the file,
+        downloading it first if needed, e.g. to serve it with a
+        **FileResponse**. A file larger than **max_bytes** would be evicted
+        straight away, so **OSError** (EFBIG) is raised instead; read it
+        with :meth:`open`.
+
+        :param filename: base name of file
+        """
+        if not self._touch(filename):
+            with self.remote.open(filename) as file:
+                size = utils.get_file_size(file)
+                if size is None or size > self.max_bytes:
+                    raise OSError(errno.EFBIG, "File too large to be cached", filename)
+                self._store(file, filename)
+        return self.cache.path(filename)
+
+    def delete(self, filename, *args, **kwargs):
+        """Deletes the filename from the remote storage and the cache.
+
+        :param filename: base name of file
+        """
+        self.cache.delete(filename)
+        return self.remote.delete(filename, *args, **kwargs)
+
+    def delete_many(self, filenames, **kwargs):
+        """Deletes several files from the remote storage and the cache.
+        Returns the result of the remote storage's **delete_many**.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        self.cache.delete_many(filenames)
+        return self.remote.delete_many(filenames, **kwargs)
+
+    def copy(self, src, dst, *args, **kwargs):
+        """Copies a stored file in the remote storage. Returns dst.
+
+        :param src: base name of the file to copy
+        :param dst: base name of the copy
+        """
+        dst = self.remote.copy(src, dst, *args, **kwargs)
+        self.cache.delete(dst)
+        return dst
+
+    def move(self, src, dst, *args, **kwargs):
+        """Moves a stored file in the remote storage, and its cached copy
+        if there is one. Returns dst.
+
+        :param src: base name of the file to move
+        :param dst: new base name of the file
+        """
+        dst = self.remote.move(src, dst, *args, **kwargs)
+        try:
+            self.cache.move(src, dst)
+        except FileNotFoundError:
+            self.cache.delete(dst)
+        return dst
+
+    def copy_many(self, pairs, **kwargs):
+        """Copies several files. Takes the same arguments as the remote
+        storage's **copy_many**."""
+        pairs = list(pairs)
+        results = self.remote.copy_many(pairs, **kwargs)
+        self.cache.delete_many(dst for _, dst in pairs)
+        return results
+
+    def move_many(self, pairs, **kwargs):
+        """Moves several files. Takes the same arguments as the remote
+        storage's **move_many**."""
+        pairs = list(pairs)
+        results = self.remote.move_many(pairs, **kwargs)
+        for src, dst in pairs:
+            try:
+                self.cache.move(src, dst)
+            except FileNotFoundError:
+                self.cache.delete(dst)
+        return results
+
+    def save(self, fs, *args, **kwargs):
+        """Saves contents of a **cgi.FieldStorage** object. Takes the same
+        arguments as the remote storage's **save**.
+
+        :returns: modified filename
+        """
+        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+
+    def save_filename(self, filename, *args, **kwargs):
+        """Saves a filename in local filesystem. Takes the same arguments
+        as the remote storage's **save_filename**.
+
+        :returns: modified filename
+        """
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    def save_file(self, file, filename, *args, **kwargs):
+        """Saves a file object to the remote storage and keeps a copy in the
+        cache. Takes the same arguments as the remote storage's
+        **save_file**. The file is copied to the cache first and uploaded
+        from there, so non-seekable streams are read only once.
+
+        If the remote storage may have kept a file already stored under
+        the name, e.g. Google Cloud Storage without **replace**, the file is
+        not cached, and any cached copy is dropped.
+
+        :returns: modified filename
+        """
+        temp_path = self._temp_path()
+        try:
+            with open(temp_path, "xb") as dest:
+                file.seek(0)
+                _copy_file(file, dest, self.cache.copy_buffer_size)
+                # A kernel copy does not move the position of dest.
+                size = dest.seek(0, os.SEEK_END)
+            with open(temp_path, "rb") as temp:
+                name = self.remote.save_file(temp, filename, *args, **kwargs)
+            if not self._written(file, filename, *args, **kwargs):
+                self.cache.delete(name)
+            elif size <= self.max_bytes:
+                self._replace(temp_path, name, size)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return name
+
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads of
+        the remote storage.
+
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.remote.max_workers)
+
+    def complete_upload(self, filename, *args, **kwargs):
+        """Checks a file uploaded with **presigned_upload**. Takes the same
+        arguments as the remote storage's **complete_upload**."""
+        filename = self.remote.complete_upload(filename, *args, **kwargs)
+        self.cache.delete(filename)
+        return filename
+
+    def prune(self):
+        """Evicts files unused for more than **max_age** seconds, then the
+        least recently used files until the cache holds at most
+        **max_bytes**. Returns the number of files evicted.
+        """
+        with self._lock:
+            self._pruned_at = time.monotonic()
+        cutoff = time.time() - self.max_age
+        files = sorted(self.cache.list(), key=lambda info: info.mtime)
+        size = sum(info.size for info in files)
+        evicted = 0
+        for info in files:
+            if info.mtime >= cutoff and size <= self.max_bytes:
+                break
+            if self.cache.delete(info.name):
+                evicted += 1
+            size -= info.size
+        with self._lock:
+            self._size = size
+        return evicted
+
+    def _written(self, *args, **kwargs):
+        """Returns **True** if a call to the remote storage's **save_file**
+        with these arguments is sure to have stored the file."""
+        if not getattr(self.remote, "keeps_existing_files", False):
+            return True
+        try:
+            arguments = utils.bind_arguments(self.remote.save_file, *args, **kwargs)
+        except TypeError:
+            return False
+        # Content-addressed files of the same name hold the same data.
+        return bool(arguments.get("replace") or arguments.get("content_addressed"))
+
+    def _touch(self, filename):
+        """Marks a cached file as just used. Returns **False** if the file
+        is not cached or has expired."""
+        path = self.cache.path(filename)
+        try:
+            if os.path.getmtime(path) < time.time() - self.max_age:
+                return False
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _temp_path(self):
+        os.makedirs(self.cache.base_path, exist_ok=True)
+        return os.path.join(self.cache.base_path, TEMP_PREFIX + uuid.uuid4().hex + TEMP_SUFFIX)
+
+    def _store(self, file, filename):
+        """Copies a file object into the cache under filename."""
+        temp_path = self._temp_path()
+        try:
+            with open(temp_path, "xb") as dest:
+                _copy_file(file, dest, self.cache.copy_buffer_size)
+                # A kernel copy does not move the position of dest.
+                size = dest.seek(0, os.SEEK_END)
+            self._replace(temp_path, filename, size)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _replace(self, temp_path, filename, size):
+        path = self.cache.path(filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            due = (
+                self._size is None
+                or self._size > self.max_bytes
+                or time.monotonic() - self._pruned_at > self.prune_interval
+            )
+        if due:
+            self.prune()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from zope.interface import implementer
+
+from . import utils, validation
+from .exceptions import FileNotAllowed
+from .extensions import get_policy
+from .interfaces import IFileStorage
+
+
+try:
+    import transaction
+except ImportError:
+    raise RuntimeError("You must have transaction installed to use pyramid_storage.transactional")
+
+
+log = logging.getLogger(__name__)
+
+
+def get_transactional_file_storage_impl(request):
+    """
+    Returns a :class:`TransactionalFileStorage` for the request, joining
+    **request.tm** if pyramid_tm is used.
+
+    :param request: Pyramid Request instance
+    """
+    from .registry import get_file_storage_impl
+
+    options = (
+        ("transactional.spool_size", False, 8 * 1024 * 1024),
+        ("transactional.max_workers", False, None),
+    )
+    kwargs = utils.read_settings(request.registry.settings, options, "storage.")
+    return TransactionalFileStorage(
+        get_file_storage_impl(request),
+        getattr(request, "tm", None),
+        spool_size=kwargs["transactional.spool_size"],
+        max_workers=kwargs["transactional.max_workers"],
+    )
+
+
+@implementer(IFileStorage)
+class TransactionalFileStorage(object):
+    """Stages saves and deletes in front of any **IFileStorage**
+    implementation until the current transaction commits.
+
+    Saving a file copies it to a temporary file and returns the name it
+    will be stored under, reserving it where the backend can. When the
+    transaction commits, the staged files are uploaded in parallel on up to
+    **max_workers** threads before the other data managers commit (a
+    failure aborts the transaction), and the staged deletes run once it has
+    committed. If the transaction aborts, files already uploaded are
+    removed and reserved names given back.
+
+    All other attributes are those of the wrapped storage.
+
+    :param storage: **IFileStorage** instance
+    :param transaction_manager: transaction manager, by default the
+        thread-local **transaction.manager**
+    :param spool_size: maximum size of a staged file held in memory
+    :param max_workers: number of threads uploading at commit, by default
+        the **max_workers** of storage
+    """
+
+    def __init__(
+        self, storage, transaction_manager=None, spool_size=8 * 1024 * 1024, max_workers=None
+    ):
+        self.storage = storage
+        self.transaction_manager = transaction_manager or transaction.manager
+        self.spool_size = int(spool_size)
+        self.max_workers = int(max_workers or getattr(storage, "max_workers", 8))
+        self._saves = {}
+        self._deletes = {}
+        self._flushed = []
+        self._data_manager = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def _join(self):
+        """Joins the current transaction of the calling thread, once."""
+        with self._lock:
+            if self._data_manager is None:
+                data_manager = StorageDataManager(self)
+                self.transaction_manager.get().join(data_manager)
+                self._data_manager = data_manager
+
+    def exists(self, filename, *args, **kwargs):
+        if filename in self._saves:
+            return True
+        if filename in self._deletes:
+            return False
+        return self.storage.exists(filename, *args, **kwargs)
+
+    def exists_many(self, filenames, *args, **kwargs):
+        filenames = list(filenames)
+        results = self.storage.exists_many(
+            [filename for filename in filenames if filename not in self._saves], *args, **kwargs
+        )
+        for filename in filenames:
+            if filename in self._saves:
+                results[filename] = True
+            elif filename in self._deletes:
+                results[filename] = False
+        return results
+
+    def delete(self, filename, *args, **kwargs):
+        """Stages the deletion of a file until the transaction commits. A
+        file saved in the same transaction is not uploaded."""
+        self._join()
+        staged = self._saves.pop(filename, None)
+        if staged is not None:
+            # Nothing was stored yet, and once given back the name may be
+            # used by another writer, so there is nothing to delete.
+            self._discard(filename, staged)
+            return
+        self._deletes[filename] = (args, kwargs)
+
+    def delete_many(self, filenames, *args, **kwargs):
+        for filename in filenames:
+            self.delete(filename, *args, **kwargs)
+
+    def save(self, fs, *args, **kwargs):
+        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+
+    def save_filename(self, filename, *args, **kwargs):
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    def save_file(
+        self,
+        file,
+        filename,
+        folder=None,
+        randomize=False,
+        extensions=None,
+        content_addressed=False,
+        **kwargs,
+    ):
+        """Stages a file to be saved when the transaction commits. Takes
+        the arguments of the storage's **save_file**. Returns the name it
+        will be stored under.
+        """
+        if not self.storage.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        try:
+            file.seek(0)
+            if content_addressed:
+                sha256, _ = utils.hash_file(file, spool)
+            else:
+                shutil.copyfileobj(file, spool)
+            spool.seek(0)
+
+            if getattr(self.storage, "sniff_content", False):
+                policy = get_policy(extensions, self.storage.extension_policy)
+                validation.sniff(spool, filename, policy.extensions)
+
+            self._join()
+
+            options = dict(kwargs, folder=folder, extensions=extensions)
+            if content_addressed:
+                options["content_addressed"] = True
+                name = utils.content_filename(
+                    utils.secure_filename(os.path.basename(filename)), sha256.hexdigest()
+                )
+                if folder:
+                    name = folder + "/" + name
+            else:
+                # The name is handed out now, so the file is written into
+                # the reserved name at commit.
+                options["_reserved"] = True
+                name = self.storage.reserve_filename(filename, folder, randomize, extensions)
+                filename = os.path.basename(name)
+        except BaseException:
+            spool.close()
+            raise
+
+        with self._lock:
+            self._deletes.pop(name, None)
+            previous = self._saves.pop(name, None)
+            self._saves[name] = (spool, filename, options)
+        if previous is not None:
+            previous[0].close()
+        return name
+
+    def save_many(self, items):
+        # The files are staged on pool threads, where the thread-local
+        # transaction manager has another transaction: join this one first.
+        self._join()
+        return utils.save_many(self, items, self.max_workers)
+
+    def _flush(self):
+        """Uploads the staged files, raising the first error."""
+
+        def upload(item):
+            name, (spool, filename, options) = item
+            try:
+                self.storage.save_file(spool, filename, **options)
+            except Exception as e:
+                return e
+            self._flushed.append(name)
+
+        errors = utils.map_concurrently(upload, list(self._saves.items()), self.max_workers)
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def _finish(self):
+        """Runs the staged deletes once the transaction has committed."""
+
+        def delete(item):
+            name, (args, kwargs) = item
+            try:
+                self.storage.delete(name, *args, **kwargs)
+            except Exception:
+                log.exception("Could not delete %s after commit", name)
+
+        try:
+            utils.map_concurrently(delete, list(self._deletes.items()), self.max_workers)
+        finally:
+            self._reset()
+
+    def _rollback(self):
+        """Removes uploaded files and gives back reserved names."""
+        flushed = set(self._flushed)
+        try:
+            for name, staged in self._saves.items():
+                if name in flushed and not staged[2].get("content_addressed"):
+                    try:
+                        self.storage.delete(name, **_location(staged[2]))
+                    except Exception:
+                        log.exception("Could not remove %s after abort", name)
+                else:
+                    self._discard(name, staged)
+        finally:
+            self._reset()
+
+    def _discard(self, name, staged):
+        spool, _, options = staged
+        spool.close()
+        if not options.get("content_addressed"):
+            self.storage.release_filename(name, **_location(options))
+
+    def _reset(self):
+        for spool, _, _ in self._saves.values():
+            spool.close()
+        self._saves = {}
+        self._deletes = {}
+        self._flushed = []
+        self._data_manager = None
+
+
+def _location(options):
+    """Returns the keyword arguments locating a staged file in the
+    storage, i.e. its bucket if not the default one."""
+    bucket_name = options.get("bucket_name")
+    return {"bucket_name": bucket_name} if bucket_name else {}
+
+
+class StorageDataManager(object):
+    """Data manager joining a :class:`TransactionalFileStorage` to a
+    transaction."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.transaction_manager = storage.transaction_manager
+
+    def tpc_begin(self, txn):
+        pass
+
+    def commit(self, txn):
+        pass
+
+    def tpc_vote(self, txn):
+        self.storage._flush()
+
+    def tpc_finish(self, txn):
+        self.storage._finish()
+
+    def abort(self, txn):
+        self.storage._rollback()
+
+    def tpc_abort(self, txn):
+        self.storage._rollback()
+
+    def sortKey(self):
+        # Vote after the other data managers, so uploads only start once
+        # e.g. the database has accepted the transaction.
+        return "~pyramid_storage:%d" % id(self)
@@ -1,9 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import collections
+import contextvars
+import hashlib
+import inspect
 import os
+import queue
 import re
+import tempfile
+import threading
+import time
 import unicodedata
 import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 from pyramid import exceptions as pyramid_exceptions
 
@@ -58,6 +68,339 @@ def random_filename(filename):
     return str(uuid.uuid4()) + ext.lower()
 
 
+def resolve_filename(filename, folder=None, randomize=False):
+    """Returns the key a file is stored under in a bucket: its secured
+    base name, randomized if required, prefixed with folder.
+
+    :param filename: the original filename
+    :param folder: relative path of sub-folder
+    :param randomize: randomize the filename
+    """
+    filename = secure_filename(os.path.basename(filename))
+    if randomize:
+        filename = random_filename(filename)
+    if folder:
+        filename = folder + "/" + filename
+    return filename
+
+
+def content_filename(filename, digest):
+    """Returns the name of a file stored under the hex digest of its
+    contents, preserving the original extension.
+
+    :param filename: the original filename
+    :param digest: hex digest of the contents
+    """
+    _, ext = os.path.splitext(filename)
+    return digest + ext.lower()
+
+
+def b64_digest(hash):
+    """Returns the base64 encoded digest of a hash object, as used in
+    **Content-MD5** headers."""
+    return base64.b64encode(hash.digest()).decode("ascii")
+
+
+def hash_file(file, dest=None, buffer_size=1024 * 1024):
+    """Reads a file object from its current position to the end and
+    computes the SHA-256 and MD5 hashes of the data, writing it to dest
+    in the same pass if given. Returns the (sha256, md5) hash objects.
+
+    :param file: file object
+    :param dest: file object to copy the data to
+    :param buffer_size: number of bytes read at a time
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    while True:
+        data = file.read(buffer_size)
+        if not data:
+            break
+        sha256.update(data)
+        md5.update(data)
+        if dest is not None:
+            dest.write(data)
+    return sha256, md5
+
+
+def digest_file(file, buffer_size=1024 * 1024, spool_size=8 * 1024 * 1024):
+    """Hashes a whole file object with :func:`hash_file` so it can be
+    uploaded afterwards. Returns the (file, sha256, md5) tuple, where file
+    is rewound to the start. A non-seekable stream cannot be read twice,
+    so it is copied to a temporary file, kept in memory up to spool_size
+    bytes, in the same pass and that file is returned instead.
+
+    :param file: file object
+    :param buffer_size: number of bytes read at a time
+    :param spool_size: maximum size of a non-seekable stream held in memory
+    """
+    try:
+        seekable = file.seekable()
+    except AttributeError:
+        seekable = True
+    if seekable:
+        file.seek(0)
+        sha256, md5 = hash_file(file, None, buffer_size)
+        file.seek(0)
+        return file, sha256, md5
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    sha256, md5 = hash_file(file, spool, buffer_size)
+    spool.seek(0)
+    return spool, sha256, md5
+
+
+def get_file_size(file):
+    """Returns the total size in bytes of a file object, or **None** if
+    the size cannot be determined without reading it (e.g. a
+    non-seekable stream). The current position is preserved.
+
+    :param file: file object
+    """
+    try:
+        position = file.tell()
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not isinstance(size, int):
+        return None
+    return size
+
+
+def bind_arguments(func, *args, **kwargs):
+    """Returns the dict of the arguments a call of func with args and
+    kwargs would receive, by name, whether they are passed by position or
+    by keyword, including those collected by a **kwargs parameter.
+    Raises **TypeError** if func cannot be called with them.
+
+    :param func: callable
+    """
+    signature = inspect.signature(func)
+    arguments = dict(signature.bind(*args, **kwargs).arguments)
+    for parameter in signature.parameters.values():
+        if parameter.kind is parameter.VAR_KEYWORD:
+            arguments.update(arguments.pop(parameter.name, {}))
+    return arguments
+
+
+def in_context(func):
+    """Returns a wrapper of func running it in a copy of the current
+    context, e.g. on a pool thread, so that storage calls it makes are
+    part of the instrumented call that started them.
+
+    :param func: callable
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context cannot be entered by several threads at once.
+        return context.copy().run(func, *args, **kwargs)
+
+    return run
+
+
+def map_concurrently(func, items, max_workers):
+    """Calls func on each item on a pool of at most max_workers threads.
+    Returns the results in the order of items.
+
+    :param func: callable taking a single item
+    :param items: iterable of items
+    :param max_workers: maximum number of threads
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(int(max_workers), len(items))) as executor:
+        return list(executor.map(in_context(func), items))
+
+
+def transfer_many(func, pairs, max_workers):
+    """Calls func(src, dst) for each (src, dst) pair, e.g. a storage's
+    **copy** or **move**, on a pool of at most max_workers threads.
+    Returns a dict mapping each src to **True**, or **False** if it did
+    not exist. Any other error is raised.
+
+    :param func: callable taking the source and destination names
+    :param pairs: iterable of (src, dst) tuples
+    :param max_workers: maximum number of threads
+    """
+    pairs = list(pairs)
+
+    def transfer(pair):
+        try:
+            func(*pair)
+        except FileNotFoundError:
+            return False
+        return True
+
+    results = map_concurrently(transfer, pairs, max_workers)
+    return dict((src, result) for (src, _), result in zip(pairs, results))
+
+
+FileInfo = collections.namedtuple("FileInfo", "name size mtime etag")
+FileInfo.__doc__ = """A stored file, as yielded by **list**.
+
+:ivar name: name of the file, including its folder
+:ivar size: size in bytes
+:ivar mtime: time of last modification, in seconds since the epoch
+:ivar etag: opaque string that changes when the contents change
+"""
+
+
+def list_concurrently(storage, prefixes, max_workers, **kwargs):
+    """Yields the files listed by **storage.list** for each prefix, with
+    the prefixes listed in parallel on at most max_workers threads. Files
+    are yielded as they are listed, in no particular order, holding at
+    most a few pages of them in memory. The prefixes should not overlap,
+    or files will be yielded more than once.
+
+    :param storage: **IFileStorage** instance
+    :param prefixes: iterable of prefixes
+    :param max_workers: maximum number of threads
+    :param kwargs: keyword arguments for **storage.list**
+    """
+    prefixes = list(prefixes)
+    if len(prefixes) <= 1:
+        for prefix in prefixes:
+            yield from storage.list(prefix, **kwargs)
+        return
+
+    done = object()
+    items = queue.Queue(maxsize=1000)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def scan(prefix):
+        try:
+            for info in storage.list(prefix, **kwargs):
+                if not put(info):
+                    return
+        except BaseException as e:
+            put(e)
+        finally:
+            put(done)
+
+    workers = min(int(max_workers), len(prefixes))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for prefix in prefixes:
+            executor.submit(in_context(scan), prefix)
+        try:
+            remaining = len(prefixes)
+            while remaining:
+                item = items.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+
+
+class SaveManyResult(object):
+    """Outcome of a **save_many** call.
+
+    :ivar filenames: resolved filenames, in the order of the input items,
+        with **None** for items that failed
+    :ivar errors: dict mapping the index of each failed item to its exception
+    :ivar elapsed: wall-clock duration in seconds
+    :ivar bytes: total size of the saved files, where it could be determined
+    """
+
+    def __init__(self, filenames, errors, elapsed, bytes):
+        self.filenames = filenames
+        self.errors = errors
+        self.elapsed = elapsed
+        self.bytes = bytes
+
+    @property
+    def files_per_second(self):
+        saved = len(self.filenames) - len(self.errors)
+        return saved / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+
+class PresignedUpload(object):
+    """Upload a client such as a browser can send straight to the bucket,
+    returned by **presigned_upload**.
+
+    :ivar filename: name the file will be stored under
+    :ivar url: URL to send the file to
+    :ivar method: "POST" for a multipart/form-data form, "PUT" to send the
+        file as the request body
+    :ivar fields: form fields to send before the file, for "POST"
+    :ivar headers: request headers to send, for "PUT"
+    """
+
+    def __init__(self, filename, url, method, fields=None, headers=None):
+        self.filename = filename
+        self.url = url
+        self.method = method
+        self.fields = fields or {}
+        self.headers = headers or {}
+
+
+def save_many(storage, items, max_workers):
+    """Saves many files with **storage.save_file** on a pool of at most
+    max_workers threads. Items are consumed lazily, with at most
+    max_workers of them in flight, so the iterable may open its files as
+    it goes. A failing item does not stop the others.
+
+    :param storage: **IFileStorage** instance
+    :param items: iterable of (file, filename) or (file, filename, options)
+        tuples, where options is a dict of keyword arguments for **save_file**
+        e.g. folder, randomize or extensions
+    :param max_workers: maximum number of threads
+    :returns: :class:`SaveManyResult`
+    """
+    max_workers = int(max_workers)
+    filenames = []
+    errors = {}
+    sizes = []
+
+    def save(index, file, filename, options):
+        size = get_file_size(file)
+        filenames[index] = storage.save_file(file, filename, **options)
+        sizes.append(size or 0)
+
+    def collect(done):
+        for future in done:
+            index = pending.pop(future)
+            try:
+                future.result()
+            except Exception as e:
+                errors[index] = e
+
+    start = time.monotonic()
+    pending = {}
+    save = in_context(save)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, item in enumerate(items):
+            if len(pending) >= max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            file, filename = item[:2]
+            options = item[2] if len(item) > 2 else {}
+            filenames.append(None)
+            pending[executor.submit(save, index, file, filename, options)] = index
+        collect(list(pending))
+
+    return SaveManyResult(filenames, errors, time.monotonic() - start, sum(sizes))
+
+
 def read_settings(settings, options, prefix=""):
     """Reads the `settings` dictionnary, and sets defaults using the
     provided list of tuples in `options`.
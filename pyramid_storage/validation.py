@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+
+from .exceptions import ContentNotAllowed
+from .extensions import GROUPS
+
+
+# Number of bytes read from the start of a file; enough for the tar header.
+SAMPLE_SIZE = 4096
+
+_ZIP = (((0, b"PK\x03\x04"),), ((0, b"PK\x05\x06"),))
+_OLE = (((0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"),),)
+_GZIP = (((0, b"\x1f\x8b"),),)
+_JPEG = (((0, b"\xff\xd8\xff"),),)
+_ASF = (((0, b"\x30\x26\xb2\x75\x8e\x66\xcf\x11"),),)
+_AVI = (((0, b"RIFF"), (8, b"AVI ")),)
+_MP4 = (((4, b"ftyp"),),)
+_EXE = (((0, b"MZ"),),)
+
+# Each extension maps to a tuple of signatures, one of which must match.
+# A signature is a tuple of (offset, magic) pairs that must all match.
+SIGNATURES = {
+    # images
+    "jpg": _JPEG,
+    "jpe": _JPEG,
+    "jpeg": _JPEG,
+    "png": (((0, b"\x89PNG\r\n\x1a\n"),),),
+    "gif": (((0, b"GIF87a"),), ((0, b"GIF89a"),)),
+    "bmp": (((0, b"BM"),),),
+    "tiff": (((0, b"II*\x00"),), ((0, b"MM\x00*"),)),
+    # documents
+    "pdf": (((0, b"%PDF-"),),),
+    "rtf": (((0, b"{\\rtf"),),),
+    "doc": _OLE,
+    "xls": _OLE,
+    "docx": _ZIP,
+    "xlsx": _ZIP,
+    "odf": _ZIP,
+    "ods": _ZIP,
+    "gnumeric": _GZIP,
+    "abw": _GZIP,
+    # audio
+    "wav": (((0, b"RIFF"), (8, b"WAVE")),),
+    "mp3": (((0, b"ID3"),), ((0, b"\xff\xfb"),), ((0, b"\xff\xf3"),), ((0, b"\xff\xf2"),)),
+    "aac": (((0, b"\xff\xf1"),), ((0, b"\xff\xf9"),), ((0, b"ADIF"),)),
+    "ogg": (((0, b"OggS"),),),
+    "oga": (((0, b"OggS"),),),
+    "flac": (((0, b"fLaC"),),),
+    # video
+    "mpeg": (((0, b"\x00\x00\x01\xba"),), ((0, b"\x00\x00\x01\xb3"),)),
+    "3gp": _MP4,
+    "mp4": _MP4,
+    "avi": _AVI,
+    "divx": _AVI,
+    "dvr": _ASF,
+    "wmv": _ASF,
+    "flv": (((0, b"FLV"),),),
+    # data
+    "plist": (((0, b"bplist00"),),),
+    # archives
+    "gz": _GZIP,
+    "tgz": _GZIP,
+    "bz2": (((0, b"BZh"),),),
+    "zip": _ZIP,
+    "tar": (((257, b"ustar"),),),
+    "txz": (((0, b"\xfd7zXZ\x00"),),),
+    "7z": (((0, b"7z\xbc\xaf\x27\x1c"),),),
+    # executables
+    "exe": _EXE,
+    "dll": _EXE,
+    "so": (((0, b"\x7fELF"),),),
+}
+
+# Extensions accepted if the sample looks like text, in addition to any
+# signatures above.
+TEXT_EXTENSIONS = frozenset(
+    GROUPS["text"]
+    + GROUPS["data"]
+    + GROUPS["scripts"]
+    + ("svg", "abw", "gnumeric", "rst", "md", "html", "htm", "css")
+)
+
+_BOMS = (b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")
+_BINARY_BYTES = frozenset(range(32)) - frozenset(b"\t\n\v\f\r\x1b")
+
+
+def is_text(sample):
+    """Checks if a sample of bytes looks like text.
+
+    :param sample: bytes from the start of a file
+    """
+    if sample.startswith(_BOMS):
+        return True
+    return not _BINARY_BYTES.intersection(sample)
+
+
+def matches(ext, sample):
+    """Checks if a sample from the start of a file matches an extension.
+    Returns **None** if the extension has no known signature.
+
+    :param ext: extension, e.g. "jpg"
+    :param sample: bytes from the start of a file
+    """
+    signatures = SIGNATURES.get(ext, ())
+    for signature in signatures:
+        if all(sample.startswith(magic, offset) for offset, magic in signature):
+            return True
+    if ext in TEXT_EXTENSIONS:
+        if not is_text(sample):
+            return False
+        return ext != "svg" or b"<svg" in sample.lower()
+    if signatures:
+        return False
+    return None
+
+
+def sniff(file, filename, extensions=(), sample_size=SAMPLE_SIZE):
+    """Checks the first bytes of a file against the signatures of the
+    extensions in the same groups as its extension, e.g. a PNG image
+    named "photo.jpg" is accepted if "png" is one of the extensions.
+    Files with an extension of unknown format are accepted.
+
+    Returns the file object to read the upload from. This is file itself
+    if it is seekable, otherwise a wrapper returning the bytes already
+    read followed by the rest of file.
+
+    :param file: file object
+    :param filename: name of file
+    :param extensions: iterable of allowed extensions, empty for any
+    :param sample_size: number of bytes to read
+    :raises ContentNotAllowed: if the contents do not match
+    """
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if ext not in SIGNATURES and ext not in TEXT_EXTENSIONS:
+        return file
+
+    candidates = set()
+    for name, group in GROUPS.items():
+        if name not in ("default", "any") and ext in group:
+            candidates.update(group)
+    if extensions:
+        candidates.intersection_update(extensions)
+    candidates.add(ext)
+
+    sample, file = peek(file, sample_size)
+    if any(matches(candidate, sample) for candidate in candidates):
+        return file
+    raise ContentNotAllowed()
+
+
+def peek(file, size):
+    """Reads up to size bytes from the start of a seekable file, or from
+    the current position of a non-seekable stream, without consuming them.
+    Returns the bytes and the file object to read from afterwards.
+
+    :param file: file object
+    :param size: number of bytes to read
+    """
+    try:
+        seekable = file.seekable()
+    except AttributeError:
+        seekable = True
+    if seekable:
+        try:
+            file.seek(0)
+            sample = file.read(size)
+            file.seek(0)
+            return sample, file
+        except (OSError, ValueError):
+            pass
+    sample = file.read(size)
+    return sample, PrefixedStream(sample, file)
+
+
+class PrefixedStream(io.RawIOBase):
+    """Non-seekable stream returning prefix followed by the rest of file.
+    It can be rewound with **seek(0)** while no more than prefix has been
+    read.
+
+    :param prefix: bytes already read from file
+    :param file: file object
+    """
+
+    def __init__(self, prefix, file):
+        self.prefix = prefix
+        self.file = file
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position < len(self.prefix):
+            data = self.prefix[self.position : self.position + len(buffer)]
+        else:
+            data = self.file.read(len(buffer))
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("seek")
+        if self.position > len(self.prefix) or not 0 <= offset <= len(self.prefix):
+            raise io.UnsupportedOperation("seek")
+        self.position = offset
+        return offset
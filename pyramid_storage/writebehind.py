@@ -0,0 +1,556 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import asbool
+from zope.interface import implementer
+
+from . import utils, validation
+from .exceptions import FileNotAllowed
+from .extensions import get_policy
+from .interfaces import IFileStorage
+from .local import TEMP_PREFIX, TEMP_SUFFIX, LocalFileStorage, _fsync_dir
+from .registry import register_file_storage_impl, storage_from_settings
+
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+log = logging.getLogger(__name__)
+
+
+def includeme(config):
+    impl = WriteBehindFileStorage.from_settings(config.registry.settings, prefix="storage.")
+
+    register_file_storage_impl(config, impl)
+
+
+@implementer(IFileStorage)
+class WriteBehindFileStorage(object):
+    """Saves files to local disk and uploads them to a remote storage, e.g.
+    **S3FileStorage** or **GoogleCloudStorage**, in the background.
+
+    :meth:`save_file` resolves the name the file will have in the remote
+    storage, writes the file to the spool directory under that name and
+    records the upload in a journal, then returns. Worker threads, or a
+    separate process running :meth:`run_worker`, upload journalled files
+    and remove them from the spool once they are stored. A failed upload is
+    retried later, waiting twice as long each time up to **max_backoff**
+    seconds. The journal is a directory of small files, one per pending
+    upload, so uploads left over by a crash or restart are picked up again.
+    Workers lock each entry while uploading it, so several processes can
+    share the spool.
+
+    Until it is uploaded a file is found by :meth:`exists` and
+    :meth:`open`, and :meth:`url` points to the spool if **base_url** is
+    set.
+
+    All other attributes are those of the remote storage.
+
+    :param remote: **IFileStorage** instance the files are uploaded to
+    :param path: directory holding the spool and the journal
+    :param threads: number of upload threads started in each process; 0 to
+        leave uploads to :meth:`run_worker`
+    :param base_url: base URL of the spool, for files not uploaded yet
+    :param fsync: flush spooled files and journal entries to disk
+    :param max_backoff: maximum seconds between two attempts of an upload
+    :param poll_interval: seconds between two scans of the journal
+    """
+
+    @classmethod
+    def from_settings(cls, settings, prefix):
+        """Returns a new instance from config settings. The remote storage
+        is configured by its own settings, e.g. **storage.aws.***.
+
+        :param settings: dict(-like) of settings
+        :param prefix: prefix separating these settings
+        """
+        options = (
+            ("writebehind.remote", True, None),
+            ("writebehind.path", True, None),
+            ("writebehind.threads", False, 2),
+            ("writebehind.base_url", False, ""),
+            ("writebehind.fsync", False, True),
+            ("writebehind.max_backoff", False, 3600),
+            ("writebehind.poll_interval", False, 5),
+        )
+        kwargs = utils.read_settings(settings, options, prefix)
+        remote = kwargs.pop("writebehind.remote")
+        if remote not in ("s3", "gcloud"):
+            raise ConfigurationError('%swritebehind.remote must be "s3" or "gcloud"' % prefix)
+        kwargs = dict((k.replace("writebehind.", ""), v) for k, v in kwargs.items())
+        return cls(storage_from_settings(remote, settings, prefix), **kwargs)
+
+    def __init__(
+        self,
+        remote,
+        path,
+        threads=2,
+        base_url="",
+        fsync=True,
+        max_backoff=3600,
+        poll_interval=5,
+    ):
+        self.remote = remote
+        self.path = path
+        self.threads = int(threads)
+        self.fsync = asbool(fsync)
+        self.max_backoff = float(max_backoff)
+        self.poll_interval = float(poll_interval)
+        self.spool = LocalFileStorage(
+            os.path.join(path, "files"), base_url=base_url, extensions="any", fsync=self.fsync
+        )
+        self.journal_path = os.path.join(path, "journal")
+        self.locks_path = os.path.join(path, "locks")
+        os.makedirs(self.journal_path, exist_ok=True)
+        os.makedirs(self.locks_path, exist_ok=True)
+
+        self._workers = []
+        self._workers_pid = None
+        self._workers_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def url(self, filename):
+        """Returns entire URL of the filename, in the spool if it is not
+        uploaded yet and the spool has a base_url
+
+        :param filename: base name of file
+        """
+        if self.spool.base_url and self.is_pending(filename):
+            return self.spool.url(filename)
+        return self.remote.url(filename)
+
+    def is_pending(self, filename):
+        """Returns **True** if the file is waiting to be uploaded.
+
+        :param filename: base name of file
+        """
+        return os.path.exists(self._entry_path(filename))
+
+    def exists(self, filename, *args, **kwargs):
+        """Checks if file exists, waiting to be uploaded or in the remote
+        storage.
+
+        :param filename: base name of file
+        """
+        return self.is_pending(filename) or self.remote.exists(filename, *args, **kwargs)
+
+    def exists_many(self, filenames, **kwargs):
+        """Checks if several files exist. Files that are not waiting to be
+        uploaded are checked with the remote storage's **exists_many**.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        missing = [filename for filename in filenames if not self.is_pending(filename)]
+        results = dict((filename, True) for filename in filenames)
+        if missing:
+            results.update(self.remote.exists_many(missing, **kwargs))
+        return results
+
+    def open(self, filename, mode="rb"):
+        """Opens a stored file for reading, from the spool if it is not
+        uploaded yet.
+
+        :param filename: base name of file
+        :param mode: only "rb" is supported
+        :returns: seekable file object
+        """
+        if self.is_pending(filename):
+            try:
+                return self.spool.open(filename, mode)
+            except FileNotFoundError:
+                # Uploaded in the meantime.
+                pass
+        return self.remote.open(filename, mode)
+
+    def delete(self, filename, *args, **kwargs):
+        """Deletes the filename, cancelling its upload if it is pending.
+
+        :param filename: base name of file
+        """
+        self._cancel(filename)
+        return self.remote.delete(filename, *args, **kwargs)
+
+    def delete_many(self, filenames, **kwargs):
+        """Deletes several files, cancelling the pending uploads. Returns
+        the result of the remote storage's **delete_many**.
+
+        :param filenames: iterable of base names of files
+        """
+        filenames = list(filenames)
+        for filename in filenames:
+            self._cancel(filename)
+        return self.remote.delete_many(filenames, **kwargs)
+
+    def _cancel(self, filename):
+        """Removes a pending upload, waiting for it to finish if a worker
+        is uploading it, so it cannot be stored after it is deleted."""
+        if not self.is_pending(filename):
+            return
+        entry_path = self._entry_path(filename)
+        with _EntryLock(self._lock_path(entry_path, "upload"), blocking=True, remove=True):
+            with _EntryLock(self._lock_path(entry_path, "entry"), blocking=True):
+                if os.path.exists(entry_path):
+                    self._remove_entry(entry_path, filename)
+
+    def save(self, fs, *args, **kwargs):
+        """Saves contents of a **cgi.FieldStorage** object. Takes the same
+        arguments as :meth:`save_file`.
+
+        :returns: modified filename
+        """
+        return self.save_file(fs.file, fs.filename, *args, **kwargs)
+
+    def save_filename(self, filename, *args, **kwargs):
+        """Saves a filename in local filesystem. Takes the same arguments as
+        :meth:`save_file`.
+
+        :returns: modified filename
+        """
+        with open(filename, "rb") as file:
+            return self.save_file(file, filename, *args, **kwargs)
+
+    def save_many(self, items):
+        """Saves many files in parallel on up to **max_workers** threads of
+        the remote storage.
+
+        :param items: iterable of (file, filename) or (file, filename, options)
+            tuples, where options is a dict of keyword arguments for
+            :meth:`save_file`
+        :returns: :class:`pyramid_storage.utils.SaveManyResult`
+        """
+        return utils.save_many(self, items, self.remote.max_workers)
+
+    def save_file(
+        self,
+        file,
+        filename,
+        folder=None,
+        randomize=False,
+        extensions=None,
+        content_addressed=False,
+        replace=False,
+        **kwargs,
+    ):
+        """Writes a file object to the spool and queues its upload. Takes
+        the arguments of the remote storage's **save_file**, which must be
+        JSON serializable. Returns the name the file is stored under in the
+        remote storage.
+
+        :returns: modified filename
+        """
+        if not self.remote.filename_allowed(filename, extensions):
+            raise FileNotAllowed()
+
+        if getattr(self.remote, "sniff_content", False):
+            policy = get_policy(extensions, self.remote.extension_policy)
+            file = validation.sniff(file, filename, policy.extensions)
+
+        if content_addressed:
+            # The name is only known once the file is spooled, but the
+            # contents under it are always the same.
+            name = self.spool.save_file(file, filename, folder=folder, content_addressed=True)
+            options = dict(kwargs, content_addressed=True)
+            with _EntryLock(self._lock_path(self._entry_path(name), "entry"), blocking=True):
+                self._queue(name, options, extensions)
+        else:
+            if replace:
+                name = utils.resolve_filename(filename, folder, randomize)
+            else:
+                name = self.remote.reserve_filename(filename, folder, randomize, extensions)
+            spool_folder, _, basename = name.rpartition("/")
+            options = dict(kwargs, replace=replace)
+            # A remote keeping files already stored under a name reserves
+            # nothing, and must not fail, to be retried forever, on one.
+            if not getattr(self.remote, "keeps_existing_files", False):
+                options["_reserved"] = True
+            entry_path = self._entry_path(name)
+            # A worker uploading earlier contents of the file cannot remove
+            # the new ones meanwhile.
+            with _EntryLock(self._lock_path(entry_path, "entry"), blocking=True):
+                self.spool.save_file(file, basename, folder=spool_folder or None, _reserved=True)
+                self._queue(name, options, extensions)
+
+        self._ensure_workers()
+        self._wakeup.set()
+        return name
+
+    def _queue(self, name, options, extensions):
+        options["extensions"] = extensions
+        # A new generation tells workers uploading earlier contents that
+        # the entry has been replaced.
+        entry = {
+            "name": name,
+            "generation": uuid.uuid4().hex,
+            "options": options,
+            "attempts": 0,
+            "due": 0,
+        }
+        try:
+            self._write_entry(name, entry)
+        except BaseException:
+            self.spool.delete(name)
+            raise
+
+    def process_pending(self):
+        """Uploads the files in the journal that are due, skipping those
+        another worker is uploading. Returns the number of files uploaded.
+        """
+        uploaded = 0
+        now = time.time()
+        for entry_name in sorted(os.listdir(self.journal_path)):
+            if self._stopped.is_set():
+                break
+            if not entry_name.endswith(".json"):
+                continue
+            entry_path = os.path.join(self.journal_path, entry_name)
+            with _EntryLock(self._lock_path(entry_path, "upload"), remove=True) as claimed:
+                if not claimed:
+                    continue
+                with _EntryLock(self._lock_path(entry_path, "entry"), blocking=True):
+                    entry = self._read_entry(entry_path)
+                    if entry is None or entry["due"] > now:
+                        continue
+                    try:
+                        # The open file keeps these contents even if the
+                        # file is saved again while it is uploaded.
+                        file = self.spool.open(entry["name"])
+                    except FileNotFoundError:
+                        log.error(
+                            "Spooled file of %s is missing, dropping its upload", entry["name"]
+                        )
+                        self._remove_entry(entry_path, entry["name"])
+                        continue
+                with file:
+                    if self._upload(file, entry_path, entry):
+                        uploaded += 1
+        return uploaded
+
+    def run_worker(self):
+        """Uploads journalled files until :meth:`stop` is called, scanning
+        the journal every **poll_interval** seconds or when a file is
+        saved by this process. Run it in a separate process to take uploads
+        out of the web workers, e.g. with ``threads = 0`` and
+        ``python -m pyramid_storage.writebehind development.ini``.
+        """
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self.process_pending()
+            except Exception:
+                log.exception("Could not process the upload journal")
+            self._wakeup.wait(self.poll_interval)
+
+    def flush(self, timeout=None):
+        """Waits until the journal is empty. Returns **False** if files are
+        still pending after timeout seconds.
+
+        :param timeout: maximum number of seconds to wait
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while any(not name.startswith(TEMP_PREFIX) for name in os.listdir(self.journal_path)):
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self._wakeup.set()
+            time.sleep(0.01)
+        return True
+
+    def stop(self):
+        """Stops the worker threads once their current upload is done."""
+        self._stopped.set()
+        self._wakeup.set()
+        for worker in self._workers:
+            worker.join()
+
+    def _ensure_workers(self):
+        """Starts the upload threads of this process. Threads are not
+        inherited across a fork: a child process starts its own."""
+        pid = os.getpid()
+        if not self.threads or self._workers_pid == pid:
+            return
+        with self._workers_lock:
+            if self._workers_pid == pid:
+                return
+            self._workers = [
+                threading.Thread(
+                    target=self.run_worker, name="pyramid_storage-writebehind", daemon=True
+                )
+                for _ in range(self.threads)
+            ]
+            for worker in self._workers:
+                worker.start()
+            self._workers_pid = pid
+
+    def _upload(self, file, entry_path, entry):
+        name = entry["name"]
+        folder, _, basename = name.rpartition("/")
+        try:
+            self.remote.save_file(file, basename, folder=folder or None, **entry["options"])
+        except FileNotAllowed:
+            log.error("%s was rejected by the remote storage, dropping its upload", name)
+            self._finish(entry_path, entry)
+            return False
+        except Exception:
+            entry["attempts"] += 1
+            backoff = min(2 ** entry["attempts"], self.max_backoff)
+            entry["due"] = time.time() + backoff
+            log.exception("Could not upload %s, retrying in %d seconds", name, backoff)
+            with _EntryLock(self._lock_path(entry_path, "entry"), blocking=True):
+                current = self._read_entry(entry_path)
+                if current is not None and current["generation"] == entry["generation"]:
+                    self._write_entry(name, entry)
+            return False
+        self._finish(entry_path, entry)
+        return True
+
+    def _finish(self, entry_path, entry):
+        """Removes an entry once its upload is done, unless the file was
+        saved again meanwhile."""
+        with _EntryLock(self._lock_path(entry_path, "entry"), blocking=True):
+            current = self._read_entry(entry_path)
+            if current is not None and current["generation"] == entry["generation"]:
+                self._remove_entry(entry_path, entry["name"])
+
+    def _entry_path(self, filename):
+        digest = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+        return os.path.join(self.journal_path, digest + ".json")
+
+    def _lock_path(self, entry_path, kind):
+        """Returns the path of a lock file covering the entry. Entries are
+        replaced rather than written in place, so they are not locked
+        themselves. The "entry" locks, only held while an entry is read or
+        written, are shared by the entries in 256 lock files which are
+        never removed. An "upload" lock is held for a whole upload, so
+        each entry has its own, removed once released."""
+        digest = os.path.splitext(os.path.basename(entry_path))[0]
+        if kind == "entry":
+            digest = digest[:2]
+        return os.path.join(self.locks_path, digest + "." + kind)
+
+    def _read_entry(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_entry(self, filename, entry):
+        """Writes a journal entry atomically."""
+        temp_path = os.path.join(self.journal_path, TEMP_PREFIX + uuid.uuid4().hex + TEMP_SUFFIX)
+        try:
+            with open(temp_path, "x") as f:
+                json.dump(entry, f)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(temp_path, self._entry_path(filename))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if self.fsync:
+            _fsync_dir(self.journal_path)
+
+    def _remove_entry(self, entry_path, filename):
+        # The entry goes first, so a crash leaves an orphan spooled file
+        # rather than an entry without its file.
+        os.remove(entry_path)
+        try:
+            os.remove(self.spool.path(filename))
+        except FileNotFoundError:
+            pass
+
+
+class _EntryLock(object):
+    """Exclusive lock on a lock file, created if needed. Evaluates to
+    **False** if, unless blocking, it is already locked. With remove, the
+    lock file is removed before it is released; whoever opened it
+    meanwhile finds out and opens the new one."""
+
+    # Locks held by this process, as flock() does not exclude threads
+    # sharing a file descriptor.
+    _held = set()
+    _held_lock = threading.Condition()
+
+    def __init__(self, path, blocking=False, remove=False):
+        self.path = path
+        self.blocking = blocking
+        self.remove = remove
+        self.file = None
+        self.locked = False
+
+    def __enter__(self):
+        with self._held_lock:
+            while self.path in self._held:
+                if not self.blocking:
+                    return False
+                self._held_lock.wait()
+            self._held.add(self.path)
+        self.locked = True
+        while True:
+            self.file = open(self.path, "ab")
+            if fcntl is None:
+                return True
+            flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.file.fileno(), flags)
+            except BlockingIOError:
+                self.file.close()
+                self.file = None
+                return False
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                    return True
+            except FileNotFoundError:
+                pass
+            # Removed by the previous holder: lock the file now in its place.
+            self.file.close()
+            self.file = None
+
+    def __exit__(self, *exc_info):
+        if self.file is not None:
+            if self.remove:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    # Missing, or still open elsewhere on Windows.
+                    pass
+            self.file.close()
+        if self.locked:
+            with self._held_lock:
+                self._held.discard(self.path)
+                self._held_lock.notify_all()
+
+
+def main(argv=sys.argv):
+    """Runs the upload worker of the storage configured by a PasteDeploy
+    config file, e.g. ``python -m pyramid_storage.writebehind
+    development.ini``."""
+    from pyramid.paster import bootstrap, setup_logging
+
+    if len(argv) != 2:
+        sys.exit("usage: %s config_uri" % os.path.basename(argv[0]))
+    setup_logging(argv[1])
+    with bootstrap(argv[1]) as env:
+        storage = env["registry"].getUtility(IFileStorage)
+        storage.run_worker()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
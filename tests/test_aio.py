@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def test_save_file(tmp_path):
+    from pyramid_storage import aio, local
+
+    s = aio.AsyncFileStorage(local.LocalFileStorage(str(tmp_path), extensions="images"))
+
+    name = asyncio.run(s.save_file(BytesIO(b"test"), "test.jpg"))
+    assert name == "test.jpg"
+    assert (tmp_path / "test.jpg").read_bytes() == b"test"
+    s.close()
+
+
+def test_exists_and_delete(tmp_path):
+    from pyramid_storage import aio, local
+
+    (tmp_path / "test.jpg").write_text("test")
+    s = aio.AsyncFileStorage(local.LocalFileStorage(str(tmp_path)))
+
+    async def run():
+        return await asyncio.gather(s.exists("test.jpg"), s.exists("missing.jpg"))
+
+    assert asyncio.run(run()) == [True, False]
+    assert asyncio.run(s.delete("test.jpg"))
+    assert not (tmp_path / "test.jpg").exists()
+    s.close()
+
+
+def test_calls_counted_in_request_totals(tmp_path):
+    from pyramid_storage import aio, instrumentation, local
+
+    s = aio.AsyncFileStorage(local.LocalFileStorage(str(tmp_path)))
+    totals = instrumentation.StorageTotals()
+
+    async def run():
+        instrumentation._totals.set(totals)
+        await s.exists("test.jpg")
+
+    asyncio.run(run())
+    assert totals.calls == 1
+    s.close()
+
+
+def test_calls_run_on_bounded_pool():
+    import threading
+
+    from pyramid_storage import aio
+
+    storage = mock.Mock()
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def exists(name):
+        with lock:
+            active.append(name)
+            peak.append(len(active))
+        threading.Event().wait(0.01)
+        with lock:
+            active.remove(name)
+        return True
+
+    storage.exists.side_effect = exists
+    s = aio.AsyncFileStorage(storage, max_workers=2)
+
+    async def run():
+        return await asyncio.gather(*(s.exists(str(i)) for i in range(10)))
+
+    assert asyncio.run(run()) == [True] * 10
+    assert max(peak) <= 2
+    s.close()
+
+
+def test_url():
+    from pyramid_storage import aio, local
+
+    s = aio.AsyncFileStorage(local.LocalFileStorage("", "http://localhost/"))
+    assert s.url("test.jpg") == "http://localhost/test.jpg"
+
+
+def test_includeme():
+    from pyramid.testing import DummyRequest, testConfig
+
+    settings = {
+        "storage.base_path": "uploads",
+        "storage.async.max_workers": "4",
+    }
+
+    with testConfig(settings=settings) as config:
+        config.include("pyramid_storage")
+        config.include("pyramid_storage.aio")
+
+        req = DummyRequest()
+        req.registry = config.registry
+
+        from pyramid_storage.registry import get_async_file_storage_impl, get_file_storage_impl
+
+        impl = get_async_file_storage_impl(req)
+        assert impl.storage is get_file_storage_impl(req)
+        assert impl.max_workers == 4
+
+
+def test_includeme_without_backend():
+    from pyramid.testing import testConfig
+
+    with testConfig(settings={}) as config:
+        with pytest.raises(pyramid_exceptions.ConfigurationError):
+            config.include("pyramid_storage.aio")
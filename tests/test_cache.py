@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def _make_storage(tmp_path, cache=None):
+    from pyramid_storage import cache as cache_module
+    from pyramid_storage import local
+
+    storage = local.LocalFileStorage(str(tmp_path), extensions="images")
+    storage.exists = mock.Mock(wraps=storage.exists)
+    return cache_module.CachedFileStorage(storage, cache or cache_module.MemoryCache())
+
+
+def test_cache_from_settings(tmp_path):
+    from pyramid_storage import cache
+
+    assert cache.cache_from_settings({}, "storage.") is None
+
+    c = cache.cache_from_settings(
+        {"storage.cache.backend": "memory", "storage.cache.max_entries": "5"}, "storage."
+    )
+    assert isinstance(c, cache.MemoryCache)
+    assert c.max_entries == 5
+
+    c = cache.cache_from_settings(
+        {"storage.cache.backend": "file", "storage.cache.path": str(tmp_path)}, "storage."
+    )
+    assert isinstance(c, cache.FileCache)
+
+
+def test_cache_from_settings_invalid():
+    from pyramid_storage import cache
+
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        cache.cache_from_settings({"storage.cache.backend": "redis"}, "storage.")
+
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        cache.cache_from_settings({"storage.cache.backend": "file"}, "storage.")
+
+
+def test_memory_cache_expires():
+    from pyramid_storage import cache
+
+    c = cache.MemoryCache(ttl=10)
+    with mock.patch("time.monotonic", return_value=100):
+        c.set("a", False)
+        assert c.get("a") is False
+    with mock.patch("time.monotonic", return_value=111):
+        assert c.get("a") is None
+
+
+def test_memory_cache_evicts_least_recently_used():
+    from pyramid_storage import cache
+
+    c = cache.MemoryCache(max_entries=2)
+    c.set("a", True)
+    c.set("b", True)
+    c.get("a")
+    c.set("c", True)
+    assert c.get("a") is True
+    assert c.get("b") is None
+    assert c.get("c") is True
+
+
+def test_file_cache(tmp_path):
+    from pyramid_storage import cache
+
+    c = cache.FileCache(str(tmp_path), ttl=10)
+    c.set("a", True)
+    c.set("b", False)
+    assert c.get("a") is True
+    assert c.get("b") is False
+    assert c.get("c") is None
+
+    # another process sees the same entries
+    assert cache.FileCache(str(tmp_path)).get("a") is True
+
+    c.delete("a")
+    assert c.get("a") is None
+
+    with mock.patch("time.time", return_value=os_time_after(tmp_path, 11)):
+        assert c.get("b") is None
+
+
+def os_time_after(path, seconds):
+    import os
+
+    return max(e.stat().st_mtime for e in os.scandir(str(path))) + seconds
+
+
+def test_file_cache_prune(tmp_path):
+    import os
+    import time
+
+    from pyramid_storage import cache
+
+    c = cache.FileCache(str(tmp_path), max_entries=2)
+    now = time.time()
+    for index, key in enumerate("abc"):
+        c.set(key, True)
+        os.utime(c._path(key), (now + index, now + index))
+    c.prune()
+    assert c.get("a") is None
+    assert len(os.listdir(str(tmp_path))) == 2
+
+
+def test_exists_caches_positive_and_negative(tmp_path):
+    s = _make_storage(tmp_path)
+    (tmp_path / "test.jpg").write_text("test")
+
+    assert s.exists("test.jpg")
+    assert s.exists("test.jpg")
+    assert not s.exists("missing.jpg")
+    assert not s.exists("missing.jpg")
+    assert s.storage.exists.call_count == 2
+
+
+def test_save_file_updates_cache(tmp_path):
+    s = _make_storage(tmp_path)
+
+    assert not s.exists("test.jpg")
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+    assert s.exists(name)
+    assert s.storage.exists.call_count == 1
+
+
+def test_delete_invalidates_cache(tmp_path):
+    s = _make_storage(tmp_path)
+    (tmp_path / "test.jpg").write_text("test")
+
+    assert s.exists("test.jpg")
+    s.delete("test.jpg")
+    calls = s.storage.exists.call_count
+    assert not s.exists("test.jpg")
+    assert s.storage.exists.call_count == calls + 1
+
+
+def test_delete_many_invalidates_cache(tmp_path):
+    s = _make_storage(tmp_path)
+    (tmp_path / "test.jpg").write_text("test")
+
+    assert s.exists("test.jpg")
+    s.delete_many(["test.jpg"])
+    assert not s.exists("test.jpg")
+
+
+def test_move_invalidates_cache(tmp_path):
+    s = _make_storage(tmp_path)
+    (tmp_path / "a.jpg").write_text("test")
+
+    assert s.exists("a.jpg")
+    assert not s.exists("b.jpg")
+    s.move("a.jpg", "b.jpg")
+    assert not s.exists("a.jpg")
+    assert s.exists("b.jpg")
+
+
+def test_exists_many_fetches_only_misses(tmp_path):
+    s = _make_storage(tmp_path)
+    (tmp_path / "a.jpg").write_text("test")
+    s.storage.exists_many = mock.Mock(wraps=s.storage.exists_many)
+
+    assert s.exists("a.jpg")
+    assert s.exists_many(["a.jpg", "b.jpg"]) == {"a.jpg": True, "b.jpg": False}
+    s.storage.exists_many.assert_called_once_with(["b.jpg"])
+    calls = s.storage.exists.call_count
+    assert not s.exists("b.jpg")
+    assert s.storage.exists.call_count == calls
+
+
+def test_save_many_updates_cache(tmp_path):
+    s = _make_storage(tmp_path)
+
+    assert not s.exists("test.jpg")
+    result = s.save_many([(BytesIO(b"test"), "test.jpg")])
+    assert s.exists(result.filenames[0])
+    assert s.storage.exists.call_count == 1
+
+
+def test_complete_upload_updates_cache():
+    from pyramid_storage import cache
+
+    storage = mock.Mock()
+    storage.exists.return_value = False
+    storage.complete_upload.return_value = "test.jpg"
+    s = cache.CachedFileStorage(storage, cache.MemoryCache())
+
+    assert not s.exists("test.jpg")
+    assert s.complete_upload("test.jpg", max_size=100) == "test.jpg"
+    assert s.exists("test.jpg")
+    storage.complete_upload.assert_called_once_with("test.jpg", max_size=100)
+
+
+def test_bucket_name_by_position_or_keyword():
+    from pyramid_storage import cache
+
+    class Storage(object):
+        def __init__(self):
+            self.calls = 0
+
+        def exists(self, filename, bucket_name=None):
+            self.calls += 1
+            return False
+
+        def save_file(self, file, filename, folder=None, bucket_name=None):
+            return filename
+
+    storage = Storage()
+    s = cache.CachedFileStorage(storage, cache.MemoryCache())
+
+    assert not s.exists("test.jpg", "other")
+    assert not s.exists("test.jpg", bucket_name="other")
+    assert storage.calls == 1
+
+    assert s.save_file(BytesIO(b"test"), "test.jpg", None, "other") == "test.jpg"
+    assert s.exists("test.jpg", bucket_name="other")
+    assert not s.exists("test.jpg")
+
+
+def test_default_bucket_named_or_not():
+    from pyramid_storage import cache
+
+    storage = mock.Mock(bucket_name="default")
+    storage.exists.return_value = True
+    s = cache.CachedFileStorage(storage, cache.MemoryCache())
+
+    assert s.exists("test.jpg", bucket_name="default")
+    s.delete("test.jpg")
+    storage.exists.return_value = False
+    assert not s.exists("test.jpg", bucket_name="default")
+    assert storage.exists.call_count == 2
+
+
+def test_delegates_other_attributes(tmp_path):
+    s = _make_storage(tmp_path)
+    assert s.url("test.jpg") == s.storage.url("test.jpg")
+    assert s.filename_allowed("test.jpg")
@@ -32,3 +32,44 @@ def test_resolve_extensions_if_mix():
     assert "wmv" in extensions
     assert "txt" in extensions
     assert "doc" in extensions
+
+
+def test_policy_filename_allowed():
+    from pyramid_storage.extensions import ExtensionPolicy
+
+    policy = ExtensionPolicy(("jpg", ".PNG"))
+    assert policy.filename_allowed("test.jpg")
+    assert policy.filename_allowed("folder/TEST.PNG")
+    assert not policy.filename_allowed("test.gif")
+    assert not policy.filename_allowed("jpg")
+    assert not policy.filename_allowed(".jpg")
+
+
+def test_policy_multi_dot_extensions():
+    from pyramid_storage.extensions import ExtensionPolicy
+
+    policy = ExtensionPolicy(("tar.gz", "txt"))
+    assert policy.filename_allowed("backup.tar.gz")
+    assert policy.filename_allowed("backup.2024.tar.gz")
+    assert policy.filename_allowed("notes.v2.txt")
+    assert not policy.filename_allowed("backup.gz")
+    assert not policy.extension_allowed("gz")
+
+
+def test_policy_empty_allows_any():
+    from pyramid_storage.extensions import ExtensionPolicy
+
+    policy = ExtensionPolicy(())
+    assert policy.filename_allowed("test")
+    assert policy.extension_allowed(".exe")
+
+
+def test_get_policy_is_cached():
+    from pyramid_storage.extensions import get_policy
+
+    default = get_policy("images")
+    assert get_policy(None, default) is default
+    assert get_policy("images") is default
+    assert get_policy(["gif", "jpg"]) is get_policy(("jpg", "gif"))
+    assert get_policy(default) is default
+    assert get_policy("any").filename_allowed("test.exe")
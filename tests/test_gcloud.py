@@ -61,6 +61,16 @@ def test_extension_not_allowed_if_allowed_if_not_dotted():
     assert not g.extension_allowed("jpg", ("gif",))
 
 
+def test_extension_allowed_if_empty_tuple():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+    assert g.filename_allowed("test.exe", ())
+    assert not g.filename_allowed("test.exe")
+
+
 def test_file_allowed():
     from pyramid_storage import gcloud
 
@@ -135,6 +145,32 @@ def test_save_file():
     assert name == "test.jpg"
 
 
+def test_save_file_content_addressed():
+    import hashlib
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+    name = hashlib.sha256(b"test").hexdigest() + ".jpg"
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", _get_mock_gcloud_connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            with mock.patch.object(g, "exists", return_value=False):
+                assert g.save_file(BytesIO(b"test"), "test.jpg", content_addressed=True) == name
+            mocked_new_blob.assert_called_once_with(name, mock.ANY)
+            assert mocked_new_blob.return_value.md5_hash == "CY9rzUYh03PK3k6DJie09g=="
+            assert mocked_new_blob.return_value.upload_from_file.called
+
+            mocked_new_blob.reset_mock()
+            with mock.patch.object(g, "exists", return_value=True):
+                assert g.save_file(BytesIO(b"test"), "test.jpg", content_addressed=True) == name
+            assert not mocked_new_blob.called
+
+
 def test_save_file_with_uniform_bucket_level_access_disabled():
     from pyramid_storage import gcloud
 
@@ -232,7 +268,11 @@ def test_save_with_content_type():
         with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
             g.save(fs, headers={"Content-Type": "image/png"})
             mocked_new_blob.return_value.upload_from_file.assert_called_with(
-                mock.ANY, rewind=True, content_type="image/png", predefined_acl="publicRead"
+                mock.ANY,
+                rewind=True,
+                content_type="image/png",
+                predefined_acl="publicRead",
+                if_generation_match=0,
             )
 
 
@@ -421,8 +461,9 @@ def test_save_file_to_bucket():
     )
 
     with mock.patch("pyramid_storage.gcloud.GoogleCloudStorage.get_connection") as mocked:
-        g.save_file(mock.Mock(), "test.jpg")
-        g.save_file(mock.Mock(), "test.jpg", bucket_name="other_bucket")
+        with mock.patch("pyramid_storage.gcloud.Blob"):
+            g.save_file(mock.Mock(), "test.jpg")
+            g.save_file(mock.Mock(), "test.jpg", bucket_name="other_bucket")
     assert mocked.return_value.get_bucket.call_args_list[0][0][0] == "my_bucket"
     assert mocked.return_value.get_bucket.call_args_list[1][0][0] == "other_bucket"
     # make sure saving to another bucket doesn't change the default
@@ -441,3 +482,448 @@ def test_delete_from_bucket():
         g.delete("test.jpg", bucket_name="other_bucket")
     assert mocked.return_value.get_bucket.call_args_list[0][0][0] == "my_bucket"
     assert mocked.return_value.get_bucket.call_args_list[1][0][0] == "other_bucket"
+
+
+def _mock_response(status_code, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.headers = headers or {}
+    return response
+
+
+def test_save_file_below_resumable_threshold():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json",
+        bucket_name="my_bucket",
+        extensions="images",
+        resumable_threshold=10,
+    )
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", _get_mock_gcloud_connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            g.save_file(BytesIO(b"x" * 10), "test.jpg")
+            blob = mocked_new_blob.return_value
+            blob.upload_from_file.assert_called_with(
+                mock.ANY,
+                rewind=True,
+                content_type="image/jpeg",
+                predefined_acl="publicRead",
+                if_generation_match=0,
+                size=10,
+            )
+            assert not blob.create_resumable_upload_session.called
+
+
+def test_save_file_above_resumable_threshold():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json",
+        bucket_name="my_bucket",
+        extensions="images",
+        chunk_size=gcloud.CHUNK_SIZE_MULTIPLE,
+        resumable_threshold=10,
+    )
+    size = gcloud.CHUNK_SIZE_MULTIPLE + 10
+    callback = mock.Mock()
+    connection = mock.MagicMock()
+    connection.get_bucket.return_value.get_blob.return_value = None
+    connection._http.request.side_effect = [
+        _mock_response(308, {"Range": "bytes=0-%d" % (gcloud.CHUNK_SIZE_MULTIPLE - 1)}),
+        _mock_response(200),
+    ]
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            blob = mocked_new_blob.return_value
+            blob.create_resumable_upload_session.return_value = "https://session"
+
+            g.save_file(BytesIO(b"x" * size), "test.jpg", upload_session_callback=callback)
+
+            assert not blob.upload_from_file.called
+            blob.create_resumable_upload_session.assert_called_with(
+                size=size,
+                content_type="image/jpeg",
+                predefined_acl="publicRead",
+                if_generation_match=0,
+            )
+
+    callback.assert_called_with("test.jpg", "https://session")
+    ranges = [
+        kwargs["headers"]["Content-Range"] for _, kwargs in connection._http.request.call_args_list
+    ]
+    assert ranges == [
+        "bytes 0-%d/%d" % (gcloud.CHUNK_SIZE_MULTIPLE - 1, size),
+        "bytes %d-%d/%d" % (gcloud.CHUNK_SIZE_MULTIPLE, size - 1, size),
+    ]
+
+
+def test_resume_upload():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+    connection = mock.MagicMock()
+    connection._http.request.side_effect = [
+        _mock_response(308, {"Range": "bytes=0-3"}),
+        _mock_response(200),
+    ]
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        g.resume_upload(BytesIO(b"0123456789"), "https://session")
+
+    calls = connection._http.request.call_args_list
+    assert calls[0].kwargs["headers"] == {"Content-Range": "bytes */10"}
+    assert calls[1].kwargs["headers"] == {"Content-Range": "bytes 4-9/10"}
+    assert calls[1].kwargs["data"] == b"456789"
+
+
+def test_upload_chunk_retried_after_server_error():
+    import requests
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json",
+        bucket_name="my_bucket",
+        extensions="images",
+        chunk_size=gcloud.CHUNK_SIZE_MULTIPLE,
+        upload_timeout=5,
+    )
+    size = gcloud.CHUNK_SIZE_MULTIPLE + 10
+    connection = mock.MagicMock()
+    connection._http.request.side_effect = [
+        requests.ConnectionError(),
+        # Asked how much was stored before the error.
+        _mock_response(308, {"Range": "bytes=0-9"}),
+        _mock_response(308, {"Range": "bytes=0-%d" % (gcloud.CHUNK_SIZE_MULTIPLE + 9)}),
+        _mock_response(200),
+    ]
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.time.sleep"):
+            g._upload_chunks(BytesIO(b"x" * size), "https://session", size, 0)
+
+    calls = connection._http.request.call_args_list
+    assert [call.kwargs["headers"]["Content-Range"] for call in calls] == [
+        "bytes 0-%d/%d" % (gcloud.CHUNK_SIZE_MULTIPLE - 1, size),
+        "bytes */%d" % size,
+        "bytes 10-%d/%d" % (gcloud.CHUNK_SIZE_MULTIPLE + 9, size),
+        "bytes */%d" % size,
+    ]
+    assert all(call.kwargs["timeout"] == 5 for call in calls)
+
+
+def test_upload_chunk_gives_up_after_retries():
+    import requests
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", chunk_retries=1
+    )
+    connection = mock.MagicMock()
+    connection._http.request.side_effect = requests.Timeout()
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.time.sleep"):
+            with pytest.raises(requests.Timeout):
+                g.resume_upload(BytesIO(b"0123456789"), "https://session")
+
+    assert connection._http.request.call_count == 2
+
+
+def test_chunk_size_must_be_multiple_of_256k():
+    from pyramid_storage import gcloud
+
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        gcloud.GoogleCloudStorage(None, "Attachments", chunk_size=1000)
+
+
+def test_save_file_does_not_look_up_existing_blob():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+
+    with mock.patch("pyramid_storage.gcloud.GoogleCloudStorage.get_connection") as mocked:
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            g.save_file(BytesIO(), "test.jpg", randomize=True)
+            assert mocked_new_blob.return_value.upload_from_file.called
+
+    assert not mocked.return_value.get_bucket.return_value.get_blob.called
+
+
+def test_save_file_if_exists_and_not_replace():
+    from google.cloud.exceptions import PreconditionFailed
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", _get_mock_gcloud_connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            upload = mocked_new_blob.return_value.upload_from_file
+            upload.side_effect = PreconditionFailed("exists")
+            name = g.save_file(BytesIO(), "test.jpg")
+            assert upload.call_args.kwargs["if_generation_match"] == 0
+            # A reserved name taken by another writer is an error.
+            with pytest.raises(PreconditionFailed):
+                g.save_file(BytesIO(), "test.jpg", _reserved=True)
+
+    assert name == "test.jpg"
+
+
+def test_save_file_if_replace():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", _get_mock_gcloud_connection
+    ):
+        with mock.patch("pyramid_storage.gcloud.Blob") as mocked_new_blob:
+            g.save_file(BytesIO(), "test.jpg", replace=True)
+            upload = mocked_new_blob.return_value.upload_from_file
+            assert "if_generation_match" not in upload.call_args.kwargs
+
+
+def test_delete_many():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+    from google.cloud.exceptions import NotFound
+
+    connection = mock.MagicMock()
+    bucket = connection.get_bucket.return_value
+    blobs = {"a.jpg": mock.Mock(), "b.jpg": mock.Mock()}
+    blobs["b.jpg"].delete.side_effect = NotFound("b.jpg")
+    bucket.blob.side_effect = blobs.get
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        results = g.delete_many(["a.jpg", "b.jpg"])
+
+    assert blobs["a.jpg"].delete.called
+    assert results == {"a.jpg": True, "b.jpg": False}
+
+
+def test_exists_many():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", max_workers=2
+    )
+    connection = mock.MagicMock()
+    bucket = connection.get_bucket.return_value
+    bucket.get_blob.side_effect = lambda name: None if name == "missing.jpg" else mock.Mock()
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        results = g.exists_many(["a.jpg", "missing.jpg"])
+
+    assert results == {"a.jpg": True, "missing.jpg": False}
+
+
+def test_exists_many_with_prefix():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    connection = mock.MagicMock()
+    blob = mock.Mock()
+    blob.name = "photos/a.jpg"
+    connection.list_blobs.return_value = iter([blob])
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        results = g.exists_many(["photos/a.jpg", "photos/b.jpg"], prefix="photos/")
+
+    assert results == {"photos/a.jpg": True, "photos/b.jpg": False}
+    connection.list_blobs.assert_called_with(connection.get_bucket.return_value, prefix="photos/")
+    assert not connection.get_bucket.return_value.get_blob.called
+
+
+def test_list():
+    import datetime
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    connection = mock.MagicMock()
+    blob = mock.Mock(size=4, etag="abc", updated=datetime.datetime(2024, 1, 1))
+    blob.name = "photos/a.jpg"
+    connection.list_blobs.return_value.pages = iter([[blob], []])
+
+    with mock.patch(
+        "pyramid_storage.gcloud.GoogleCloudStorage.get_connection", return_value=connection
+    ):
+        files = list(g.list("photos/"))
+
+    assert [(f.name, f.size, f.etag) for f in files] == [("photos/a.jpg", 4, "abc")]
+    assert files[0].mtime == blob.updated.timestamp()
+    connection.list_blobs.assert_called_with(
+        connection.get_bucket.return_value, prefix="photos/", delimiter=None
+    )
+
+
+def test_copy_and_move():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    bucket = mock.Mock()
+    source = mock.Mock()
+    blob = mock.Mock()
+    bucket.blob.side_effect = lambda name: source if name == "tmp/a.jpg" else blob
+    blob.rewrite.side_effect = [("token", 50, 100), (None, 100, 100)]
+
+    with mock.patch("pyramid_storage.gcloud.GoogleCloudStorage.get_bucket", return_value=bucket):
+        assert g.move("tmp/a.jpg", "published/a.jpg") == "published/a.jpg"
+
+    assert blob.rewrite.call_args_list == [mock.call(source), mock.call(source, token="token")]
+    blob.acl.save_predefined.assert_called_once_with("publicRead")
+    bucket.delete_blob.assert_called_once_with("tmp/a.jpg")
+
+
+def test_copy_missing_file():
+    from google.cloud.exceptions import NotFound
+
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    bucket = mock.Mock()
+    bucket.blob.return_value.rewrite.side_effect = NotFound("missing")
+
+    with mock.patch("pyramid_storage.gcloud.GoogleCloudStorage.get_bucket", return_value=bucket):
+        assert g.copy_many([("a.jpg", "b.jpg")]) == {"a.jpg": False}
+
+
+def test_open():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", read_buffer_size=4096
+    )
+    bucket = mock.Mock()
+    blob = bucket.get_blob.return_value
+    blob.generation = 7
+
+    with mock.patch.object(g, "get_bucket", return_value=bucket):
+        assert g.open("test.bin") is blob.open.return_value
+        blob.open.assert_called_once_with("rb", chunk_size=4096, if_generation_match=7)
+
+        bucket.get_blob.return_value = None
+        with pytest.raises(FileNotFoundError):
+            g.open("missing.bin")
+
+
+def test_presigned_url():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    bucket = mock.Mock()
+    blob = bucket.blob.return_value
+
+    with mock.patch.object(g, "get_bucket", return_value=bucket):
+        url = g.presigned_url("test.jpg", expires_in=60, download_name="photo.jpg")
+
+    assert url == blob.generate_signed_url.return_value
+    bucket.blob.assert_called_once_with("test.jpg")
+    kwargs = blob.generate_signed_url.call_args.kwargs
+    assert kwargs["version"] == "v4"
+    assert kwargs["expiration"].total_seconds() == 60
+    assert kwargs["response_disposition"] == 'attachment; filename="photo.jpg"'
+
+
+def test_presigned_upload_post():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json", bucket_name="my_bucket", extensions="images"
+    )
+    bucket = mock.Mock()
+    bucket.name = "my_bucket"
+    connection = mock.Mock()
+    connection.generate_signed_post_policy_v4.return_value = {
+        "url": "https://storage.googleapis.com/my_bucket/",
+        "fields": {"key": "photos/test.jpg"},
+    }
+
+    with mock.patch.object(g, "get_bucket", return_value=bucket):
+        with mock.patch.object(g, "get_connection", return_value=connection):
+            upload = g.presigned_upload("test.jpg", folder="photos", max_size=1000)
+
+    assert upload.filename == "photos/test.jpg"
+    assert upload.method == "POST"
+    assert upload.fields == {"key": "photos/test.jpg"}
+    args, kwargs = connection.generate_signed_post_policy_v4.call_args
+    assert args[:2] == ("my_bucket", "photos/test.jpg")
+    assert kwargs["fields"] == {"Content-Type": "image/jpeg", "acl": "publicRead"}
+    assert ["content-length-range", 0, 1000] in kwargs["conditions"]
+
+
+def test_presigned_upload_put_with_uniform_bucket_level_access():
+    from pyramid_storage import gcloud
+
+    g = gcloud.GoogleCloudStorage(
+        credentials="/secrets/credentials.json",
+        bucket_name="my_bucket",
+        uniform_bucket_level_access=True,
+    )
+    bucket = mock.Mock()
+
+    with mock.patch.object(g, "get_bucket", return_value=bucket):
+        upload = g.presigned_upload("test.png", method="PUT")
+
+    assert upload.method == "PUT"
+    assert upload.headers == {"Content-Type": "image/png"}
+    kwargs = bucket.blob.return_value.generate_signed_url.call_args.kwargs
+    assert kwargs["method"] == "PUT"
+    assert kwargs["content_type"] == "image/png"
+
+
+def test_complete_upload():
+    from pyramid_storage import gcloud
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    g = gcloud.GoogleCloudStorage(credentials="/secrets/credentials.json", bucket_name="my_bucket")
+    bucket = mock.Mock()
+    blob = bucket.get_blob.return_value
+    blob.size = 100
+    blob.content_type = "image/jpeg"
+
+    with mock.patch.object(g, "get_bucket", return_value=bucket):
+        assert g.complete_upload("test.jpg", max_size=100, content_type="image/jpeg")
+        assert not blob.delete.called
+
+        with pytest.raises(FileNotAllowed):
+            g.complete_upload("test.jpg", max_size=99)
+        assert blob.delete.called
+
+        bucket.get_blob.return_value = None
+        with pytest.raises(FileNotFoundError):
+            g.complete_upload("test.jpg")
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import socket
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def _local_storage(tmp_path, hooks):
+    from pyramid_storage import local
+
+    return local.LocalFileStorage(str(tmp_path), extensions="any", hooks=hooks)
+
+
+def test_save_file_reports_operation(tmp_path):
+    operations = []
+    s = _local_storage(tmp_path, [operations.append])
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+
+    assert len(operations) == 1
+    operation = operations[0]
+    assert operation.backend == "local"
+    assert operation.name == "save_file"
+    assert operation.filename == name == "photos/test.jpg"
+    assert operation.bytes == 4
+    assert operation.retries == 0
+    assert operation.error is None
+    assert operation.elapsed > 0
+
+
+def test_open_reports_size_and_error(tmp_path):
+    operations = []
+    s = _local_storage(tmp_path, [operations.append])
+    s.save_file(BytesIO(b"test"), "test.jpg")
+
+    s.open("test.jpg").close()
+    with pytest.raises(FileNotFoundError):
+        s.open("missing.jpg")
+
+    assert [(op.name, op.filename, op.bytes, op.error) for op in operations[1:]] == [
+        ("open", "test.jpg", 4, None),
+        ("open", "missing.jpg", 0, "FileNotFoundError"),
+    ]
+
+
+def test_save_many_reports_one_operation(tmp_path):
+    operations = []
+    s = _local_storage(tmp_path, [operations.append])
+
+    s.save_many((BytesIO(b"test"), "test%d.jpg" % i) for i in range(5))
+
+    assert [(op.name, op.bytes) for op in operations] == [("save_many", 20)]
+
+
+def test_disabled_without_hooks(tmp_path):
+    from pyramid_storage import instrumentation
+
+    s = _local_storage(tmp_path, None)
+    with mock.patch.object(instrumentation, "Operation") as Operation:
+        s.save_file(BytesIO(b"test"), "test.jpg")
+
+    assert not Operation.called
+
+
+def test_failing_hook_is_logged(tmp_path, caplog):
+    s = _local_storage(tmp_path, [mock.Mock(side_effect=ValueError)])
+
+    assert s.save_file(BytesIO(b"test"), "test.jpg") == "test.jpg"
+    assert "hook" in caplog.text
+
+
+def test_s3_retries():
+    from pyramid_storage import s3
+
+    operations = []
+    s = s3.S3FileStorage(bucket_name="my_bucket", hooks=[operations.append])
+    with mock.patch("pyramid_storage.s3.S3FileStorage.s3_client") as client:
+        client.head_object.return_value = {"ResponseMetadata": {"RetryAttempts": 2}}
+        assert s.exists("test.jpg")
+
+    assert [(op.backend, op.name, op.retries) for op in operations] == [("s3", "exists", 2)]
+
+
+def test_nested_calls_are_not_reported():
+    from pyramid_storage import s3
+
+    operations = []
+    s = s3.S3FileStorage(bucket_name="my_bucket", hooks=[operations.append])
+    with mock.patch("pyramid_storage.s3.S3FileStorage.s3_client") as client:
+        client.head_object.return_value = {"ResponseMetadata": {"RetryAttempts": 0}}
+        s.save_file(BytesIO(b"test"), "test.jpg", content_addressed=True)
+
+    # The file already exists: save_file returns after calling exists().
+    assert client.head_object.called
+    assert [(op.name, op.error) for op in operations] == [("save_file", None)]
+
+
+def test_logging_hook(caplog):
+    from pyramid_storage import instrumentation
+
+    operation = instrumentation.Operation("s3", "save_file", "test.jpg")
+    operation.bytes = 4
+    hook = instrumentation.LoggingHook(level="info")
+
+    with caplog.at_level(logging.INFO, "pyramid_storage.instrumentation"):
+        hook(operation)
+
+    assert "s3.save_file test.jpg" in caplog.text
+    assert "bytes=4" in caplog.text
+
+
+def test_statsd_hook():
+    from pyramid_storage import instrumentation
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    operation = instrumentation.Operation("s3", "save_file", "test.jpg")
+    operation.elapsed = 0.5
+    operation.bytes = 4
+    operation.error = "OSError"
+
+    with server:
+        instrumentation.StatsdHook("127.0.0.1", server.getsockname()[1], "app")(operation)
+        data = server.recv(1024)
+
+    assert data.decode("ascii").split("\n") == [
+        "app.s3.save_file.time:500.000|ms",
+        "app.s3.save_file.bytes:4|c",
+        "app.s3.save_file.errors.OSError:1|c",
+    ]
+
+
+def test_prometheus_hook():
+    prometheus_client = pytest.importorskip("prometheus_client")
+    from pyramid_storage import instrumentation
+
+    registry = prometheus_client.CollectorRegistry()
+    hook = instrumentation.PrometheusHook("app", registry)
+    # A second hook shares the metrics.
+    instrumentation.PrometheusHook("app", registry)
+    operation = instrumentation.Operation("s3", "save_file", "test.jpg")
+    operation.bytes = 4
+    operation.retries = 1
+
+    hook(operation)
+
+    labels = {"backend": "s3", "operation": "save_file"}
+    assert registry.get_sample_value("app_operation_duration_seconds_count", labels) == 1
+    assert registry.get_sample_value("app_bytes_total", labels) == 4
+    assert registry.get_sample_value("app_retries_total", labels) == 1
+
+
+def test_hooks_from_settings():
+    from pyramid_storage import instrumentation
+
+    settings = {"storage.instrument.hooks": "logging statsd\nlogging.info"}
+    hooks = instrumentation.hooks_from_settings(settings, "storage.")
+
+    assert isinstance(hooks[0], instrumentation.LoggingHook)
+    assert isinstance(hooks[1], instrumentation.StatsdHook)
+    assert hooks[2] is logging.info
+    assert instrumentation.hooks_from_settings({}, "storage.") == []
+
+    settings["storage.instrument.hooks"] = "no.such.hook"
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        instrumentation.hooks_from_settings(settings, "storage.")
+
+
+def test_from_settings_hooks(tmp_path):
+    from pyramid_storage import instrumentation, local
+
+    settings = {"storage.base_path": str(tmp_path), "storage.instrument.hooks": "logging"}
+    s = local.LocalFileStorage.from_settings(settings, "storage.")
+
+    assert isinstance(s.hooks[0], instrumentation.LoggingHook)
+
+
+def test_tween_attaches_totals(tmp_path):
+    from pyramid.response import Response
+    from pyramid.testing import DummyRequest
+
+    from pyramid_storage import instrumentation
+
+    s = _local_storage(tmp_path, None)
+
+    def handler(request):
+        s.save_file(BytesIO(b"test"), "test.jpg")
+        s.exists("test.jpg")
+        return Response()
+
+    registry = mock.Mock(settings={"storage.instrument.server_timing": "true"})
+    tween = instrumentation.storage_tween_factory(handler, registry)
+    request = DummyRequest()
+    response = tween(request)
+
+    totals = request.storage_totals
+    assert totals.calls == 2
+    assert totals.bytes == 4
+    assert totals.errors == 0
+    assert response.headers["Server-Timing"].startswith("storage;dur=")
+    # Calls made outside the request are not counted.
+    s.exists("test.jpg")
+    assert totals.calls == 2
+
+
+def test_tween_reads_settings_under_prefix():
+    from pyramid.response import Response
+    from pyramid.testing import DummyRequest
+
+    from pyramid_storage import instrumentation
+
+    registry = mock.Mock(settings={"media.instrument.server_timing": "true"})
+    tween = instrumentation.storage_tween_factory(lambda request: Response(), registry, "media.")
+
+    assert "Server-Timing" in tween(DummyRequest()).headers
+    tween = instrumentation.storage_tween_factory(lambda request: Response(), registry)
+    assert "Server-Timing" not in tween(DummyRequest()).headers
@@ -1,20 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import os
+import shutil
+from io import BytesIO
 from unittest import mock
 
 import pytest
 from pyramid import exceptions as pyramid_exceptions
 
 
-def _mock_open(name="test", mode="wb"):
-    obj = mock.Mock()
-    obj.__enter__ = mock.Mock()
-    obj.__enter__.return_value = mock.Mock()
-    obj.__exit__ = mock.Mock()
-    return obj
-
-
 def test_extension_allowed_if_any():
     from pyramid_storage import local
 
@@ -71,125 +65,79 @@ def test_save_if_file_not_allowed():
         s.save(fs)
 
 
-def test_save_if_file_allowed():
+def test_save_if_file_allowed(tmp_path):
     from pyramid_storage import local
 
     fs = mock.Mock()
     fs.filename = "test.jpg"
+    fs.file = BytesIO(b"test")
 
-    s = local.LocalFileStorage("uploads", extensions="images")
-
-    patches = (
-        mock.patch("builtins.open", _mock_open),
-        mock.patch("os.path.exists", lambda p: False),
-        mock.patch("os.makedirs", lambda p: True),
-        mock.patch("shutil.copyfileobj", lambda x, y: True),
-    )
-
-    for patch in patches:
-        patch.start()
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
 
     name = s.save(fs)
     assert name == "test.jpg"
+    assert (tmp_path / "test.jpg").read_bytes() == b"test"
 
-    for patch in patches:
-        patch.stop()
 
-
-def test_save_file():
+def test_save_file(tmp_path):
     from pyramid_storage import local
 
-    s = local.LocalFileStorage("uploads", extensions="images")
-
-    patches = (
-        mock.patch("builtins.open", _mock_open),
-        mock.patch("os.path.exists", lambda p: False),
-        mock.patch("os.makedirs", lambda p: True),
-        mock.patch("shutil.copyfileobj", lambda x, y: True),
-    )
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
 
-    for patch in patches:
-        patch.start()
-
-    name = s.save_file(mock.Mock(), "test.jpg", replace=True)
+    name = s.save_file(BytesIO(b"test"), "test.jpg", replace=True)
     assert name == "test.jpg"
-
-    for patch in patches:
-        patch.stop()
+    # replace is not supported by the local storage: a new name is used.
+    assert s.save_file(BytesIO(b"test"), "test.jpg", replace=True) == "test-1.jpg"
 
 
-def test_save_filename():
+def test_save_filename(tmp_path):
     from pyramid_storage import local
 
-    s = local.LocalFileStorage("uploads", extensions="images")
+    s = local.LocalFileStorage(str(tmp_path / "uploads"), extensions="images")
 
-    patches = (
-        mock.patch("builtins.open", _mock_open),
-        mock.patch("os.path.exists", lambda p: False),
-        mock.patch("os.makedirs", lambda p: True),
-        mock.patch("shutil.copyfileobj", lambda x, y: True),
-    )
+    p = tmp_path / "test.jpg"
+    p.write_text("test")
 
-    for patch in patches:
-        patch.start()
-
-    name = s.save_filename("test.jpg")
+    name = s.save_filename(str(p))
     assert name == "test.jpg"
-
-    for patch in patches:
-        patch.stop()
+    assert (tmp_path / "uploads" / "test.jpg").read_text() == "test"
 
 
-def test_save_if_randomize():
+def test_save_if_randomize(tmp_path):
     from pyramid_storage import local
 
     fs = mock.Mock()
     fs.filename = "test.jpg"
+    fs.file = BytesIO(b"test")
 
-    s = local.LocalFileStorage("uploads", extensions="images")
-
-    patches = (
-        mock.patch("builtins.open", _mock_open),
-        mock.patch("os.path.exists", lambda p: False),
-        mock.patch("os.makedirs", lambda p: True),
-        mock.patch("shutil.copyfileobj", lambda x, y: True),
-    )
-
-    for patch in patches:
-        patch.start()
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
 
     name = s.save(fs, randomize=True)
     assert name != "test.jpg"
     assert name.endswith(".jpg")
 
-    for patch in patches:
-        patch.stop()
-
 
-def test_save_in_folder():
+def test_save_in_folder(tmp_path):
     from pyramid_storage import local
 
     fs = mock.Mock()
     fs.filename = "test.jpg"
+    fs.file = BytesIO(b"test")
 
-    s = local.LocalFileStorage("uploads", extensions="images")
-
-    patches = (
-        mock.patch("builtins.open"),
-        _mock_open(),
-        mock.patch("os.path.exists", lambda p: False),
-        mock.patch("os.makedirs", lambda p: True),
-        mock.patch("shutil.copyfileobj", lambda x, y: True),
-    )
-
-    for patch in patches:
-        patch.start()
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
 
     name = s.save(fs, folder="photos")
     assert name == "photos%stest.jpg" % os.path.sep
+    assert (tmp_path / "photos" / "test.jpg").read_bytes() == b"test"
 
-    for patch in patches:
-        patch.stop()
+
+def test_save_if_name_clashes(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
+
+    names = [s.save_file(BytesIO(b"test"), "test.jpg") for _ in range(3)]
+    assert names == ["test.jpg", "test-1.jpg", "test-2.jpg"]
 
 
 def test_url():
@@ -220,6 +168,9 @@ def test_remove_if_exists():
     s = local.LocalFileStorage("")
     assert s.delete("test.jpg")
 
+    for patch in patches:
+        patch.stop()
+
 
 def test_remove_if_not_exists():
     from pyramid_storage import local
@@ -230,29 +181,63 @@ def test_remove_if_not_exists():
         assert not s.delete("test.jpg")
 
 
-def test_resolve_name_if_not_exists():
+def test_resolve_name_if_not_exists(tmp_path):
     from pyramid_storage import local
 
-    s = local.LocalFileStorage("uploads")
+    s = local.LocalFileStorage(str(tmp_path))
 
-    with mock.patch("os.path.exists", lambda p: False):
-        name, path = s.resolve_name("test.jpg", "uploads")
-        assert name == "test.jpg"
-        assert path == "uploads" + os.path.sep + "test.jpg"
+    name, path = s.resolve_name("test.jpg", str(tmp_path))
+    assert name == "test.jpg"
+    assert path == str(tmp_path) + os.path.sep + "test.jpg"
+    assert os.path.exists(path)
 
 
-def test_resolve_name_if_exists():
+def test_resolve_name_if_exists(tmp_path):
     from pyramid_storage import local
 
-    s = local.LocalFileStorage("uploads")
+    s = local.LocalFileStorage(str(tmp_path))
+    (tmp_path / "test.jpg").write_text("test")
+
+    name, path = s.resolve_name("test.jpg", str(tmp_path))
+    assert name == "test-1.jpg"
+    assert path == str(tmp_path) + os.path.sep + "test-1.jpg"
+
+
+def test_resolve_name_searches_last_suffix(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path))
+    (tmp_path / "test.jpg").write_text("test")
+    for i in range(1, 20):
+        (tmp_path / ("test-%d.jpg" % i)).write_text("test")
 
-    def conditional_exists(path):
-        return "1" not in path
+    with mock.patch("pyramid_storage.local.os.scandir") as scandir:
+        with mock.patch("pyramid_storage.local.os.path.lexists", wraps=os.path.lexists) as lexists:
+            name, _ = s.resolve_name("test.jpg", str(tmp_path))
+    assert name == "test-20.jpg"
+    assert not scandir.called
+    assert lexists.call_count < 12
 
-    with mock.patch("os.path.exists", conditional_exists):
-        name, path = s.resolve_name("test.jpg", "uploads")
-        assert name == "test-1.jpg"
-        assert path == "uploads" + os.path.sep + "test-1.jpg"
+    with mock.patch.object(s, "_search_last_counter") as search_last_counter:
+        name, _ = s.resolve_name("test.jpg", str(tmp_path))
+        assert name == "test-21.jpg"
+        assert not search_last_counter.called
+
+
+def test_resolve_name_if_concurrent(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: s.resolve_name("test.jpg", str(tmp_path)), range(50))
+        )
+
+    names = [name for name, _ in results]
+    assert len(set(names)) == 50
 
 
 def test_dummy_storage():
@@ -281,3 +266,439 @@ def test_from_settings_if_base_path_missing():
 
     with pytest.raises(pyramid_exceptions.ConfigurationError):
         local.LocalFileStorage.from_settings({}, "storage.")
+
+
+def test_save_leaves_no_temp_files(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
+    s.save_file(BytesIO(b"test"), "test.jpg")
+
+    assert os.listdir(str(tmp_path)) == ["test.jpg"]
+
+
+def test_save_removes_temp_file_on_error(tmp_path):
+    from pyramid_storage import local
+
+    file = mock.Mock()
+    file.read.side_effect = IOError
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images")
+
+    with pytest.raises(IOError):
+        s.save_file(file, "test.jpg")
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_save_with_fsync(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images", fsync=True)
+
+    with mock.patch("os.fsync") as fsync:
+        s.save_file(BytesIO(b"test"), "test.jpg")
+        assert fsync.call_count == 2
+
+    assert (tmp_path / "test.jpg").read_bytes() == b"test"
+
+
+def test_sweep_temp_files(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "photos").mkdir()
+    stale = tmp_path / "photos" / (local.TEMP_PREFIX + "abc" + local.TEMP_SUFFIX)
+    stale.write_text("test")
+    os.utime(str(stale), (0, 0))
+    fresh = tmp_path / (local.TEMP_PREFIX + "def" + local.TEMP_SUFFIX)
+    fresh.write_text("test")
+    (tmp_path / "test.jpg").write_text("test")
+    os.utime(str(tmp_path / "test.jpg"), (0, 0))
+
+    s = local.LocalFileStorage(str(tmp_path))
+    assert s.sweep_temp_files() == 1
+
+    assert not stale.exists()
+    assert fresh.exists()
+    assert (tmp_path / "test.jpg").exists()
+
+
+def test_save_filename_copies_with_kernel(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path / "uploads"), extensions="images")
+
+    p = tmp_path / "test.jpg"
+    p.write_bytes(b"x" * 100000)
+
+    with mock.patch("shutil.copyfileobj") as copyfileobj:
+        name = s.save_filename(str(p))
+        assert not copyfileobj.called
+
+    assert (tmp_path / "uploads" / name).read_bytes() == b"x" * 100000
+
+
+def test_save_file_copies_from_current_position_with_kernel(tmp_path):
+    from pyramid_storage import local
+
+    p = tmp_path / "test.jpg"
+    p.write_bytes(b"0123456789")
+
+    with open(str(p), "rb") as src, open(str(tmp_path / "copy.jpg"), "wb") as dest:
+        src.seek(4)
+        with mock.patch("pyramid_storage.local._clone") as clone:
+            local._copy_file(src, dest, 1024)
+            assert not clone.called
+        assert src.tell() == 10
+
+    assert (tmp_path / "copy.jpg").read_bytes() == b"456789"
+
+
+def test_copy_of_spooled_file_stays_in_memory(tmp_path):
+    import tempfile
+
+    from pyramid_storage import local
+
+    src = tempfile.SpooledTemporaryFile(max_size=1024)
+    src.write(b"0123456789")
+    src.seek(4)
+
+    with open(str(tmp_path / "copy.jpg"), "wb") as dest:
+        local._copy_file(src, dest, 1024)
+
+    assert not src._rolled
+    assert (tmp_path / "copy.jpg").read_bytes() == b"456789"
+
+
+def test_save_file_falls_back_to_buffered_copy(tmp_path):
+    import errno
+
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path / "uploads"), extensions="images", copy_buffer_size=7)
+
+    p = tmp_path / "test.jpg"
+    p.write_bytes(b"test")
+
+    error = OSError(errno.EXDEV, "cross-device")
+    patches = (
+        mock.patch("pyramid_storage.local._clone", return_value=False),
+        mock.patch("os.copy_file_range", side_effect=error, create=True),
+        mock.patch("os.sendfile", side_effect=error, create=True),
+        mock.patch("shutil.copyfileobj", wraps=shutil.copyfileobj),
+    )
+    for patch in patches:
+        patch.start()
+
+    try:
+        name = s.save_filename(str(p))
+        shutil.copyfileobj.assert_called_with(mock.ANY, mock.ANY, 7)
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    assert (tmp_path / "uploads" / name).read_bytes() == b"test"
+
+
+def test_delete_many(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "a.jpg").write_text("test")
+    (tmp_path / "b.jpg").write_text("test")
+
+    s = local.LocalFileStorage(str(tmp_path), max_workers=2)
+
+    assert s.delete_many(["a.jpg", "b.jpg", "c.jpg"]) == {
+        "a.jpg": True,
+        "b.jpg": True,
+        "c.jpg": False,
+    }
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_exists_many(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "a.jpg").write_text("test")
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    assert s.exists_many(["a.jpg", "b.jpg"]) == {"a.jpg": True, "b.jpg": False}
+
+
+def test_list(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "photos" / "2024").mkdir(parents=True)
+    (tmp_path / "photos" / "a.jpg").write_text("test")
+    (tmp_path / "photos" / "2024" / "b.jpg").write_text("test")
+    (tmp_path / "photos" / (local.TEMP_PREFIX + "c.jpg")).write_text("test")
+    (tmp_path / "other.jpg").write_text("test")
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    assert sorted(info.name for info in s.list("photos/")) == ["photos/2024/b.jpg", "photos/a.jpg"]
+    assert [info.name for info in s.list("photos/", recursive=False)] == ["photos/a.jpg"]
+    assert [info.name for info in s.list("photos/a")] == ["photos/a.jpg"]
+    assert len(list(s.list())) == 3
+    assert list(s.list("missing/")) == []
+
+    info = next(s.list("other"))
+    assert info.size == 4
+    assert info.mtime == os.path.getmtime(str(tmp_path / "other.jpg"))
+
+
+def test_list_many(tmp_path):
+    from pyramid_storage import local
+
+    for folder in "abc":
+        (tmp_path / folder).mkdir()
+        for i in range(5):
+            (tmp_path / folder / ("%d.jpg" % i)).write_text("test")
+
+    s = local.LocalFileStorage(str(tmp_path), max_workers=2)
+
+    names = sorted(info.name for info in s.list_many(["a/", "b/", "c/"]))
+    assert names == sorted("%s/%d.jpg" % (folder, i) for folder in "abc" for i in range(5))
+
+
+def test_save_file_sharded(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), base_url="/uploads/", shard_depth=2)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+    dup = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+
+    assert name == "photos/test.jpg"
+    assert dup == "photos/test-1.jpg"
+    shards = local.shard_dirs("test.jpg", 2)
+    assert s.path(name) == os.path.join(str(tmp_path), "photos", *shards, "test.jpg")
+    assert s.url(name) == "/uploads/photos/%s/%s/test.jpg" % tuple(shards)
+    assert os.path.exists(s.path(name))
+    assert os.path.exists(s.path(dup))
+    assert s.exists(name)
+    assert sorted(info.name for info in s.list("photos/", recursive=False)) == [dup, name]
+
+    assert s.delete(name)
+    assert not s.exists(name)
+
+
+def test_resolve_name_sharded_searches_last_counter(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), shard_depth=1)
+    for i in range(20):
+        s.save_file(BytesIO(b"test"), "test.jpg")
+
+    # Another process, without the cached counters, finds the last suffix
+    # with a few lookups.
+    other = local.LocalFileStorage(str(tmp_path), shard_depth=1)
+    with mock.patch("pyramid_storage.local.os.open", wraps=os.open) as os_open:
+        with mock.patch("pyramid_storage.local.os.path.lexists", wraps=os.path.lexists) as lexists:
+            assert other.save_file(BytesIO(b"test"), "test.jpg") == "test-20.jpg"
+
+    reservations = [
+        c for c in os_open.call_args_list if os.path.basename(c.args[0]).startswith("test")
+    ]
+    assert len(reservations) == 2
+    assert lexists.call_count < 12
+
+
+def test_reshard(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "photos").mkdir()
+    (tmp_path / "photos" / "a.jpg").write_text("a")
+    (tmp_path / "b.jpg").write_text("b")
+
+    s = local.LocalFileStorage(str(tmp_path), shard_depth=2, shard_width=1)
+
+    assert s.reshard() == 2
+    assert s.reshard(from_depth=2, from_width=1) == 0
+    assert open(s.path("photos/a.jpg")).read() == "a"
+    assert open(s.path("b.jpg")).read() == "b"
+    assert sorted(info.name for info in s.list()) == ["b.jpg", "photos/a.jpg"]
+
+    flat = local.LocalFileStorage(str(tmp_path))
+
+    assert flat.reshard(from_depth=2, from_width=1) == 2
+    assert sorted(os.listdir(str(tmp_path))) == ["b.jpg", "photos"]
+    assert os.listdir(str(tmp_path / "photos")) == ["a.jpg"]
+
+
+def test_folders_named_like_shards(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "ab").mkdir()
+    (tmp_path / "ab" / "a.jpg").write_text("a")
+    (tmp_path / "0").mkdir()
+    (tmp_path / "0" / "b.jpg").write_text("b")
+
+    s = local.LocalFileStorage(str(tmp_path), shard_depth=2, shard_width=1)
+
+    assert s.reshard() == 2
+    assert sorted(info.name for info in s.list()) == ["0/b.jpg", "ab/a.jpg"]
+    s.save_file(BytesIO(b"c"), "c.jpg")
+
+    flat = local.LocalFileStorage(str(tmp_path))
+
+    assert flat.reshard(from_depth=2, from_width=1) == 3
+    assert sorted(info.name for info in flat.list()) == ["0/b.jpg", "ab/a.jpg", "c.jpg"]
+    assert open(flat.path("0/b.jpg")).read() == "b"
+
+
+def test_copy_and_move(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "tmp").mkdir()
+    (tmp_path / "tmp" / "a.jpg").write_text("test")
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    assert s.copy("tmp/a.jpg", "tmp/b.jpg") == "tmp/b.jpg"
+    assert s.move("tmp/a.jpg", "published/a.jpg") == "published/a.jpg"
+    assert not s.exists("tmp/a.jpg")
+    assert open(s.path("published/a.jpg")).read() == "test"
+    assert open(s.path("tmp/b.jpg")).read() == "test"
+    assert os.listdir(str(tmp_path / "tmp")) == ["b.jpg"]
+
+    with pytest.raises(FileNotFoundError):
+        s.copy("tmp/a.jpg", "tmp/c.jpg")
+
+
+def test_move_many_sharded(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path), shard_depth=1, max_workers=2)
+    for name in ("a.jpg", "b.jpg"):
+        s.save_file(BytesIO(b"test"), name, folder="tmp")
+
+    results = s.move_many(
+        [
+            ("tmp/a.jpg", "published/a.jpg"),
+            ("tmp/b.jpg", "published/b.jpg"),
+            ("tmp/c.jpg", "c.jpg"),
+        ]
+    )
+
+    assert results == {"tmp/a.jpg": True, "tmp/b.jpg": True, "tmp/c.jpg": False}
+    assert sorted(info.name for info in s.list("published/")) == [
+        "published/a.jpg",
+        "published/b.jpg",
+    ]
+
+
+def test_save_many(tmp_path):
+    from pyramid_storage import local
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images", max_workers=4)
+
+    items = [(BytesIO(b"test"), "test.jpg", {"folder": "photos"}) for _ in range(10)]
+    items.append((BytesIO(b"test"), "test.exe"))
+    result = s.save_many(items)
+
+    assert sorted(result.filenames[:10]) == sorted(
+        os.path.join("photos", name) for name in os.listdir(str(tmp_path / "photos"))
+    )
+    assert result.filenames[10] is None
+    assert isinstance(result.errors[10], FileNotAllowed)
+    assert result.bytes == 40
+
+
+def test_save_file_sniff_content(tmp_path):
+    from pyramid_storage import local
+    from pyramid_storage.exceptions import ContentNotAllowed
+
+    s = local.LocalFileStorage(str(tmp_path), extensions="images", sniff_content=True)
+
+    name = s.save_file(BytesIO(b"\x89PNG\r\n\x1a\n" + b"\x00" * 32), "test.png")
+    assert (tmp_path / name).exists()
+
+    with pytest.raises(ContentNotAllowed):
+        s.save_file(BytesIO(b"%PDF-1.7\n"), "test.jpg")
+    assert not (tmp_path / "test.jpg").exists()
+
+
+def test_save_file_content_addressed(tmp_path):
+    import hashlib
+
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path))
+    digest = hashlib.sha256(b"test").hexdigest()
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="avatars", content_addressed=True)
+    assert name == os.path.join("avatars", digest + ".jpg")
+    assert (tmp_path / name).read_bytes() == b"test"
+
+    again = s.save_file(BytesIO(b"test"), "other.JPG", folder="avatars", content_addressed=True)
+    assert again == name
+    assert sorted(os.listdir(str(tmp_path / "avatars"))) == [digest + ".jpg"]
+
+    other = s.save_file(BytesIO(b"other"), "test.jpg", folder="avatars", content_addressed=True)
+    assert other != name
+
+
+def test_open(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "test.txt").write_bytes(b"hello world")
+    s = local.LocalFileStorage(str(tmp_path))
+
+    with s.open("test.txt") as f:
+        assert isinstance(f, local.MappedFile)
+        assert f.read(5) == b"hello"
+        f.seek(-5, os.SEEK_END)
+        assert f.read() == b"world"
+        f.seek(6)
+        buffer = bytearray(3)
+        assert f.readinto(buffer) == 3
+        assert buffer == b"wor"
+    assert f.closed
+
+
+def test_open_empty_file(tmp_path):
+    from pyramid_storage import local
+
+    (tmp_path / "empty.txt").write_bytes(b"")
+    s = local.LocalFileStorage(str(tmp_path))
+
+    with s.open("empty.txt") as f:
+        assert f.read() == b""
+
+
+def test_open_errors(tmp_path):
+    from pyramid_storage import local
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    with pytest.raises(FileNotFoundError):
+        s.open("missing.txt")
+
+    with pytest.raises(ValueError):
+        s.open("test.txt", "wb")
+
+
+def test_reserve_and_release_filename(tmp_path):
+    from pyramid_storage import local
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    s = local.LocalFileStorage(str(tmp_path))
+
+    name = s.reserve_filename("test.jpg", folder="photos")
+    assert name == os.path.join("photos", "test.jpg")
+    assert s.reserve_filename("test.jpg", folder="photos") == os.path.join("photos", "test-1.jpg")
+
+    assert s.save_file(BytesIO(b"test"), "test.jpg", folder="photos", _reserved=True) == name
+    assert (tmp_path / name).read_bytes() == b"test"
+
+    # a written file is not released
+    s.release_filename(name)
+    assert (tmp_path / name).exists()
+    s.release_filename(os.path.join("photos", "test-1.jpg"))
+    assert not (tmp_path / "photos" / "test-1.jpg").exists()
+
+    with pytest.raises(FileNotAllowed):
+        s.reserve_filename("test.exe")
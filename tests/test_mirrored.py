@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def _make_storage(tmp_path, count=2, **kwargs):
+    from pyramid_storage import local, mirrored
+
+    storages = [
+        local.LocalFileStorage(str(tmp_path / ("replica%d" % i)), base_url="http://%d/" % i)
+        for i in range(count)
+    ]
+    kwargs.setdefault("retries", 0)
+    return mirrored.MirroredFileStorage(storages, **kwargs)
+
+
+def test_from_settings(tmp_path):
+    from pyramid_storage import local, mirrored, s3
+
+    settings = {
+        "storage.mirror.backends": "primary backup",
+        "storage.mirror.quorum": "2",
+        "storage.mirror.primary.backend": "s3",
+        "storage.mirror.primary.aws.bucket_name": "my_bucket",
+        "storage.mirror.backup.backend": "local",
+        "storage.mirror.backup.base_path": str(tmp_path),
+    }
+    s = mirrored.MirroredFileStorage.from_settings(settings, "storage.")
+
+    assert isinstance(s.primary, s3.S3FileStorage)
+    assert s.primary.bucket_name == "my_bucket"
+    assert isinstance(s.storages[1], local.LocalFileStorage)
+    assert s.storages[1].base_path == str(tmp_path)
+    assert s.quorum == 2
+
+    settings["storage.mirror.quorum"] = "3"
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        mirrored.MirroredFileStorage.from_settings(settings, "storage.")
+
+
+def test_save_file_writes_all_storages(tmp_path):
+    s = _make_storage(tmp_path, count=3, quorum=3)
+    (tmp_path / "replica0" / "photos").mkdir(parents=True)
+    (tmp_path / "replica0" / "photos" / "test.jpg").write_text("old")
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+
+    assert name == "photos/test-1.jpg"
+    for storage in s.storages:
+        assert open(storage.path(name), "rb").read() == b"test"
+    assert s.url(name) == "http://0/photos/test-1.jpg"
+    assert s.exists(name)
+
+
+def test_save_file_replace_and_randomize(tmp_path):
+    s = _make_storage(tmp_path, quorum=2)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", replace=True, randomize=True)
+
+    assert name != "test.jpg"
+    assert name.endswith(".jpg")
+    for storage in s.storages:
+        assert open(storage.path(name), "rb").read() == b"test"
+
+
+def test_save_file_spools_only_streams(tmp_path):
+    s = _make_storage(tmp_path, quorum=2)
+    path = tmp_path / "test.jpg"
+    path.write_bytes(b"test")
+
+    with mock.patch("pyramid_storage.mirrored.tempfile.mkstemp") as mkstemp:
+        with open(str(path), "rb") as file:
+            assert s.save_file(file, "a.jpg") == "a.jpg"
+        assert s.save_file(BytesIO(b"test"), "b.jpg") == "b.jpg"
+        assert not mkstemp.called
+
+    class Stream(object):
+        def __init__(self):
+            self.file = BytesIO(b"test")
+
+        def seek(self, offset):
+            self.file.seek(offset)
+
+        def read(self, size=-1):
+            return self.file.read(size)
+
+    assert s.save_file(Stream(), "c.jpg") == "c.jpg"
+    for storage in s.storages:
+        for name in ("a.jpg", "b.jpg", "c.jpg"):
+            assert open(storage.path(name), "rb").read() == b"test"
+
+
+def test_finished_writes_are_forgotten(tmp_path):
+    s = _make_storage(tmp_path, quorum=1)
+
+    s.save_file(BytesIO(b"test"), "test.jpg")
+    assert s.flush(timeout=5)
+
+    assert s._futures == set()
+    assert s._pending == [{}, {}]
+
+    s.close()
+    with pytest.raises(RuntimeError):
+        s.delete("test.jpg")
+    assert s._futures == set()
+    assert s._pending == [{}, {}]
+
+
+def test_save_file_returns_at_quorum(tmp_path):
+    s = _make_storage(tmp_path, quorum=1)
+    release = threading.Event()
+    slow = s.storages[1]
+    save_file = slow.save_file
+    slow.save_file = lambda *args, **kwargs: release.wait() and save_file(*args, **kwargs)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+
+    assert s.storages[0].exists(name)
+    assert not slow.exists(name)
+    slow.exists = mock.Mock(wraps=slow.exists)
+    assert s.exists(name)
+    assert not slow.exists.called
+
+    release.set()
+    assert s.flush(timeout=5)
+    assert open(slow.path(name), "rb").read() == b"test"
+
+
+def test_save_file_fails_below_quorum(tmp_path):
+    s = _make_storage(tmp_path, quorum=2)
+    s.storages[1].save_file = mock.Mock(side_effect=OSError("down"))
+
+    with pytest.raises(OSError):
+        s.save_file(BytesIO(b"test"), "test.jpg")
+
+    # Writes that succeeded are not undone.
+    s.flush()
+    assert s.storages[0].exists("test.jpg")
+
+
+def test_background_write_is_retried(tmp_path):
+    s = _make_storage(tmp_path, retries=2)
+    s.storages[1].save_file = mock.Mock(side_effect=[OSError("down"), "test.jpg"])
+
+    s.save_file(BytesIO(b"test"), "test.jpg")
+
+    assert s.flush(timeout=5)
+    assert s.storages[1].save_file.call_count == 2
+
+
+def test_reads_skip_failed_storage(tmp_path):
+    s = _make_storage(tmp_path, quorum=2)
+    s.save_file(BytesIO(b"test"), "test.jpg")
+    s._latency = [0.2, 0.1]
+    s.storages[1].open = mock.Mock(side_effect=OSError("down"))
+
+    with s.open("test.jpg") as f:
+        assert f.read() == b"test"
+    assert s._order() == [0, 1]
+
+    del s.storages[1].open
+    with pytest.raises(FileNotFoundError):
+        s.open("missing.jpg")
+
+
+def test_delete_and_move(tmp_path):
+    s = _make_storage(tmp_path, quorum=2)
+    s.save_file(BytesIO(b"test"), "a.jpg")
+    s.save_file(BytesIO(b"test"), "b.jpg")
+
+    assert s.move("a.jpg", "c.jpg") == "c.jpg"
+    s.delete("b.jpg")
+
+    for storage in s.storages:
+        assert storage.exists_many(["a.jpg", "b.jpg", "c.jpg"]) == {
+            "a.jpg": False,
+            "b.jpg": False,
+            "c.jpg": True,
+        }
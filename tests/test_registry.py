@@ -39,3 +39,30 @@ def test_get_file_storage():
         registry.register_file_storage_impl(config, fs)
         impl = registry.get_file_storage_impl(req)
         assert impl == fs
+
+
+def test_register_wraps_impl_in_cache():
+    from pyramid_storage import registry
+    from pyramid_storage.cache import CachedFileStorage, MemoryCache
+    from pyramid_storage.interfaces import IFileStorage
+
+    @implementer(IFileStorage)
+    class DummyFileStorage(object):
+        pass
+
+    settings = {
+        "storage.cache.backend": "memory",
+        "storage.cache.ttl": "30",
+    }
+
+    with testConfig(settings=settings) as config:
+        fs = DummyFileStorage()
+        req = DummyRequest()
+        req.registry = config.registry
+
+        registry.register_file_storage_impl(config, fs)
+        impl = registry.get_file_storage_impl(req)
+        assert isinstance(impl, CachedFileStorage)
+        assert isinstance(impl.cache, MemoryCache)
+        assert impl.cache.ttl == 30
+        assert impl.storage is fs
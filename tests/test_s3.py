@@ -48,6 +48,16 @@ def test_extension_not_allowed_if_allowed_if_not_dotted():
     assert not s.extension_allowed("jpg", ("gif",))
 
 
+def test_extension_allowed_if_empty_tuple():
+    from pyramid_storage import s3
+
+    s = s3.S3FileStorage(
+        access_key="AK", secret_key="SK", bucket_name="my_bucket", extensions="images"
+    )
+    assert s.filename_allowed("test.exe", ())
+    assert not s.filename_allowed("test.exe")
+
+
 def test_file_allowed():
     from pyramid_storage import s3
 
@@ -111,6 +121,54 @@ def test_save_file(mock_s3_client):
     assert name == "test.jpg"
 
 
+def test_save_file_sniff_content(mock_s3_client):
+    from io import BytesIO
+
+    from pyramid_storage import s3
+    from pyramid_storage.exceptions import ContentNotAllowed
+
+    s = s3.S3FileStorage(
+        access_key="AK",
+        secret_key="SK",
+        bucket_name="my_bucket",
+        extensions="images",
+        sniff_content=True,
+    )
+
+    with pytest.raises(ContentNotAllowed):
+        s.save_file(BytesIO(b"MZ\x90\x00"), "test.jpg")
+    mock_s3_client.put_object.assert_not_called()
+
+    assert s.save_file(BytesIO(b"\xff\xd8\xff\xe0"), "test.jpg") == "test.jpg"
+    mock_s3_client.put_object.assert_called_once()
+
+
+def test_save_file_content_addressed(mock_s3_client):
+    import hashlib
+    from io import BytesIO
+
+    from pyramid_storage import s3
+
+    s = s3.S3FileStorage(
+        access_key="AK", secret_key="SK", bucket_name="my_bucket", extensions="images"
+    )
+    key = "avatars/" + hashlib.sha256(b"test").hexdigest() + ".jpg"
+
+    with mock.patch.object(s, "exists", return_value=False) as exists:
+        name = s.save_file(BytesIO(b"test"), "test.jpg", folder="avatars", content_addressed=True)
+    assert name == key
+    exists.assert_called_once_with(key, None)
+    kwargs = mock_s3_client.put_object.call_args.kwargs
+    assert kwargs["Key"] == key
+    assert kwargs["ContentMD5"] == "CY9rzUYh03PK3k6DJie09g=="
+
+    mock_s3_client.put_object.reset_mock()
+    with mock.patch.object(s, "exists", return_value=True):
+        name = s.save_file(BytesIO(b"test"), "test.jpg", folder="avatars", content_addressed=True)
+    assert name == key
+    mock_s3_client.put_object.assert_not_called()
+
+
 def test_save_filename(mock_s3_client, tmp_path):
     from pyramid_storage import s3
 
@@ -314,3 +372,503 @@ def test_delete_from_bucket(mock_s3_client):
     s.delete("test.jpg", bucket_name="other_bucket")
 
     mock_s3_client.delete_object(Bucket="other_bucket", Key="test.jpg")
+
+
+def test_s3_client_is_cached():
+    from pyramid_storage import s3
+
+    settings = {
+        "storage.aws.bucket_name": "Attachments",
+        "storage.aws.region": "eu-west-1",
+    }
+    inst = s3.S3FileStorage.from_settings(settings, "storage.")
+
+    with mock.patch("boto3.client") as boto_mocked:
+        assert inst.s3_client is inst.s3_client
+        assert boto_mocked.call_count == 1
+
+
+def test_s3_client_is_rebuilt_after_fork():
+    from pyramid_storage import s3
+
+    settings = {
+        "storage.aws.bucket_name": "Attachments",
+        "storage.aws.region": "eu-west-1",
+    }
+    inst = s3.S3FileStorage.from_settings(settings, "storage.")
+
+    with mock.patch("boto3.client") as boto_mocked:
+        inst.s3_client
+        with mock.patch("os.getpid", return_value=-1):
+            inst.s3_client
+        assert boto_mocked.call_count == 2
+
+
+def test_from_settings_with_max_pool_connections():
+    from pyramid_storage import s3
+
+    settings = {
+        "storage.aws.bucket_name": "Attachments",
+        "storage.aws.region": "eu-west-1",
+        "storage.aws.max_pool_connections": "50",
+    }
+    inst = s3.S3FileStorage.from_settings(settings, "storage.")
+
+    with mock.patch("boto3.client") as boto_mocked:
+        inst.s3_client
+
+        _, kwargs = boto_mocked.call_args_list[0]
+        assert kwargs["config"].max_pool_connections == 50
+
+
+def test_save_file_below_multipart_threshold(mock_s3_client):
+    from io import BytesIO
+
+    from pyramid_storage import s3
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", extensions="images", multipart_threshold=10)
+
+    s.save_file(BytesIO(b"x" * 10), "test.jpg")
+
+    assert mock_s3_client.put_object.called
+    assert not mock_s3_client.create_multipart_upload.called
+
+
+def test_save_file_above_multipart_threshold(mock_s3_client):
+    from io import BytesIO
+
+    from pyramid_storage import s3
+
+    mock_s3_client.create_multipart_upload.return_value = {"UploadId": "abc"}
+    mock_s3_client.upload_part.side_effect = lambda **kwargs: {
+        "ETag": "etag-%d" % kwargs["PartNumber"]
+    }
+
+    s = s3.S3FileStorage(
+        bucket_name="my_bucket",
+        extensions="images",
+        multipart_threshold=s3.MIN_PART_SIZE,
+        multipart_chunksize=s3.MIN_PART_SIZE,
+        max_concurrency=2,
+    )
+
+    s.save_file(BytesIO(b"x" * (s3.MIN_PART_SIZE * 2 + 1)), "test.jpg")
+
+    assert not mock_s3_client.put_object.called
+    mock_s3_client.create_multipart_upload.assert_called_with(
+        Bucket="my_bucket", Key="test.jpg", ACL=None, ContentType="image/jpeg"
+    )
+    sizes = sorted(len(kwargs["Body"]) for _, kwargs in mock_s3_client.upload_part.call_args_list)
+    assert sizes == [1, s3.MIN_PART_SIZE, s3.MIN_PART_SIZE]
+    mock_s3_client.complete_multipart_upload.assert_called_with(
+        Bucket="my_bucket",
+        Key="test.jpg",
+        UploadId="abc",
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": 1, "ETag": "etag-1"},
+                {"PartNumber": 2, "ETag": "etag-2"},
+                {"PartNumber": 3, "ETag": "etag-3"},
+            ]
+        },
+    )
+
+
+def test_upload_multipart_retries_failed_part(mock_s3_client):
+    from io import BytesIO
+
+    from botocore.exceptions import ClientError
+
+    from pyramid_storage import s3
+
+    error = ClientError({"Error": {"Code": "500"}}, "UploadPart")
+    mock_s3_client.create_multipart_upload.return_value = {"UploadId": "abc"}
+    mock_s3_client.upload_part.side_effect = [error, {"ETag": "etag-1"}]
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    with mock.patch("time.sleep"):
+        s.upload_multipart(BytesIO(b"x"), "test.jpg")
+
+    assert mock_s3_client.upload_part.call_count == 2
+    assert mock_s3_client.complete_multipart_upload.called
+    assert not mock_s3_client.abort_multipart_upload.called
+
+
+def test_upload_multipart_aborts_on_failure(mock_s3_client):
+    from io import BytesIO
+
+    from botocore.exceptions import ClientError
+
+    from pyramid_storage import s3
+
+    error = ClientError({"Error": {"Code": "500"}}, "UploadPart")
+    mock_s3_client.create_multipart_upload.return_value = {"UploadId": "abc"}
+    mock_s3_client.upload_part.side_effect = error
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", part_retries=1)
+
+    with mock.patch("time.sleep"):
+        with pytest.raises(ClientError):
+            s.upload_multipart(BytesIO(b"x"), "test.jpg")
+
+    assert mock_s3_client.upload_part.call_count == 2
+    assert not mock_s3_client.complete_multipart_upload.called
+    mock_s3_client.abort_multipart_upload.assert_called_with(
+        Bucket="my_bucket", Key="test.jpg", UploadId="abc"
+    )
+
+
+def test_delete_many(mock_s3_client):
+    from pyramid_storage import s3
+
+    def delete_objects(Bucket, Delete):
+        keys = [obj["Key"] for obj in Delete["Objects"]]
+        return {
+            "Deleted": [{"Key": key} for key in keys if key != "error.jpg"],
+            "Errors": [{"Key": key, "Code": "AccessDenied"} for key in keys if key == "error.jpg"],
+        }
+
+    mock_s3_client.delete_objects.side_effect = delete_objects
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    filenames = ["%d.jpg" % i for i in range(1500)] + ["error.jpg"]
+    results = s.delete_many(filenames)
+
+    assert mock_s3_client.delete_objects.call_count == 2
+    _, kwargs = mock_s3_client.delete_objects.call_args_list[0]
+    assert kwargs["Bucket"] == "my_bucket"
+    assert len(kwargs["Delete"]["Objects"]) == 1000
+    assert results["0.jpg"]
+    assert results["1499.jpg"]
+    assert not results["error.jpg"]
+
+
+def test_exists_many(mock_s3_client):
+    from botocore.exceptions import ClientError
+
+    from pyramid_storage import s3
+
+    def head_object(Bucket, Key):
+        if Key == "missing.jpg":
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {}
+
+    mock_s3_client.head_object.side_effect = head_object
+    mock_s3_client.exceptions.ClientError = ClientError
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", max_workers=2)
+
+    assert s.exists_many(["a.jpg", "b.jpg", "missing.jpg"]) == {
+        "a.jpg": True,
+        "b.jpg": True,
+        "missing.jpg": False,
+    }
+    assert mock_s3_client.head_object.call_count == 3
+
+
+def test_exists_many_with_prefix(mock_s3_client):
+    from pyramid_storage import s3
+
+    paginator = mock_s3_client.get_paginator.return_value
+    paginator.paginate.return_value = [
+        {"Contents": [{"Key": "photos/a.jpg"}]},
+        {"Contents": [{"Key": "photos/b.jpg"}]},
+    ]
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    results = s.exists_many(["photos/a.jpg", "photos/b.jpg", "photos/c.jpg"], prefix="photos/")
+
+    assert results == {"photos/a.jpg": True, "photos/b.jpg": True, "photos/c.jpg": False}
+    mock_s3_client.get_paginator.assert_called_with("list_objects_v2")
+    paginator.paginate.assert_called_with(Bucket="my_bucket", Prefix="photos/")
+    assert not mock_s3_client.head_object.called
+
+
+def test_list(mock_s3_client):
+    import datetime
+
+    from pyramid_storage import s3
+
+    modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    paginator = mock_s3_client.get_paginator.return_value
+    paginator.paginate.return_value = [
+        {
+            "Contents": [
+                {"Key": "photos/a.jpg", "Size": 4, "LastModified": modified, "ETag": '"a"'}
+            ]
+        },
+        {
+            "Contents": [
+                {"Key": "photos/b.jpg", "Size": 5, "LastModified": modified, "ETag": '"b"'}
+            ]
+        },
+        {},
+    ]
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    files = list(s.list("photos/", recursive=False))
+
+    assert [(f.name, f.size, f.etag) for f in files] == [
+        ("photos/a.jpg", 4, '"a"'),
+        ("photos/b.jpg", 5, '"b"'),
+    ]
+    assert files[0].mtime == modified.timestamp()
+    mock_s3_client.get_paginator.assert_called_with("list_objects_v2")
+    paginator.paginate.assert_called_with(Bucket="my_bucket", Prefix="photos/", Delimiter="/")
+
+
+def test_copy(mock_s3_client):
+    from pyramid_storage import s3
+
+    mock_s3_client.head_object.return_value = {"ContentLength": 100}
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", acl="public-read")
+
+    assert s.copy("tmp/a.jpg", "published/a.jpg") == "published/a.jpg"
+    mock_s3_client.copy_object.assert_called_once_with(
+        Bucket="my_bucket",
+        Key="published/a.jpg",
+        CopySource={"Bucket": "my_bucket", "Key": "tmp/a.jpg"},
+        ACL="public-read",
+    )
+
+
+def test_copy_large_file(mock_s3_client):
+    from pyramid_storage import s3
+
+    size = s3.MAX_COPY_SIZE + 1
+    mock_s3_client.head_object.return_value = {"ContentLength": size, "ContentType": "video/mp4"}
+    mock_s3_client.create_multipart_upload.return_value = {"UploadId": "upload"}
+    mock_s3_client.upload_part_copy.side_effect = lambda **kwargs: {
+        "CopyPartResult": {"ETag": "etag-%d" % kwargs["PartNumber"]}
+    }
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+    s.copy("a.mp4", "b.mp4")
+
+    parts = -(-size // s3.COPY_PART_SIZE)
+    assert not mock_s3_client.copy_object.called
+    mock_s3_client.create_multipart_upload.assert_called_once_with(
+        Bucket="my_bucket", Key="b.mp4", ContentType="video/mp4"
+    )
+    ranges = sorted(
+        (c.kwargs["PartNumber"], c.kwargs["CopySourceRange"])
+        for c in mock_s3_client.upload_part_copy.call_args_list
+    )
+    assert len(ranges) == parts
+    assert ranges[0] == (1, "bytes=0-%d" % (s3.COPY_PART_SIZE - 1))
+    assert ranges[-1] == (parts, "bytes=%d-%d" % ((parts - 1) * s3.COPY_PART_SIZE, size - 1))
+    completed = mock_s3_client.complete_multipart_upload.call_args.kwargs
+    assert completed["MultipartUpload"]["Parts"] == [
+        {"PartNumber": i, "ETag": "etag-%d" % i} for i in range(1, parts + 1)
+    ]
+
+
+def test_move_many(mock_s3_client):
+    from botocore.exceptions import ClientError
+
+    from pyramid_storage import s3
+
+    def head_object(Bucket, Key):
+        if Key == "missing.jpg":
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        return {"ContentLength": 100}
+
+    mock_s3_client.head_object.side_effect = head_object
+    mock_s3_client.exceptions.ClientError = ClientError
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", max_workers=2)
+
+    results = s.move_many([("a.jpg", "b/a.jpg"), ("missing.jpg", "b/missing.jpg")])
+
+    assert results == {"a.jpg": True, "missing.jpg": False}
+    mock_s3_client.delete_object.assert_called_once_with(Bucket="my_bucket", Key="a.jpg")
+
+
+def _mock_ranged_get(data):
+    from io import BytesIO
+
+    def get_object(Bucket, Key, Range, IfMatch):
+        start, end = Range[len("bytes=") :].split("-")
+        return {"Body": BytesIO(data[int(start) : int(end) + 1])}
+
+    return get_object
+
+
+def test_open(mock_s3_client):
+    from pyramid_storage import s3
+
+    data = bytes(range(256)) * 100
+    mock_s3_client.head_object.return_value = {"ContentLength": len(data), "ETag": '"abc"'}
+    mock_s3_client.get_object.side_effect = _mock_ranged_get(data)
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", read_buffer_size=1000)
+
+    with s.open("test.bin") as f:
+        assert f.read(10) == data[:10]
+        assert f.read(10) == data[10:20]
+        assert mock_s3_client.get_object.call_count == 1
+
+        f.seek(20000)
+        assert f.read(5) == data[20000:20005]
+        f.seek(-3, 2)
+        assert f.read() == data[-3:]
+
+    ranges = [c.kwargs["Range"] for c in mock_s3_client.get_object.call_args_list]
+    assert ranges == ["bytes=0-999", "bytes=20000-20999", "bytes=25597-25599"]
+    assert all(c.kwargs["IfMatch"] == '"abc"' for c in mock_s3_client.get_object.call_args_list)
+
+
+def test_open_read_all_in_one_request(mock_s3_client):
+    from pyramid_storage import s3
+
+    data = bytes(range(256)) * 4096
+    mock_s3_client.head_object.return_value = {"ContentLength": len(data), "ETag": '"abc"'}
+    mock_s3_client.get_object.side_effect = _mock_ranged_get(data)
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", read_buffer_size=1000)
+
+    with s.open("test.bin") as f:
+        assert f.read(10) == data[:10]
+        assert f.read() == data[10:]
+
+    ranges = [c.kwargs["Range"] for c in mock_s3_client.get_object.call_args_list]
+    assert ranges == ["bytes=0-999", "bytes=1000-%d" % (len(data) - 1)]
+
+
+def test_open_if_not_found(mock_s3_client):
+    from botocore.exceptions import ClientError
+
+    from pyramid_storage import s3
+
+    mock_s3_client.exceptions.ClientError = ClientError
+    mock_s3_client.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    with pytest.raises(FileNotFoundError):
+        s.open("missing.bin")
+
+    with pytest.raises(ValueError):
+        s.open("test.bin", "wb")
+
+
+def test_presigned_url(mock_s3_client):
+    from pyramid_storage import s3
+
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+    url = s.presigned_url("test.jpg", expires_in=60, download_name="photo.jpg")
+    assert url == mock_s3_client.generate_presigned_url.return_value
+    mock_s3_client.generate_presigned_url.assert_called_once_with(
+        "get_object",
+        Params={
+            "Bucket": "my_bucket",
+            "Key": "test.jpg",
+            "ResponseContentDisposition": 'attachment; filename="photo.jpg"',
+        },
+        ExpiresIn=60,
+    )
+
+
+def test_presigned_upload_post(mock_s3_client):
+    from pyramid_storage import s3
+
+    mock_s3_client.generate_presigned_post.return_value = {
+        "url": "https://my_bucket.s3.amazonaws.com/",
+        "fields": {"key": "photos/test_1.jpg"},
+    }
+    s = s3.S3FileStorage(bucket_name="my_bucket", acl="private", extensions="images")
+
+    upload = s.presigned_upload("test 1.jpg", folder="photos", max_size=1000)
+    assert upload.filename == "photos/test_1.jpg"
+    assert upload.method == "POST"
+    assert upload.url == "https://my_bucket.s3.amazonaws.com/"
+    assert upload.fields == {"key": "photos/test_1.jpg"}
+    mock_s3_client.generate_presigned_post.assert_called_once_with(
+        "my_bucket",
+        "photos/test_1.jpg",
+        Fields={"Content-Type": "image/jpeg", "acl": "private"},
+        Conditions=[
+            {"Content-Type": "image/jpeg"},
+            {"acl": "private"},
+            ["content-length-range", 0, 1000],
+        ],
+        ExpiresIn=3600,
+    )
+
+
+def test_presigned_upload_put(mock_s3_client):
+    from pyramid_storage import s3
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", acl="private", extensions="images")
+
+    upload = s.presigned_upload("test.png", method="PUT")
+    assert upload.method == "PUT"
+    assert upload.headers == {"Content-Type": "image/png", "x-amz-acl": "private"}
+    mock_s3_client.generate_presigned_url.assert_called_once_with(
+        "put_object",
+        Params={
+            "Bucket": "my_bucket",
+            "Key": "test.png",
+            "ContentType": "image/png",
+            "ACL": "private",
+        },
+        ExpiresIn=3600,
+    )
+
+
+def test_presigned_upload_not_allowed(mock_s3_client):
+    from pyramid_storage import s3
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    s = s3.S3FileStorage(bucket_name="my_bucket", extensions="images")
+
+    with pytest.raises(FileNotAllowed):
+        s.presigned_upload("test.exe")
+
+    with pytest.raises(ValueError):
+        s.presigned_upload("test.jpg", method="GET")
+
+
+def test_complete_upload(mock_s3_client):
+    from pyramid_storage import s3
+
+    mock_s3_client.head_object.return_value = {"ContentLength": 100, "ContentType": "image/jpeg"}
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    assert s.complete_upload("test.jpg", max_size=100, content_type="image/jpeg") == "test.jpg"
+    mock_s3_client.delete_object.assert_not_called()
+
+
+def test_complete_upload_deletes_rejected_file(mock_s3_client):
+    from pyramid_storage import s3
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    mock_s3_client.head_object.return_value = {"ContentLength": 101, "ContentType": "image/jpeg"}
+    s = s3.S3FileStorage(bucket_name="my_bucket")
+
+    with pytest.raises(FileNotAllowed):
+        s.complete_upload("test.jpg", max_size=100)
+    mock_s3_client.delete_object.assert_called_once_with(Bucket="my_bucket", Key="test.jpg")
+
+    mock_s3_client.delete_object.reset_mock()
+    with pytest.raises(FileNotAllowed):
+        s.complete_upload("test.jpg", content_type="image/png")
+    assert mock_s3_client.delete_object.called
+
+
+def test_complete_upload_sniffs_content(mock_s3_client):
+    from pyramid_storage import s3
+    from pyramid_storage.exceptions import ContentNotAllowed
+
+    data = b"%PDF-1.7\n"
+    mock_s3_client.head_object.return_value = {"ContentLength": len(data), "ETag": '"abc"'}
+    mock_s3_client.get_object.side_effect = _mock_ranged_get(data)
+    s = s3.S3FileStorage(bucket_name="my_bucket", extensions="images", sniff_content=True)
+
+    with pytest.raises(ContentNotAllowed):
+        s.complete_upload("test.jpg")
+    assert mock_s3_client.delete_object.called
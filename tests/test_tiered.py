@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def _make_storage(tmp_path, **kwargs):
+    from pyramid_storage import local, tiered
+
+    remote = local.LocalFileStorage(str(tmp_path / "remote"), base_url="http://cdn/")
+    remote.open = mock.Mock(wraps=remote.open)
+    cache = local.LocalFileStorage(str(tmp_path / "cache"), extensions="any")
+    return tiered.TieredFileStorage(remote, cache, **kwargs)
+
+
+def test_from_settings(tmp_path):
+    from pyramid_storage import s3, tiered
+
+    settings = {
+        "storage.tiered.remote": "s3",
+        "storage.tiered.path": str(tmp_path),
+        "storage.tiered.max_bytes": "1000",
+        "storage.aws.bucket_name": "my_bucket",
+    }
+    s = tiered.TieredFileStorage.from_settings(settings, "storage.")
+
+    assert isinstance(s.remote, s3.S3FileStorage)
+    assert s.cache.base_path == str(tmp_path)
+    assert s.max_bytes == 1000
+
+    settings["storage.tiered.remote"] = "ftp"
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        tiered.TieredFileStorage.from_settings(settings, "storage.")
+
+
+def test_save_file_writes_through(tmp_path):
+    s = _make_storage(tmp_path)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+
+    assert name == "photos/test.jpg"
+    assert open(s.remote.path(name), "rb").read() == b"test"
+    assert open(s.cache.path(name), "rb").read() == b"test"
+    assert s.url(name) == "http://cdn/photos/test.jpg"
+    with s.open(name) as f:
+        assert f.read() == b"test"
+    assert not s.remote.open.called
+    assert [f for f in os.listdir(str(tmp_path / "cache")) if f != "photos"] == []
+
+
+def test_save_file_not_cached_if_remote_may_keep_existing_file(tmp_path):
+    s = _make_storage(tmp_path)
+    s.remote.keeps_existing_files = True
+    s.cache.save_file(BytesIO(b"old"), "test.jpg")
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+    assert not s.cache.exists(name)
+
+    name = s.save_file(BytesIO(b"new"), "test.jpg", replace=True)
+    assert open(s.cache.path(name), "rb").read() == b"new"
+
+
+def test_open_reads_through(tmp_path):
+    s = _make_storage(tmp_path)
+    name = s.remote.save_file(BytesIO(b"test"), "test.jpg")
+
+    with s.open(name) as f:
+        assert f.read() == b"test"
+    with s.open(name) as f:
+        assert f.read() == b"test"
+
+    assert s.remote.open.call_count == 1
+    assert s.path(name) == s.cache.path(name)
+
+
+def test_open_large_file_skips_cache(tmp_path):
+    s = _make_storage(tmp_path, max_bytes=2)
+    name = s.remote.save_file(BytesIO(b"test"), "test.jpg")
+
+    with s.open(name) as f:
+        assert f.read() == b"test"
+
+    assert not s.cache.exists(name)
+
+
+def test_path_of_large_file_raises(tmp_path):
+    import errno
+
+    s = _make_storage(tmp_path, max_bytes=50)
+    name = s.remote.save_file(BytesIO(b"x" * 100), "test.jpg")
+
+    with pytest.raises(OSError) as e:
+        s.path(name)
+
+    assert e.value.errno == errno.EFBIG
+    assert not s.cache.exists(name)
+
+
+def test_save_large_cloned_file_skips_cache(tmp_path):
+    s = _make_storage(tmp_path, max_bytes=2)
+    # Pruning would evict the file anyway.
+    s.prune = mock.Mock()
+
+    def clone(src, dest, buffer_size):
+        # Like FICLONE, leaves the position of dest unchanged.
+        dest.flush()
+        os.pwrite(dest.fileno(), src.read(), 0)
+
+    with mock.patch("pyramid_storage.tiered._copy_file", clone):
+        name = s.save_file(BytesIO(b"test"), "test.jpg")
+
+    assert s.remote.exists(name)
+    assert not s.cache.exists(name)
+
+
+def test_prune_evicts_least_recently_used(tmp_path):
+    s = _make_storage(tmp_path, max_bytes=12)
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        s.save_file(BytesIO(b"test"), name)
+    now = time.time()
+    os.utime(s.cache.path("a.jpg"), (now - 20, now - 20))
+    os.utime(s.cache.path("b.jpg"), (now - 10, now - 10))
+
+    s.open("a.jpg").close()
+    s.max_bytes = 10
+    assert s.prune() == 1
+
+    assert not s.cache.exists("b.jpg")
+    assert s.cache.exists("a.jpg")
+    assert s.cache.exists("c.jpg")
+    assert s.exists("b.jpg")
+
+
+def test_prune_evicts_expired_files(tmp_path):
+    s = _make_storage(tmp_path, max_age=60)
+    s.save_file(BytesIO(b"test"), "test.jpg")
+    old = time.time() - 120
+    os.utime(s.cache.path("test.jpg"), (old, old))
+
+    assert s.prune() == 1
+    assert not s.cache.exists("test.jpg")
+
+
+def test_delete_and_move(tmp_path):
+    s = _make_storage(tmp_path)
+    s.save_file(BytesIO(b"test"), "a.jpg")
+    s.save_file(BytesIO(b"test"), "b.jpg")
+
+    s.move("a.jpg", "c.jpg")
+    s.delete("b.jpg")
+
+    assert s.exists_many(["a.jpg", "b.jpg", "c.jpg"]) == {
+        "a.jpg": False,
+        "b.jpg": False,
+        "c.jpg": True,
+    }
+    assert s.cache.exists("c.jpg")
+    assert not s.cache.exists("b.jpg")
+
+
+def test_includeme(tmp_path):
+    from pyramid.testing import testConfig
+
+    from pyramid_storage import tiered
+    from pyramid_storage.interfaces import IFileStorage
+
+    settings = {
+        "storage.tiered.remote": "s3",
+        "storage.tiered.path": str(tmp_path),
+        "storage.aws.bucket_name": "my_bucket",
+    }
+    with testConfig(settings=settings) as config:
+        config.include("pyramid_storage.tiered")
+        impl = config.registry.getUtility(IFileStorage)
+
+    assert isinstance(impl, tiered.TieredFileStorage)
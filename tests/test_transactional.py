@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+import os
+from io import BytesIO
+from unittest import mock
+
+import pytest
+
+
+def _make_storage(tmp_path):
+    import transaction
+
+    from pyramid_storage import local, transactional
+
+    manager = transaction.TransactionManager()
+    storage = local.LocalFileStorage(str(tmp_path))
+    return transactional.TransactionalFileStorage(storage, manager), manager
+
+
+def test_save_is_written_on_commit(tmp_path):
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+    assert name == os.path.join("photos", "test.jpg")
+    assert s.exists(name)
+    # the name is reserved but nothing is written yet
+    assert (tmp_path / name).read_bytes() == b""
+    assert s.save_file(BytesIO(b"other"), "test.jpg", folder="photos") == os.path.join(
+        "photos", "test-1.jpg"
+    )
+
+    manager.commit()
+    assert (tmp_path / name).read_bytes() == b"test"
+    assert (tmp_path / "photos" / "test-1.jpg").read_bytes() == b"other"
+
+
+def test_save_is_discarded_on_abort(tmp_path):
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+    manager.abort()
+
+    assert os.listdir(str(tmp_path / "photos")) == []
+
+
+def test_failed_flush_removes_uploaded_files(tmp_path):
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    s.save_file(BytesIO(b"test"), "a.jpg")
+    s.save_file(BytesIO(b"test"), "b.jpg")
+
+    save_file = s.storage.save_file
+
+    def failing_save_file(file, filename, **kwargs):
+        if filename == "b.jpg":
+            raise OSError("disk full")
+        return save_file(file, filename, **kwargs)
+
+    with mock.patch.object(s.storage, "save_file", side_effect=failing_save_file):
+        with pytest.raises(OSError):
+            manager.commit()
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_delete_runs_after_commit(tmp_path):
+    s, manager = _make_storage(tmp_path)
+    (tmp_path / "test.jpg").write_bytes(b"test")
+
+    manager.begin()
+    s.delete("test.jpg")
+    assert not s.exists("test.jpg")
+    assert (tmp_path / "test.jpg").exists()
+    manager.abort()
+    assert (tmp_path / "test.jpg").exists()
+
+    manager.begin()
+    s.delete("test.jpg")
+    manager.commit()
+    assert not (tmp_path / "test.jpg").exists()
+
+
+def test_delete_of_staged_save(tmp_path):
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+    s.delete(name)
+    assert not s.exists(name)
+    # Another writer gets the name given back by the delete.
+    assert s.storage.save_file(BytesIO(b"other"), "test.jpg") == name
+    manager.commit()
+
+    assert (tmp_path / name).read_bytes() == b"other"
+
+
+def test_abort_uses_staged_bucket():
+    import transaction
+
+    from pyramid_storage import transactional
+
+    manager = transaction.TransactionManager()
+    storage = mock.Mock(max_workers=2, sniff_content=False)
+    storage.reserve_filename.return_value = "test.jpg"
+    s = transactional.TransactionalFileStorage(storage, manager)
+    manager.begin()
+
+    s.save_file(BytesIO(b"test"), "test.jpg", bucket_name="other")
+    s.save_file(BytesIO(b"test"), "test.jpg", bucket_name="other", extensions=("jpg",))
+    s._flushed.append("test.jpg")
+    manager.abort()
+
+    storage.delete.assert_called_once_with("test.jpg", bucket_name="other")
+
+    manager.begin()
+    s.save_file(BytesIO(b"test"), "test.jpg", bucket_name="other")
+    manager.abort()
+
+    storage.release_filename.assert_called_with("test.jpg", bucket_name="other")
+
+
+def test_save_content_addressed(tmp_path):
+    import hashlib
+
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", content_addressed=True)
+    assert name == hashlib.sha256(b"test").hexdigest() + ".jpg"
+    assert not (tmp_path / name).exists()
+    manager.commit()
+
+    assert (tmp_path / name).read_bytes() == b"test"
+
+
+def test_save_not_allowed(tmp_path):
+    from pyramid_storage.exceptions import FileNotAllowed
+
+    s, manager = _make_storage(tmp_path)
+    manager.begin()
+
+    with pytest.raises(FileNotAllowed):
+        s.save_file(BytesIO(b"test"), "test.exe")
+    manager.commit()
+
+
+def test_request_storage_joins_request_tm(tmp_path):
+    import transaction
+    from pyramid.request import apply_request_extensions
+    from pyramid.testing import DummyRequest, testConfig
+
+    from pyramid_storage.transactional import TransactionalFileStorage
+
+    settings = {
+        "storage.base_path": str(tmp_path),
+        "storage.transactional": "true",
+    }
+
+    with testConfig(settings=settings) as config:
+        config.include("pyramid_storage")
+        request = DummyRequest()
+        request.registry = config.registry
+        request.tm = transaction.TransactionManager()
+        request.tm.begin()
+
+        apply_request_extensions(request)
+        storage = request.storage
+        assert isinstance(storage, TransactionalFileStorage)
+        assert storage.transaction_manager is request.tm
+
+        storage.save_file(BytesIO(b"test"), "test.jpg")
+        request.tm.commit()
+
+    assert (tmp_path / "test.jpg").read_bytes() == b"test"
+
+
+def test_save_many_joins_thread_local_transaction(tmp_path):
+    import transaction
+
+    from pyramid_storage import local, transactional
+
+    s = transactional.TransactionalFileStorage(local.LocalFileStorage(str(tmp_path)))
+    transaction.begin()
+    try:
+        result = s.save_many((BytesIO(b"test"), "test%d.jpg" % i) for i in range(4))
+        assert not result.errors
+        transaction.commit()
+    finally:
+        transaction.abort()
+
+    for name in result.filenames:
+        assert (tmp_path / name).read_bytes() == b"test"
@@ -18,3 +18,155 @@ def test_random_filename():
     filename = random_filename("my little pony.png")
     assert filename.endswith(".png")
     assert filename != "my little pony.png"
+
+
+def test_get_file_size():
+    from io import BytesIO
+
+    from pyramid_storage.utils import get_file_size
+
+    file = BytesIO(b"hello")
+    file.seek(2)
+    assert get_file_size(file) == 5
+    assert file.tell() == 2
+
+
+def test_get_file_size_if_not_seekable():
+    from unittest import mock
+
+    from pyramid_storage.utils import get_file_size
+
+    file = mock.Mock()
+    file.seek.side_effect = OSError
+    assert get_file_size(file) is None
+
+
+def test_content_filename():
+    from pyramid_storage.utils import content_filename
+
+    assert content_filename("Test.JPG", "abc123") == "abc123.jpg"
+    assert content_filename("README", "abc123") == "abc123"
+
+
+def test_digest_file():
+    import hashlib
+    from io import BytesIO
+
+    from pyramid_storage.utils import b64_digest, digest_file
+
+    file = BytesIO(b"hello world")
+    file.seek(3)
+    result, sha256, md5 = digest_file(file, buffer_size=4)
+    assert result is file
+    assert file.tell() == 0
+    assert sha256.hexdigest() == hashlib.sha256(b"hello world").hexdigest()
+    assert b64_digest(md5) == "XrY7u+Ae7tCTyyK7j1rNww=="
+
+
+def test_digest_file_if_not_seekable():
+    import hashlib
+    import io
+
+    from pyramid_storage.utils import digest_file
+
+    class Stream(io.RawIOBase):
+        def __init__(self):
+            self.data = io.BytesIO(b"hello world")
+
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            return self.data.readinto(buffer)
+
+    result, sha256, _ = digest_file(Stream(), buffer_size=4)
+    assert result.read() == b"hello world"
+    assert sha256.hexdigest() == hashlib.sha256(b"hello world").hexdigest()
+
+
+def test_map_concurrently():
+    from pyramid_storage.utils import map_concurrently
+
+    assert map_concurrently(lambda x: x * 2, range(10), 3) == [x * 2 for x in range(10)]
+    assert map_concurrently(lambda x: x * 2, [], 3) == []
+
+
+def test_list_concurrently():
+    from unittest import mock
+
+    from pyramid_storage.utils import list_concurrently
+
+    storage = mock.Mock()
+    storage.list.side_effect = lambda prefix, **kwargs: iter([prefix + "1", prefix + "2"])
+
+    assert sorted(list_concurrently(storage, ["a/", "b/", "c/"], 2)) == [
+        "a/1",
+        "a/2",
+        "b/1",
+        "b/2",
+        "c/1",
+        "c/2",
+    ]
+    assert list(list_concurrently(storage, ["a/"], 2, recursive=False)) == ["a/1", "a/2"]
+    storage.list.assert_called_with("a/", recursive=False)
+
+
+def test_list_concurrently_raises():
+    from unittest import mock
+
+    import pytest
+
+    from pyramid_storage.utils import list_concurrently
+
+    def list_(prefix):
+        if prefix == "b/":
+            raise OSError("failed")
+        return iter([prefix + "1"])
+
+    storage = mock.Mock()
+    storage.list.side_effect = list_
+
+    with pytest.raises(OSError):
+        list(list_concurrently(storage, ["a/", "b/"], 2))
+
+
+def test_transfer_many():
+    from pyramid_storage.utils import transfer_many
+
+    def copy(src, dst):
+        if src == "missing.jpg":
+            raise FileNotFoundError(src)
+
+    assert transfer_many(copy, [("a.jpg", "b.jpg"), ("missing.jpg", "c.jpg")], 2) == {
+        "a.jpg": True,
+        "missing.jpg": False,
+    }
+
+
+def test_save_many():
+    from io import BytesIO
+    from unittest import mock
+
+    from pyramid_storage.utils import save_many
+
+    def save_file(file, filename, folder=None):
+        if filename == "bad.exe":
+            raise ValueError(filename)
+        return (folder + "/" if folder else "") + filename
+
+    storage = mock.Mock()
+    storage.save_file.side_effect = save_file
+
+    items = [
+        (BytesIO(b"abc"), "a.jpg"),
+        (BytesIO(b"x"), "bad.exe"),
+        (BytesIO(b"de"), "b.jpg", {"folder": "photos"}),
+    ]
+    result = save_many(storage, iter(items), 2)
+
+    assert result.filenames == ["a.jpg", None, "photos/b.jpg"]
+    assert list(result.errors) == [1]
+    assert isinstance(result.errors[1], ValueError)
+    assert result.bytes == 5
+    assert result.elapsed > 0
+    assert result.files_per_second > 0
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import io
+from io import BytesIO
+
+import pytest
+
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+JPEG = b"\xff\xd8\xff\xe0" + b"\x00" * 32
+PDF = b"%PDF-1.7\n" + b"\x00" * 32
+
+
+class NonSeekable(io.RawIOBase):
+    def __init__(self, data):
+        self.data = BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.data.readinto(buffer)
+
+
+def test_matches():
+    from pyramid_storage import validation
+
+    assert validation.matches("png", PNG)
+    assert not validation.matches("png", JPEG)
+    assert validation.matches("wav", b"RIFF\x00\x00\x00\x00WAVEfmt ")
+    assert not validation.matches("wav", b"RIFF\x00\x00\x00\x00AVI LIST")
+    assert validation.matches("tar", b"\x00" * 257 + b"ustar\x0000")
+    assert validation.matches("csv", b"a,b\n1,2\n")
+    assert not validation.matches("csv", PNG)
+    assert validation.matches("svg", b'<?xml version="1.0"?>\n<svg xmlns="...">')
+    assert not validation.matches("svg", b"<html></html>")
+    assert validation.matches("unknown", PNG) is None
+
+
+def test_sniff_accepts_matching_content():
+    from pyramid_storage import validation
+
+    f = BytesIO(PNG)
+    assert validation.sniff(f, "test.png", ("png",)) is f
+    assert f.tell() == 0
+
+
+def test_sniff_accepts_other_type_from_same_group():
+    from pyramid_storage import validation
+
+    assert validation.sniff(BytesIO(PNG), "test.jpg", ("jpg", "png"))
+
+
+def test_sniff_rejects_other_type_not_allowed():
+    from pyramid_storage import validation
+    from pyramid_storage.exceptions import ContentNotAllowed, FileNotAllowed
+
+    with pytest.raises(ContentNotAllowed):
+        validation.sniff(BytesIO(PNG), "test.jpg", ("jpg",))
+
+    with pytest.raises(FileNotAllowed):
+        validation.sniff(BytesIO(PDF), "test.jpg", ())
+
+
+def test_sniff_accepts_unknown_extension():
+    from pyramid_storage import validation
+
+    assert validation.sniff(BytesIO(PNG), "test.xyz", ())
+
+
+def test_sniff_keeps_non_seekable_stream_intact():
+    from pyramid_storage import validation
+
+    data = JPEG + b"x" * 10000
+    stream = NonSeekable(data)
+
+    f = validation.sniff(stream, "test.jpg", ("jpg",), sample_size=16)
+    assert stream.data.tell() == 16
+    f.seek(0)
+    assert f.read() == data
+
+    with pytest.raises(io.UnsupportedOperation):
+        f.seek(0)
+
+
+def test_sniff_non_seekable_rejected_after_sample_only():
+    from pyramid_storage import validation
+    from pyramid_storage.exceptions import ContentNotAllowed
+
+    stream = NonSeekable(PDF + b"x" * 10000)
+    with pytest.raises(ContentNotAllowed):
+        validation.sniff(stream, "test.jpg", ("jpg",), sample_size=16)
+    assert stream.data.tell() == 16
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import os
+from io import BytesIO
+from unittest import mock
+
+import pytest
+from pyramid import exceptions as pyramid_exceptions
+
+
+def _make_storage(tmp_path, **kwargs):
+    from pyramid_storage import local, writebehind
+
+    remote = local.LocalFileStorage(str(tmp_path / "remote"), base_url="http://cdn/")
+    kwargs.setdefault("threads", 0)
+    kwargs.setdefault("fsync", False)
+    return writebehind.WriteBehindFileStorage(remote, str(tmp_path / "spool"), **kwargs)
+
+
+def test_from_settings(tmp_path):
+    from pyramid_storage import s3, writebehind
+
+    settings = {
+        "storage.writebehind.remote": "s3",
+        "storage.writebehind.path": str(tmp_path),
+        "storage.writebehind.threads": "4",
+        "storage.aws.bucket_name": "my_bucket",
+    }
+    s = writebehind.WriteBehindFileStorage.from_settings(settings, "storage.")
+
+    assert isinstance(s.remote, s3.S3FileStorage)
+    assert s.threads == 4
+    assert os.path.isdir(s.journal_path)
+
+    settings["storage.writebehind.remote"] = "local"
+    with pytest.raises(pyramid_exceptions.ConfigurationError):
+        writebehind.WriteBehindFileStorage.from_settings(settings, "storage.")
+
+
+def test_save_file_is_uploaded_later(tmp_path):
+    s = _make_storage(tmp_path, base_url="/spool/")
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", folder="photos")
+
+    assert name == "photos/test.jpg"
+    assert s.is_pending(name)
+    # The local remote reserves the name with an empty file.
+    assert os.path.getsize(s.remote.path(name)) == 0
+    assert s.exists(name)
+    assert s.exists_many([name, "other.jpg"]) == {name: True, "other.jpg": False}
+    assert s.url(name) == "/spool/photos/test.jpg"
+    with s.open(name) as f:
+        assert f.read() == b"test"
+
+    assert s.process_pending() == 1
+
+    assert not s.is_pending(name)
+    assert open(s.remote.path(name), "rb").read() == b"test"
+    assert s.url(name) == "http://cdn/photos/test.jpg"
+    assert not os.path.exists(s.spool.path(name))
+    assert os.listdir(s.journal_path) == []
+
+
+def test_journal_survives_restart(tmp_path):
+    s = _make_storage(tmp_path)
+    name = s.save_file(BytesIO(b"test"), "test.jpg", randomize=True)
+
+    restarted = _make_storage(tmp_path)
+
+    assert restarted.is_pending(name)
+    assert restarted.process_pending() == 1
+    assert restarted.remote.exists(name)
+
+
+def test_failed_upload_is_retried(tmp_path):
+    s = _make_storage(tmp_path)
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+    save_file = s.remote.save_file
+    s.remote.save_file = mock.Mock(side_effect=OSError("down"))
+
+    assert s.process_pending() == 0
+    assert s.is_pending(name)
+    # Not due yet.
+    s.remote.save_file = save_file
+    assert s.process_pending() == 0
+
+    with mock.patch("time.time", return_value=10**10):
+        assert s.process_pending() == 1
+    assert s.remote.exists(name)
+
+
+def test_save_during_upload_is_uploaded_again(tmp_path):
+    s = _make_storage(tmp_path)
+    name = s.save_file(BytesIO(b"old"), "test.jpg")
+    save_file = s.remote.save_file
+
+    def save_again(*args, **kwargs):
+        s.save_file(BytesIO(b"new"), name, replace=True)
+        return save_file(*args, **kwargs)
+
+    with mock.patch.object(s.remote, "save_file", side_effect=save_again):
+        assert s.process_pending() == 1
+
+    assert s.is_pending(name)
+    assert open(s.remote.path(name), "rb").read() == b"old"
+    assert s.process_pending() == 1
+    assert open(s.remote.path(name), "rb").read() == b"new"
+
+
+def test_replace_is_passed_to_remote(tmp_path):
+    s = _make_storage(tmp_path)
+    s.save_file(BytesIO(b"test"), "a.jpg")
+    s.save_file(BytesIO(b"test"), "b.jpg", replace=True)
+
+    with mock.patch.object(s.remote, "save_file") as save_file:
+        s.process_pending()
+
+    replaced = dict((call.args[1], call.kwargs["replace"]) for call in save_file.call_args_list)
+    assert replaced == {"a.jpg": False, "b.jpg": True}
+    assert all(call.kwargs["_reserved"] for call in save_file.call_args_list)
+
+
+def test_nothing_reserved_on_remote_keeping_existing_files(tmp_path):
+    s = _make_storage(tmp_path)
+    s.remote.keeps_existing_files = True
+    s.save_file(BytesIO(b"test"), "a.jpg")
+
+    with mock.patch.object(s.remote, "save_file") as save_file:
+        s.process_pending()
+
+    assert "_reserved" not in save_file.call_args.kwargs
+
+
+def test_save_file_replace_and_randomize(tmp_path):
+    s = _make_storage(tmp_path)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", replace=True, randomize=True)
+    s.process_pending()
+
+    assert name != "test.jpg"
+    assert open(s.remote.path(name), "rb").read() == b"test"
+
+
+def test_delete_cancels_upload(tmp_path):
+    s = _make_storage(tmp_path)
+    name = s.save_file(BytesIO(b"test"), "test.jpg")
+
+    s.delete(name)
+
+    assert not s.exists(name)
+    assert s.process_pending() == 0
+    assert not s.remote.exists(name)
+
+
+def test_delete_does_not_wait_for_other_uploads(tmp_path):
+    from pyramid_storage import writebehind
+
+    s = _make_storage(tmp_path)
+    # Two names whose entries share their "entry" lock file.
+    names = {}
+    for i in range(1000):
+        name = "test%d.jpg" % i
+        prefix = os.path.basename(s._entry_path(name))[:2]
+        if prefix in names:
+            break
+        names[prefix] = name
+    uploading, deleted = names[prefix], name
+    s.save_file(BytesIO(b"test"), uploading)
+    s.save_file(BytesIO(b"test"), deleted)
+
+    upload_lock = s._lock_path(s._entry_path(uploading), "upload")
+    with writebehind._EntryLock(upload_lock, remove=True):
+        s.delete(deleted)
+        assert not s.is_pending(deleted)
+        with mock.patch.object(writebehind, "_EntryLock") as lock:
+            s.delete("missing.jpg")
+        assert not lock.called
+
+    assert s.process_pending() == 1
+    assert [f for f in os.listdir(s.locks_path) if f.endswith(".upload")] == []
+
+
+def test_content_addressed(tmp_path):
+    s = _make_storage(tmp_path)
+
+    name = s.save_file(BytesIO(b"test"), "test.jpg", content_addressed=True)
+    s.process_pending()
+
+    assert name.endswith(".jpg") and len(name) == 64 + 4
+    assert s.remote.exists(name)
+
+
+def test_worker_threads(tmp_path):
+    s = _make_storage(tmp_path, threads=2, poll_interval=0.1)
+    try:
+        names = [s.save_file(BytesIO(b"test"), "test.jpg") for _ in range(5)]
+        assert s.flush(timeout=5)
+    finally:
+        s.stop()
+
+    assert sorted(names) == sorted(os.listdir(str(tmp_path / "remote")))